@@ -0,0 +1,489 @@
+"""
+Asynchronous serving mode of the API, as an ASGI app. All connections of a worker process are handled on one event
+loop, so slow clients and idle status checks do not hold a thread each:
+
+- /predict reads the multipart upload as it arrives, without blocking, into memory or a temporary file. The cleaning,
+  validation and prediction run on the prediction threads, or in worker processes (see `asgi_task_pool`).
+- /status long polls and /events streams wait on the event loop for the task to change.
+- All other routes, like / and /results, are served by the Flask app on a small pool of threads.
+
+Run with: python -m api.serve --asgi
+"""
+import asyncio
+import io
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Union
+from urllib.parse import parse_qsl
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, File, MultipartDecoder, NeedData
+from api import main
+from api.main import REQUEST_SECONDS, describe_task, scheduler, task_store
+from ml_model.config.dynamic_config import config
+from ml_model.model.model_utils import model_registry
+from ml_model.model.predict import clean_validate_and_predict, clean_validate_and_predict_in_chunks, TaskContext
+from ml_model.model.scheduler import QueueFullError
+from ml_model.model import task_worker
+from ml_model.model.task_store import is_finished, TaskRecord
+
+
+# Seconds between checks of the task store while waiting for a task to change. Updates made in this process wake up
+# the waiters right away, updates of other processes sharing a SQLite store are picked up by these checks.
+WAIT_CHECK_INTERVAL = 1.0
+
+# Spooled uploads are written to their temporary file in blocks of this size
+SPOOL_BLOCK_BYTES = 1 << 20
+
+# Threads that serve the routes of the Flask app
+wsgi_executor = ThreadPoolExecutor(max_workers=config.serving_config.serving_threads, thread_name_prefix="wsgi")
+
+# Worker processes that process the uploads when `asgi_task_pool` is "process". They are started on first use, by a
+# fork server, because forking the threads of the API directly can leave their locks held in the worker processes.
+# They run the entry points of task_worker, which does not import the API.
+process_pool: Optional[ProcessPoolExecutor] = None
+
+
+class ClientDisconnected(Exception):
+    """Raised when the client goes away before its request has been read."""
+
+
+@dataclass
+class Upload:
+    """A CSV file read from a multipart upload, either into memory (`buffer`) or into a temporary file (`file_name`)."""
+
+    filename: str
+    buffer: Optional[io.BytesIO] = None
+    file_name: Optional[str] = None
+
+
+class TaskUpdates:
+    """Wakes up the coroutines that wait for a task to change, whenever the task store is updated in this process."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._changed = asyncio.Event()
+
+    def notify(self) -> None:
+        # Called by the threads that update the task store
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self, task_id: str, since: float, timeout: float) -> Optional[TaskRecord]:
+        """The asynchronous counterpart of TaskStore.wait."""
+        deadline = self._loop.time() + timeout
+        while True:
+            # Taken before reading the task, so an update right after the read is not missed
+            changed = self._changed
+            record = task_store.get(task_id)
+            remaining = deadline - self._loop.time()
+            if record is None or record.updated_at > since or is_finished(record.status) or remaining <= 0:
+                return record
+            try:
+                await asyncio.wait_for(changed.wait(), min(remaining, WAIT_CHECK_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
+
+
+task_updates: Optional[TaskUpdates] = None
+
+
+def get_task_updates() -> TaskUpdates:
+    global task_updates
+    if task_updates is None:
+        task_updates = TaskUpdates(asyncio.get_running_loop())
+        task_store.add_listener(task_updates.notify)
+
+    return task_updates
+
+
+async def application(scope: dict, receive: Callable, send: Callable) -> None:
+    if scope["type"] == "lifespan":
+        await handle_lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    method, path = scope["method"], scope["path"]
+    if method == "POST" and path == "/predict":
+        await observe_request("/predict", handle_upload, scope, receive, send)
+    elif method == "GET" and path.startswith("/status/"):
+        await observe_request("/status/<task_id>", handle_status, scope, receive, send)
+    elif method == "GET" and path.startswith("/events/"):
+        await observe_request("/events/<task_id>", handle_events, scope, receive, send)
+    else:
+        # The Flask app observes its own requests
+        await call_wsgi(scope, receive, send)
+
+
+async def handle_lifespan(receive: Callable, send: Callable) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            get_task_updates()
+            if config.serving_config.prewarm_model:
+                model_registry.prewarm()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if process_pool is not None:
+                process_pool.shutdown(wait=False, cancel_futures=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def observe_request(endpoint: str, handler: Callable, scope: dict, receive: Callable, send: Callable) -> None:
+    start = time.perf_counter()
+    status = []
+
+    async def send_and_record_status(message: dict) -> None:
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+            # Streamed responses are observed when the streaming starts, like in the Flask app
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - start, endpoint=endpoint, method=scope["method"], status=str(message["status"])
+            )
+        await send(message)
+
+    try:
+        await handler(scope, receive, send_and_record_status)
+    except ClientDisconnected:
+        pass
+    except Exception:
+        logging.exception(f"Error handling {scope['method']} {scope['path']}")
+        if not status:
+            await send_json(send_and_record_status, {"msg": "Internal server error."}, status=500)
+
+
+def query_args(scope: dict) -> MultiDict:
+    return MultiDict(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True))
+
+
+def request_headers(scope: dict) -> Dict[str, str]:
+    return {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+
+
+async def send_response(
+        send: Callable,
+        body: bytes,
+        content_type: str,
+        status: int = 200,
+        headers: Optional[Dict[str, str]] = None
+) -> None:
+    response_headers = [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]
+    response_headers += [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+    await send({"type": "http.response.start", "status": status, "headers": response_headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send: Callable, payload: dict, status: int = 200, headers: Optional[Dict[str, str]] = None):
+    await send_response(send, json.dumps(payload).encode(), "application/json", status, headers)
+
+
+async def handle_upload(scope: dict, receive: Callable, send: Callable) -> None:
+    """The asynchronous counterpart of main.make_prediction."""
+    args = query_args(scope)
+    headers = request_headers(scope)
+    output, k, error = main.parse_output_options(args)
+    if error:
+        await send_json(send, {"msg": error}, status=400)
+        return
+    version, error, status_code = main.parse_model_version(args)
+    if error:
+        await send_json(send, {"msg": error}, status=status_code)
+        return
+
+    task_id = str(uuid.uuid4())
+    upload_size = int(headers["content-length"]) if headers.get("content-length", "").isdigit() else None
+    client_id = headers.get("x-client-id") or (scope["client"][0] if scope.get("client") else "unknown")
+    try:
+        ticket = scheduler.reserve(task_id, client_id, main.estimate_rows(upload_size))
+    except QueueFullError as e:
+        await send_queue_full(send, e)
+        return
+
+    upload = None
+    try:
+        in_memory = upload_size is not None and upload_size <= config.serving_config.in_memory_upload_max_bytes
+        upload = await receive_upload(receive, headers.get("content-type", ""), in_memory)
+        if upload is None or not upload.filename.endswith(".csv"):
+            scheduler.cancel(ticket)
+            if upload is not None and upload.file_name:
+                os.remove(upload.file_name)
+            await send_json(send, {"msg": "Invalid file format. Please upload a CSV file."}, status=400)
+            return
+
+        context = TaskContext(task_id=task_id, task_store=task_store, output=output, k=k, version=version)
+        if upload.buffer is not None:
+            task_store.create(task_id, status="queued")
+            scheduler.submit(ticket, main.start_task, process_upload, context, upload.buffer, None)
+        else:
+            context.temp_file_name = upload.file_name
+            if upload_size is None:
+                # Uploads without a Content-Length were admitted at the smallest cost, now their size is known
+                try:
+                    scheduler.resize(ticket, main.estimate_rows(os.path.getsize(upload.file_name)))
+                except QueueFullError as e:
+                    os.remove(upload.file_name)
+                    await send_queue_full(send, e)
+                    return
+            chunked = main.is_chunked(upload.file_name)
+            if chunked and output != "labels":
+                os.remove(upload.file_name)
+                scheduler.cancel(ticket)
+                await send_json(send, {"msg": "Uploads this large can only be predicted with output=labels."}, 400)
+                return
+            task_store.create(task_id, status="queued")
+            chunk_size = config.serving_config.streaming_chunk_size if chunked else None
+            scheduler.submit(ticket, main.start_task, process_upload, context, upload.file_name, chunk_size)
+    except Exception:
+        scheduler.cancel(ticket)
+        if upload is not None and upload.file_name and os.path.exists(upload.file_name):
+            os.remove(upload.file_name)
+        raise
+
+    await send_json(send, {"task_id": task_id, "msg": "File uploaded and processing started!"})
+
+
+async def send_queue_full(send: Callable, error: QueueFullError) -> None:
+    await send_json(send, {"msg": str(error)}, status=429, headers={"Retry-After": str(error.retry_after_seconds)})
+
+
+async def receive_upload(receive: Callable, content_type: str, in_memory: bool) -> Optional[Upload]:
+    """
+    Reads the "file" part of a multipart body as it arrives. Returns None if the body has no such part. The other
+    parts are skipped.
+    """
+    mimetype, options = parse_options_header(content_type)
+    if mimetype != "multipart/form-data" or "boundary" not in options:
+        await read_body(receive)
+        return None
+
+    decoder = MultipartDecoder(options["boundary"].encode("latin-1"))
+    upload = None
+    in_upload = False
+    pending = bytearray()
+    spool_file = None
+    try:
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise ClientDisconnected()
+            more_body = message.get("more_body", False)
+            decoder.receive_data(message.get("body", b""))
+            if not more_body:
+                decoder.receive_data(None)
+
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, File) and event.name == "file" and upload is None:
+                    upload = Upload(filename=event.filename or "")
+                    in_upload = True
+                    if in_memory:
+                        upload.buffer = io.BytesIO()
+                    else:
+                        upload.file_name = main.create_spool_file()
+                        spool_file = open(upload.file_name, "wb")
+                elif isinstance(event, Data) and in_upload:
+                    pending += event.data
+                    in_upload = event.more_data
+                elif not isinstance(event, Data):
+                    in_upload = False
+                event = decoder.next_event()
+
+            # Memory is appended to right away, files are written off the event loop in large blocks
+            if upload is not None and upload.buffer is not None:
+                upload.buffer.write(pending)
+                pending.clear()
+            elif spool_file is not None and (len(pending) >= SPOOL_BLOCK_BYTES or not in_upload):
+                block, pending = bytes(pending), bytearray()
+                await asyncio.to_thread(spool_file.write, block)
+
+        if spool_file is not None and pending:
+            await asyncio.to_thread(spool_file.write, bytes(pending))
+        if upload is not None and upload.buffer is not None:
+            upload.buffer.seek(0)
+    except Exception:
+        if spool_file is not None:
+            spool_file.close()
+            os.remove(upload.file_name)
+        raise
+    finally:
+        if spool_file is not None and not spool_file.closed:
+            await asyncio.to_thread(spool_file.close)
+
+    return upload
+
+
+async def read_body(receive: Callable) -> bytes:
+    body = bytearray()
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+    return bytes(body)
+
+
+def process_upload(context: TaskContext, source: Union[str, io.BytesIO], chunk_size: Optional[int]) -> None:
+    """
+    Cleans, validates and predicts an upload on the configured task pool. Runs on a prediction thread, which waits
+    for the worker process when the uploads are processed in worker processes.
+    """
+    if config.serving_config.asgi_task_pool != "process":
+        if chunk_size:
+            clean_validate_and_predict_in_chunks(context, source, chunk_size)
+        else:
+            clean_validate_and_predict(context, source)
+        return
+
+    global process_pool
+    if process_pool is None:
+        process_pool = ProcessPoolExecutor(
+            config.serving_config.executor_workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=task_worker.init_worker,
+            initargs=(config.serving_config,)
+        )
+    try:
+        # Uploads in memory are sent to the worker process as bytes
+        payload = source if isinstance(source, str) else source.getvalue()
+        record = process_pool.submit(
+            task_worker.process_upload, context.task_id, context.output, context.k, context.version, payload, chunk_size
+        ).result()
+        context.task_store.update(
+            context.task_id, status=record.status, processed_rows=record.processed_rows, result=record.result
+        )
+    except Exception as e:
+        logging.error(f"Processing failed for task {context.task_id}: {e}")
+        context.task_store.update(context.task_id, status=f"failed: {e}", result={"status": "failed", "error": str(e)})
+    finally:
+        # The worker process removes the file, unless it died first
+        if isinstance(source, str) and os.path.exists(source):
+            os.remove(source)
+
+
+async def handle_status(scope: dict, receive: Callable, send: Callable) -> None:
+    """The asynchronous counterpart of main.check_status."""
+    task_id = scope["path"][len("/status/"):]
+    args = query_args(scope)
+    wait = min(args.get("wait", 0.0, type=float), config.serving_config.status_max_wait_seconds)
+    include_result = args.get("include_result", "false").lower() in ("1", "true")
+    record = task_store.get(task_id)
+    if record is not None and wait > 0:
+        since = args.get("since", record.updated_at, type=float)
+        record = await get_task_updates().wait(task_id, since, wait)
+
+    await send_json(send, describe_task(task_id, record, include_result))
+
+
+async def handle_events(scope: dict, receive: Callable, send: Callable) -> None:
+    """The asynchronous counterpart of main.task_events."""
+    task_id = scope["path"][len("/events/"):]
+    headers = [(b"content-type", b"text/event-stream; charset=utf-8"), (b"cache-control", b"no-cache")]
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+
+    deadline = time.monotonic() + config.serving_config.events_max_seconds
+    record = task_store.get(task_id)
+    last_update = None
+    while record is not None and not is_finished(record.status) and time.monotonic() < deadline:
+        update = describe_task(task_id, record)
+        if update != last_update:
+            await send_event(send, f"event: status\ndata: {json.dumps(update)}\n\n")
+            last_update = update
+        else:
+            # Keeps proxies from closing the idle connection
+            await send_event(send, ": keep-alive\n\n")
+        # The queue position changes without the task being updated, so queued tasks are checked more often
+        timeout = 1.0 if record.status == "queued" else config.serving_config.events_keep_alive_seconds
+        record = await get_task_updates().wait(task_id, record.updated_at, timeout)
+
+    if record is None:
+        await send_event(send, f"event: unknown\ndata: {json.dumps(describe_task(task_id, None))}\n\n")
+    elif is_finished(record.status):
+        event = "completed" if record.status == "completed" else "failed"
+        await send_event(send, f"event: {event}\ndata: {json.dumps(describe_task(task_id, record, True))}\n\n")
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def send_event(send: Callable, event: str) -> None:
+    await send({"type": "http.response.body", "body": event.encode(), "more_body": True})
+
+
+async def call_wsgi(scope: dict, receive: Callable, send: Callable) -> None:
+    """Serves the request with the Flask app on the WSGI threads. Streamed responses are sent as they are produced."""
+    try:
+        body = await read_body(receive)
+    except ClientDisconnected:
+        return
+
+    loop = asyncio.get_running_loop()
+    response_start = {}
+
+    def start_response(status: str, headers: list, exc_info=None):
+        response_start["status"] = int(status.split(" ", 1)[0])
+        response_start["headers"] = [
+            (name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers
+        ]
+
+    result = await loop.run_in_executor(wsgi_executor, main.app, wsgi_environ(scope, body), start_response)
+    try:
+        chunks = iter(result)
+        # WSGI apps may start the response when the first chunk is produced
+        chunk = await loop.run_in_executor(wsgi_executor, next, chunks, None)
+        await send({"type": "http.response.start", **response_start})
+        while chunk is not None:
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            chunk = await loop.run_in_executor(wsgi_executor, next, chunks, None)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(result, "close"):
+            await loop.run_in_executor(wsgi_executor, result.close)
+
+
+def wsgi_environ(scope: dict, body: bytes) -> dict:
+    """Translates an ASGI request into a WSGI environment."""
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ[name] = value
+        elif name != "CONTENT_LENGTH":
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+    return environ
@@ -0,0 +1,73 @@
+"""
+This file contains the encoding of prediction results in the response formats the API supports. The client picks a
+format with the `format` query parameter or the Accept header:
+
+- json (application/json): predicted labels as {"predictions": [...]}, other outputs column by column as
+  {"columns": {name: [...]}}.
+- ndjson (application/x-ndjson): one JSON object per row, streamed in blocks of rows.
+- npy (application/x-npy): a NumPy structured array with one field per column, as written by numpy.save.
+
+Results are encoded from the arrays of every column, so large results are never turned into nested Python lists.
+"""
+import io
+import json
+import numpy as np
+from flask import Request, Response, jsonify
+from typing import Dict, Iterator, Optional
+
+
+FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "npy": "application/x-npy",
+}
+
+# Number of rows that are encoded at a time when streaming NDJSON
+NDJSON_BLOCK_ROWS = 10_000
+
+
+def negotiate_format(request: Request) -> Optional[str]:
+    """Returns the requested response format, or None if the requested format is not supported."""
+    requested = request.args.get("format")
+    if requested is not None:
+        return requested if requested in FORMATS else None
+
+    mimetype = request.accept_mimetypes.best_match(list(FORMATS.values()), default=FORMATS["json"])
+    return next(name for name, format_mimetype in FORMATS.items() if format_mimetype == mimetype)
+
+
+def encode_columns(columns: Dict[str, np.ndarray], version: str, response_format: str) -> Response:
+    """Encodes the output columns of a prediction in the given format."""
+    if response_format == "ndjson":
+        response = Response(stream_ndjson(columns), mimetype=FORMATS["ndjson"])
+    elif response_format == "npy":
+        response = Response(to_npy(columns), mimetype=FORMATS["npy"])
+    elif list(columns) == ["prediction"]:
+        response = jsonify({"predictions": columns["prediction"].tolist(), "version": version})
+    else:
+        response = jsonify({
+            "columns": {name: values.tolist() for name, values in columns.items()},
+            "n_rows": len(next(iter(columns.values()))),
+            "version": version,
+        })
+
+    response.headers["X-Model-Version"] = version
+    return response
+
+
+def stream_ndjson(columns: Dict[str, np.ndarray]) -> Iterator[str]:
+    names = list(columns)
+    n_rows = len(columns[names[0]])
+    for start in range(0, n_rows, NDJSON_BLOCK_ROWS):
+        block = [columns[name][start:start + NDJSON_BLOCK_ROWS].tolist() for name in names]
+        yield "".join(json.dumps(dict(zip(names, row))) + "\n" for row in zip(*block))
+
+
+def to_npy(columns: Dict[str, np.ndarray]) -> bytes:
+    table = np.empty(len(next(iter(columns.values()))), dtype=[(name, values.dtype) for name, values in columns.items()])
+    for name, values in columns.items():
+        table[name] = values
+
+    buffer = io.BytesIO()
+    np.save(buffer, table, allow_pickle=False)
+    return buffer.getvalue()
@@ -1,26 +1,159 @@
 import argparse
+import io
+import json
 import os
 import tempfile
 import threading
+import time
 import uuid
-from flask import Flask, request, render_template, jsonify
-from ml_model.model.predict import clean_validate_and_predict, TaskContext
+import numpy as np
+from flask import Flask, Response, g, request, render_template, jsonify
+from api.encoding import encode_columns, negotiate_format
+from ml_model.config.dynamic_config import config
+from ml_model.model.metrics import metrics
+from ml_model.model.parallelism import limit_native_threads, parallelism_budget
+from ml_model.model.model_utils import model_pool, model_registry
+from ml_model.model.predict import (
+    clean_validate_and_predict,
+    clean_validate_and_predict_in_chunks,
+    micro_batcher,
+    OUTPUT_MODES,
+    prediction_cache,
+    validate_and_predict_records,
+    TaskContext
+)
+from ml_model.model.profiling import profile_slow_request
+from ml_model.model.scheduler import AdmissionScheduler, QueueFullError, Ticket
+from ml_model.model.task_store import create_task_store, is_finished, TaskRecord
 from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Mapping, Optional, Tuple
 
 
 app = Flask(__name__)
 
 
-# Initialize thread pool.
-executor = ThreadPoolExecutor(max_workers=5)
+# Initialize thread pool. Its threads are only started when work is submitted, so the pool can be created before
+# the production server forks its worker processes.
+executor = ThreadPoolExecutor(max_workers=config.serving_config.executor_workers)
 
-# To keep track of the processing status and task results.
-processing_status = {}
-task_results = {}
+# Admits uploads while the queue has room and runs them on the executor in a fair order
+scheduler = AdmissionScheduler(
+    executor,
+    max_running=config.serving_config.executor_workers,
+    max_rows=config.serving_config.admission_max_rows,
+    max_queued_tasks=config.serving_config.admission_max_queued_tasks,
+    default_retry_after_seconds=config.serving_config.admission_retry_after_seconds,
+)
 
-# Lock to prevent race condition errors
-status_lock = threading.Lock()
-task_results_lock = threading.Lock()
+# To keep track of the processing status, the number of processed rows and task results.
+task_store = create_task_store(config.serving_config)
+
+# Long polls and event streams hold a request thread while they wait, so only this many may wait at once. Past that,
+# they are answered with a 503 and clients poll /status without waiting instead.
+waiting_requests = threading.BoundedSemaphore(config.serving_config.max_waiting_requests)
+
+# Seconds clients should wait before polling again when they are not allowed to wait
+WAIT_RETRY_AFTER_SECONDS = 1
+
+# Metrics of the API, exposed at /metrics together with those of the prediction path
+REQUEST_SECONDS = metrics.histogram(
+    "api_request_seconds", "Time spent handling a request.", labelnames=["endpoint", "method", "status"]
+)
+metrics.gauge(
+    "api_executor_queued_tasks",
+    "Number of upload tasks waiting for a prediction thread.",
+    function=lambda: scheduler.metrics()["queued_tasks"]
+)
+metrics.gauge(
+    "api_executor_running_tasks",
+    "Number of upload tasks being processed.",
+    function=lambda: scheduler.metrics()["running_tasks"]
+)
+metrics.gauge(
+    "api_executor_outstanding_rows",
+    "Estimated number of rows of the queued and running upload tasks.",
+    function=lambda: scheduler.metrics()["outstanding_rows"]
+)
+metrics.counter(
+    "api_rejected_uploads_total",
+    "Number of uploads rejected because the queue was full.",
+    function=lambda: scheduler.rejected_count
+)
+metrics.gauge(
+    "ml_model_micro_batch_queue_size",
+    "Number of JSON requests waiting to be batched.",
+    function=micro_batcher.queue_size
+)
+metrics.gauge(
+    "ml_model_loaded",
+    "Number of model versions that are loaded.",
+    function=lambda: len(model_pool.metrics()["loaded_versions"])
+)
+metrics.counter(
+    "ml_model_loads_total",
+    "Number of times a model was loaded.",
+    function=lambda: model_registry.metrics()["load_count"]
+)
+metrics.gauge(
+    "ml_model_memory_bytes",
+    "Estimated memory footprint of the loaded models of all versions.",
+    function=lambda: model_pool.metrics()["memory_bytes"]
+)
+metrics.counter(
+    "ml_model_evictions_total",
+    "Number of times a model version was unloaded to stay within the memory budget.",
+    function=lambda: model_pool.eviction_count
+)
+if prediction_cache is not None:
+    metrics.gauge(
+        "ml_model_prediction_cache_entries",
+        "Number of rows in the prediction cache.",
+        function=lambda: prediction_cache.metrics()["entries"]
+    )
+    metrics.counter(
+        "ml_model_prediction_cache_hits_total",
+        "Rows found in the prediction cache.",
+        function=lambda: prediction_cache.hits
+    )
+    metrics.counter(
+        "ml_model_prediction_cache_misses_total",
+        "Rows not found in the prediction cache.",
+        function=lambda: prediction_cache.misses
+    )
+
+metrics.gauge(
+    "ml_model_prediction_threads",
+    "Number of threads predicting, including the helper threads of sharded batches.",
+    function=lambda: parallelism_budget.active_threads
+)
+
+# The prediction threads are coordinated by the parallelism budget, native libraries should not add their own.
+limit_native_threads(config.serving_config.native_threads)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    # Streamed responses are observed when the streaming starts
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - g.request_start,
+        endpoint=endpoint,
+        method=request.method,
+        status=str(response.status_code)
+    )
+
+    return response
+
+
+def start_task(fn: Callable, context: TaskContext, *args) -> dict:
+    """Runs a queued task, marking it as processing first."""
+    context.task_store.update(context.task_id, status="processing")
+    return fn(context, *args)
 
 
 @app.route("/", methods=["GET"])
@@ -41,56 +174,351 @@ def make_prediction():
     might take some time, it is being run on a different thread.
     """
 
-    input_file = request.files.get('file')
-    if input_file and input_file.filename.endswith('.csv'):
-        # Save the file temporarily
-        temp_dir = 'tmp'
-        ensure_directory_exists(temp_dir)
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".csv", dir=temp_dir)
-        input_file.save(temp_file.name)
+    output, k, error = parse_output_options()
+    if error:
+        return jsonify({"msg": error}), 400
+    version, error, status_code = parse_model_version()
+    if error:
+        return jsonify({"msg": error}), status_code
+
+    # Generate a unique task ID to track the status
+    task_id = str(uuid.uuid4())
+
+    # Admission is decided on the size of the request, before the upload is read, so rejected uploads cost nothing.
+    upload_size = request.content_length
+    try:
+        ticket = scheduler.reserve(task_id, get_client_id(), estimate_rows(upload_size))
+    except QueueFullError as e:
+        return queue_full(e)
+
+    try:
+        input_file = request.files.get('file')
+        if not input_file or not input_file.filename.endswith('.csv'):
+            scheduler.cancel(ticket)
+            return jsonify({"msg": "Invalid file format. Please upload a CSV file."}), 400
+
+        context = TaskContext(task_id=task_id, task_store=task_store, output=output, k=k, version=version)
+
+        # Small uploads are parsed from memory. Larger ones are spooled to disk, because they have to outlive the
+        # request and are processed in chunks when they are very large.
+        if upload_size is not None and upload_size <= config.serving_config.in_memory_upload_max_bytes:
+            buffer = io.BytesIO(input_file.read())
+            task_store.create(task_id, status="queued")
+            scheduler.submit(ticket, start_task, clean_validate_and_predict, context, buffer)
+        else:
+            context.temp_file_name = spool_upload(input_file)
+            if upload_size is None:
+                # Uploads without a Content-Length were admitted at the smallest cost, now their size is known
+                try:
+                    scheduler.resize(ticket, estimate_rows(os.path.getsize(context.temp_file_name)))
+                except QueueFullError as e:
+                    os.remove(context.temp_file_name)
+                    return queue_full(e)
+            if is_chunked(context.temp_file_name) and output != "labels":
+                os.remove(context.temp_file_name)
+                scheduler.cancel(ticket)
+                return jsonify({"msg": "Uploads this large can only be predicted with output=labels."}), 400
+            task_store.create(task_id, status="queued")
+            submit_spooled_upload(context, ticket)
+    except Exception:
+        scheduler.cancel(ticket)
+        raise
+
+    return jsonify({"task_id": task_id, "msg": "File uploaded and processing started!"})
+
+
+def queue_full(error: QueueFullError):
+    response = jsonify({"msg": str(error)})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(error.retry_after_seconds)
+
+    return response
+
+
+def get_client_id() -> str:
+    """Identifies the client for fair queuing, by the X-Client-Id header or else by its address."""
+    return request.headers.get("X-Client-Id") or request.remote_addr or "unknown"
+
+
+def estimate_rows(upload_size: Optional[int]) -> int:
+    """Estimates the number of rows of an upload from its size in bytes."""
+    return (upload_size or 0) // config.serving_config.admission_bytes_per_row
+
+
+def parse_output_options(args: Optional[Mapping] = None) -> Tuple[str, int, Optional[str]]:
+    """
+    Returns the requested output mode and k, and an error message if they are invalid. The options are read from the
+    query parameters of the current request, or from `args`.
+    """
+    args = request.args if args is None else args
+    output = args.get("output", "labels")
+    k = args.get("k", 3, type=int)
+    if output not in OUTPUT_MODES:
+        return output, k, f"Unknown output mode {output!r}. Use one of {', '.join(OUTPUT_MODES)}."
+    if k < 1:
+        return output, k, "k must be a positive integer."
+
+    return output, k, None
+
+
+def parse_model_version(args: Optional[Mapping] = None) -> Tuple[str, Optional[str], int]:
+    """
+    Returns the model version that serves the request, selected by the `version` query parameter or else the default
+    version, and an error message and status code if it can not be served. See parse_output_options for `args`.
+    """
+    args = request.args if args is None else args
+    try:
+        version = model_pool.resolve(args.get("version"))
+    except ValueError as e:
+        return "", str(e), 400
+    if version != model_pool.default_version and version not in model_pool.available_versions():
+        return version, f"Unknown model version {version!r}.", 404
+
+    return version, None, 200
+
+
+def is_chunked(file_name: str) -> bool:
+    """Whether a spooled upload is large enough to be processed in chunks."""
+    return os.path.getsize(file_name) > config.serving_config.streaming_threshold_bytes
+
+
+def create_spool_file() -> str:
+    """Creates an empty temporary file for an upload and returns its path."""
+    temp_dir = 'tmp'
+    ensure_directory_exists(temp_dir)
+    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".csv", dir=temp_dir)
+    temp_file.close()
+
+    return temp_file.name
+
+
+def spool_upload(input_file) -> str:
+    """Saves the upload to a temporary file and returns its path. The file is removed if saving fails."""
+    file_name = create_spool_file()
+    try:
+        input_file.save(file_name)
+    except Exception:
+        os.remove(file_name)
+        raise
 
-        # Generate a unique task ID to track the status
-        task_id = str(uuid.uuid4())
-        with status_lock:
-            processing_status[task_id] = "processing"
+    return file_name
 
-        # Process the file in a separate thread
-        context = TaskContext(
-            task_id=task_id,
-            status_lock=status_lock,
-            processing_status=processing_status,
-            task_results=task_results,
-            task_results_lock=task_results_lock,
-            temp_file_name=temp_file.name
-        )
-        executor.submit(clean_validate_and_predict, context, temp_file.name)
 
-        return jsonify({"task_id": task_id, "msg": "File uploaded and processing started!"})
+def submit_spooled_upload(context: TaskContext, ticket: Ticket) -> None:
+    """Queues the spooled upload on the scheduler. The processing functions always remove the file."""
+    file_name = context.temp_file_name
+    try:
+        # Large files are processed in chunks to keep memory usage bounded
+        if is_chunked(file_name):
+            scheduler.submit(
+                ticket,
+                start_task,
+                clean_validate_and_predict_in_chunks,
+                context,
+                file_name,
+                config.serving_config.streaming_chunk_size
+            )
+        else:
+            scheduler.submit(ticket, start_task, clean_validate_and_predict, context, file_name)
+    except Exception:
+        os.remove(file_name)
+        raise
 
-    return jsonify({"msg": "Invalid file format. Please upload a CSV file."}), 400
+
+@app.route("/predict/json", methods=["POST"])
+def make_json_prediction():
+    """
+    This function makes a prediction for one or more records delivered as JSON and returns the predictions in the
+    response. The body is either a single record, a list of records or an object with the records under "inputs".
+    The `output` query parameter selects labels, probabilities (proba) or the k most likely classes (topk), the
+    `version` query parameter the model version, and the response format is negotiated, see api/encoding.py.
+    """
+
+    output, k, error = parse_output_options()
+    response_format = negotiate_format(request)
+    if error or response_format is None:
+        return jsonify({"msg": error or "Unsupported response format."}), 400
+    version, error, status_code = parse_model_version()
+    if error:
+        return jsonify({"msg": error}), status_code
+
+    payload = request.get_json(silent=True)
+    if isinstance(payload, dict):
+        payload = payload.get("inputs", [payload])
+    if not isinstance(payload, list) or not payload or not all(isinstance(record, dict) for record in payload):
+        return jsonify({"msg": "Invalid input. Please send one or more records as JSON."}), 400
+
+    with profile_slow_request("predict-json"):
+        columns, errors = validate_and_predict_records(payload, output, k, version)
+    if errors:
+        return jsonify({"errors": json.loads(errors)}), 400
+
+    return encode_columns(columns, version, response_format)
 
 
 @app.route("/status/<task_id>", methods=["GET"])
 def check_status(task_id):
-    status = processing_status.get(task_id, "unknown task id")
+    """
+    Returns the status of the task. With `wait`, this is a long poll: the response is held for up to `wait` seconds,
+    until the task changes after `since` (the `updated_at` of an earlier response) or is finished. Without `since`,
+    any change after the request arrived counts. With `include_result`, a finished task also carries its predictions
+    when they are kept in the task store. Long polls are answered with a 503 when `max_waiting_requests` requests
+    are waiting already.
+    """
+    wait = min(request.args.get("wait", 0.0, type=float), config.serving_config.status_max_wait_seconds)
+    include_result = request.args.get("include_result", "false").lower() in ("1", "true")
+    record = task_store.get(task_id)
+    if record is not None and wait > 0:
+        if not waiting_requests.acquire(blocking=False):
+            return too_many_waiting_requests()
+        try:
+            since = request.args.get("since", record.updated_at, type=float)
+            record = task_store.wait(task_id, since, wait)
+        finally:
+            waiting_requests.release()
+
+    return jsonify(describe_task(task_id, record, include_result))
+
+
+def too_many_waiting_requests():
+    response = jsonify({"msg": "Too many clients are waiting for updates. Please poll /status without waiting."})
+    response.headers["Retry-After"] = str(WAIT_RETRY_AFTER_SECONDS)
+
+    return response, 503
+
+
+def describe_task(task_id: str, record: Optional[TaskRecord], include_result: bool = False) -> dict:
+    """The status of a task, as reported by /status and /events."""
+    response = {"task_id": task_id, "status": record.status if record else "unknown task id"}
+    if record is None:
+        return response
+
+    response["updated_at"] = record.updated_at
+    if record.processed_rows is not None:
+        response["processed_rows"] = record.processed_rows
+    if record.status == "queued":
+        # Only known to the worker process that queued the task
+        queue_position = scheduler.queue_position(task_id)
+        if queue_position is not None:
+            response["queue_position"] = queue_position
+    if record.status == "completed":
+        response["results_url"] = f"/results/{task_id}"
+        # Results that are kept in files are only served by /results
+        if include_result and "predictions" in (record.result or {}):
+            response["result"] = record.result
+
+    return response
+
+
+@app.route("/events/<task_id>", methods=["GET"])
+def task_events(task_id):
+    """
+    Streams the updates of the task as Server-Sent Events, until it is finished. Every update is a "status" event.
+    The stream ends with a "completed" event, which carries the predictions when they are kept in the task store, or
+    with a "failed" event. Unknown tasks get a single "unknown" event. Like long polls, streams are answered with a
+    503 when `max_waiting_requests` requests are waiting already.
+    """
+    if not waiting_requests.acquire(blocking=False):
+        return too_many_waiting_requests()
 
-    return jsonify({"task_id": task_id, "status": status})
+    response = Response(
+        stream_task_events(task_id), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
+    # Called when the stream ends or the client goes away
+    response.call_on_close(waiting_requests.release)
+
+    return response
+
+
+def stream_task_events(task_id: str):
+    deadline = time.monotonic() + config.serving_config.events_max_seconds
+    record = task_store.get(task_id)
+    last_update = None
+    while record is not None and not is_finished(record.status) and time.monotonic() < deadline:
+        update = describe_task(task_id, record)
+        if update != last_update:
+            yield f"event: status\ndata: {json.dumps(update)}\n\n"
+            last_update = update
+        else:
+            # Keeps proxies from closing the idle connection
+            yield ": keep-alive\n\n"
+        # The queue position changes without the task being updated, so queued tasks are checked more often
+        timeout = 1.0 if record.status == "queued" else config.serving_config.events_keep_alive_seconds
+        record = task_store.wait(task_id, record.updated_at, timeout)
+
+    if record is None:
+        yield f"event: unknown\ndata: {json.dumps(describe_task(task_id, None))}\n\n"
+    elif is_finished(record.status):
+        event = "completed" if record.status == "completed" else "failed"
+        yield f"event: {event}\ndata: {json.dumps(describe_task(task_id, record, include_result=True))}\n\n"
+
+
+def stream_predictions_file(result: dict):
+    """Streams the predictions of a chunked task as JSON, without loading the predictions file into memory."""
+    yield '{"predictions": ['
+    separator = ""
+    with open(result["predictions_file"]) as predictions_file:
+        while lines := predictions_file.readlines(1 << 16):
+            yield separator + ",".join(line.rstrip("\n") for line in lines)
+            separator = ","
+    yield f'], "version": {json.dumps(result["version"])}}}'
 
 
 @app.route("/results/<task_id>", methods=["GET"])
 def get_results(task_id):
-    result = task_results.get(task_id)
-    if result:
-        return jsonify(result)
-    else:
+    result = task_store.get_result(task_id)
+    if not result:
         return jsonify({"error": "Task not found"}), 404
 
+    response_format = negotiate_format(request)
+    if response_format is None:
+        return jsonify({"msg": "Unsupported response format."}), 400
+
+    if "predictions_file" in result:
+        if response_format == "json":
+            return Response(stream_predictions_file(result), mimetype="application/json")
+        columns = {"prediction": np.loadtxt(result["predictions_file"], dtype=np.int64, ndmin=1)}
+    elif "output_file" in result:
+        with np.load(result["output_file"]) as output_file:
+            columns = {name: output_file[name] for name in output_file.files}
+    elif "predictions" in result and response_format != "json":
+        columns = {"prediction": np.asarray(result["predictions"])}
+    else:
+        return jsonify(result)
+
+    return encode_columns(columns, result["version"], response_format)
+
+
+@app.route("/model", methods=["GET"])
+def model_info():
+    """
+    Returns load time and memory footprint of the model of the default version, the loaded versions of the model pool
+    and the cache hit rate.
+    """
+    model_metrics = model_registry.metrics()
+    model_metrics["pool"] = {**model_pool.metrics(), "available_versions": model_pool.available_versions()}
+    if prediction_cache is not None:
+        model_metrics["prediction_cache"] = prediction_cache.metrics()
+
+    return jsonify(model_metrics)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_exposition():
+    """Returns the metrics of this process in the Prometheus text format."""
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run the app.")
     parser.add_argument("--local", action="store_true", help="Run the app locally on 127.0.0.1")
     args = parser.parse_args()
 
+    # Load the model in the background, so the first request does not have to wait for it. This is not done on
+    # import, which would pull scikit-learn into every process that imports the app.
+    if config.serving_config.prewarm_model:
+        model_registry.prewarm()
+
     if args.local:
         app.run(debug=True)
     else:
@@ -0,0 +1,92 @@
+"""
+Production entry point of the API. The app and the model are loaded once in a master process, which then pre-forks
+the worker processes. The workers share the memory pages of the model copy-on-write instead of each loading their
+own copy, and every worker serves requests on its own threads. With --asgi, every worker instead serves up to
+`asgi_connections` connections on an event loop (see api/asgi.py).
+"""
+import argparse
+import gc
+import logging
+import os
+from gunicorn.app.base import BaseApplication
+from ml_model.config.dynamic_config import config
+
+
+class PreforkApplication(BaseApplication):
+    """Runs an already imported WSGI or ASGI app with gunicorn."""
+
+    def __init__(self, application, options: dict):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def freeze_shared_objects(server, worker):
+    """
+    Runs in the master process before every fork. Moving all objects that exist at this point into the permanent
+    generation keeps the garbage collector of the workers from touching them, and with that from copying the
+    memory pages they live on.
+    """
+    gc.freeze()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the app with pre-forked worker processes.")
+    parser.add_argument("--bind", default="0.0.0.0:80", help="Address to listen on.")
+    parser.add_argument("--workers", type=int, default=config.serving_config.serving_workers,
+                        help="Number of worker processes. 0 means one per CPU core.")
+    parser.add_argument("--threads", type=int, default=config.serving_config.serving_threads,
+                        help="Number of request threads per worker process.")
+    parser.add_argument("--asgi", action="store_true", help="Serve the asynchronous ASGI app instead.")
+    parser.add_argument("--connections", type=int, default=config.serving_config.asgi_connections,
+                        help="Number of connections per worker process of the ASGI app.")
+    args = parser.parse_args()
+
+    workers = args.workers or os.cpu_count() or 1
+    if workers > 1 and config.serving_config.task_store_backend == "memory":
+        # Status and result requests can end up at any worker, so the workers need to share their tasks.
+        logging.warning("The in-memory task store can not be shared between workers. Using the sqlite task store.")
+        config.serving_config.task_store_backend = "sqlite"
+
+    # The parallelism budget of every worker is sized by the number of workers, so together they use each core once
+    config.serving_config.serving_workers = workers
+    cores = os.cpu_count() or 1
+    if config.serving_config.prediction_threads * workers > cores:
+        logging.warning(
+            f"{workers} workers with {config.serving_config.prediction_threads} prediction threads each oversubscribe "
+            f"the {cores} CPU cores. Set prediction_threads to 0 to divide the cores over the workers."
+        )
+
+    # Import the app and load the model before forking, so the workers inherit both. The model is loaded right here,
+    # so no background thread is left running in the master process when it forks.
+    config.serving_config.prewarm_model = False
+    if args.asgi:
+        from api.asgi import application as app
+    else:
+        from api.main import app
+    from ml_model.model.model_utils import model_registry
+    model_registry.get()
+    gc.collect()
+
+    options = {
+        "bind": args.bind,
+        "workers": workers,
+        "preload_app": True,
+        "pre_fork": freeze_shared_objects,
+    }
+    if args.asgi:
+        options.update({"worker_class": "asgi", "worker_connections": args.connections})
+    else:
+        options.update({"worker_class": "gthread", "threads": args.threads})
+    PreforkApplication(app, options).run()
+
+
+if __name__ == "__main__":
+    main()
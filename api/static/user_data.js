@@ -9,8 +9,18 @@ document.getElementById('upload-form').onsubmit = function (event) {
         method: 'POST',
         body: formData,
     })
-    .then(response => response.json())
-    .then(data => {
+    .then(response => response.json().then(data => ({ response, data })))
+    .then(({ response, data }) => {
+        if (!response.ok) {
+            // The service is busy (429) or the upload was rejected.
+            const retryAfter = response.headers.get('Retry-After');
+            const message = retryAfter ? `${data.msg} Please try again in ${retryAfter} seconds.` : data.msg;
+            const errorContainer = document.createElement('div');
+            errorContainer.innerText = `Error: ${message}`;
+            document.getElementById('task-result').appendChild(errorContainer);
+            return;
+        }
+
         // Dynamically create new element for task.
         const taskId = data.task_id;
         const taskContainer = document.createElement('div');
@@ -27,21 +37,99 @@ document.getElementById('upload-form').onsubmit = function (event) {
 };
 
 /*
-This function continuously checks the status of the task.
+This function follows the task until it is finished. The server pushes every update as a Server-Sent Event, so no
+requests are made while nothing happens. Browsers without EventSource wait for updates with long polls instead. When
+too many clients are waiting already, the server refuses the stream or long poll and the task is polled instead.
 */
 function checkStatus(taskId) {
-    fetch(`/status/${taskId}`)
+    if (!window.EventSource) {
+        waitForStatus(taskId);
+        return;
+    }
+
+    const events = new EventSource(`/events/${taskId}`);
+    events.addEventListener('status', event => showStatus(taskId, JSON.parse(event.data)));
+    ['completed', 'failed', 'unknown'].forEach(name => events.addEventListener(name, event => {
+        // Close the stream, otherwise the browser reconnects when the server ends it
+        events.close();
+        handleFinishedTask(taskId, JSON.parse(event.data));
+    }));
+    // The browser reconnects to a stream that ended, but gives up on a refused one
+    events.onerror = () => {
+        if (events.readyState === EventSource.CLOSED) {
+            pollStatus(taskId);
+        }
+    };
+}
+
+/*
+This function waits for the next update of the task with a long poll on /status, until the task is finished.
+*/
+function waitForStatus(taskId, since) {
+    const sinceParam = since === undefined ? '' : `&since=${since}`;
+    fetch(`/status/${taskId}?wait=25&include_result=true${sinceParam}`)
+        .then(response => {
+            if (response.status === 503) {
+                pollStatus(taskId);
+                return;
+            }
+            return response.json().then(statusData => {
+                if (isRunning(statusData)) {
+                    showStatus(taskId, statusData);
+                    waitForStatus(taskId, statusData.updated_at);
+                } else {
+                    handleFinishedTask(taskId, statusData);
+                }
+            });
+        })
+        .catch(() => setTimeout(() => waitForStatus(taskId, since), 1000));
+}
+
+/*
+This function checks the status of the task every second, until it is finished.
+*/
+function pollStatus(taskId) {
+    fetch(`/status/${taskId}?include_result=true`)
         .then(response => response.json())
         .then(statusData => {
-            document.getElementById(`status-${taskId}`).innerText = statusData.status;
-            if (statusData.status === 'completed') {
-                fetchResults(taskId);
-            } else if (statusData.status.startsWith('failed')) {
-                document.getElementById(`result-${taskId}`).innerText = `Error: ${statusData.status}`;
+            if (isRunning(statusData)) {
+                showStatus(taskId, statusData);
+                setTimeout(() => pollStatus(taskId), 1000);
             } else {
-                setTimeout(() => checkStatus(taskId), 1000);
+                handleFinishedTask(taskId, statusData);
             }
-        });
+        })
+        .catch(() => setTimeout(() => pollStatus(taskId), 1000));
+}
+
+function isRunning(statusData) {
+    return statusData.status === 'queued' || statusData.status === 'processing';
+}
+
+function showStatus(taskId, statusData) {
+    const position = statusData.queue_position;
+    const rows = statusData.processed_rows;
+    let text = statusData.status;
+    if (position !== undefined) {
+        text += ` (position ${position + 1} in queue)`;
+    } else if (rows !== undefined) {
+        text += ` (${rows} rows processed)`;
+    }
+    document.getElementById(`status-${taskId}`).innerText = text;
+}
+
+function handleFinishedTask(taskId, statusData) {
+    showStatus(taskId, statusData);
+    if (statusData.status === 'completed') {
+        // Results that are kept in files are not part of the update
+        if (statusData.result) {
+            document.getElementById(`result-${taskId}`).innerText = JSON.stringify(statusData.result, null, 2);
+        } else {
+            fetchResults(taskId);
+        }
+    } else {
+        document.getElementById(`result-${taskId}`).innerText = `Error: ${statusData.status}`;
+    }
 }
 
 /*
@@ -0,0 +1,60 @@
+"""
+Benchmark of the model artifact formats. Saves the fitted pipeline as a pickle and as a compact artifact at several
+compression levels, and reports the size of every file, the median time to load it and whether the loaded model gives
+the same probabilities as the fitted pipeline on the wine datasets.
+
+Run with: python -m ml_model.benchmarks.bench_artifacts
+"""
+import argparse
+import tempfile
+import time
+import joblib
+import numpy as np
+from pathlib import Path
+from ml_model.config.dynamic_config import config
+from ml_model.model.data_validation import combine_clean_and_validate_wine_datasets
+from ml_model.model.flat_forest import FlatForestPipeline
+from ml_model.model.model_utils import load_compact_artifact, load_pipeline, save_compact_artifact
+
+
+def median_load(load_fn, repeats: int):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model = load_fn()
+        timings.append(time.perf_counter() - start)
+
+    return model, float(np.median(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the size and load time of the model artifact formats.")
+    parser.add_argument("--compression-levels", type=int, nargs="+", default=[0, 3, 9])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    pipeline = load_pipeline()
+    wine_df, errors = combine_clean_and_validate_wine_datasets(config.app_config.training_data_file_names)
+    if errors:
+        raise ValueError(f"An error occurred during the validation of the wine datasets: {errors}")
+    X = wine_df[config.ml_model_config.features]
+    expected = pipeline.predict_proba(X)
+
+    print(f"{'format':<12} {'compress':>8} {'size (MB)':>10} {'load (s)':>9} {'identical':>9}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for compress in args.compression_levels:
+            file_path = Path(temp_dir) / f"pipeline_{compress}.pkl"
+            joblib.dump(pipeline, file_path, compress=("zlib", compress) if compress else 0)
+            model, seconds = median_load(lambda: joblib.load(file_path), args.repeats)
+            identical = np.array_equal(model.predict_proba(X), expected)
+            print(f"{'pickle':<12} {compress:>8} {file_path.stat().st_size / 1e6:>10.1f} {seconds:>9.3f} {identical!s:>9}")
+
+            file_path = Path(temp_dir) / f"pipeline_{compress}.compact.joblib"
+            save_compact_artifact(pipeline, file_path, compress)
+            (preprocessing, flat_forest), seconds = median_load(lambda: load_compact_artifact(file_path), args.repeats)
+            identical = np.array_equal(FlatForestPipeline(preprocessing, flat_forest).predict_proba(X), expected)
+            print(f"{'compact':<12} {compress:>8} {file_path.stat().st_size / 1e6:>10.1f} {seconds:>9.3f} {identical!s:>9}")
+
+
+if __name__ == "__main__":
+    main()
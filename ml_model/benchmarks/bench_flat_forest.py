@@ -0,0 +1,55 @@
+"""
+Benchmark of the compiled FlatForest evaluator against the scikit-learn predict path, on the wine datasets. Checks that
+both give identical probabilities and reports the median latency per batch size.
+
+Run with: python -m ml_model.benchmarks.bench_flat_forest
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from ml_model.config.dynamic_config import config
+from ml_model.model.data_validation import combine_clean_and_validate_wine_datasets
+from ml_model.model.flat_forest import FlatForestPipeline, flatten_forest
+from ml_model.model.model_utils import load_pipeline
+
+
+def median_latency(predict_fn, X: pd.DataFrame, repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predict_fn(X)
+        timings.append(time.perf_counter() - start)
+
+    return float(np.median(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the flat forest evaluator against scikit-learn.")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 100, 6497, 100_000])
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    pipeline = load_pipeline()
+    flat_pipeline = FlatForestPipeline(pipeline[:-1], flatten_forest(pipeline[-1]))
+    flat_pipeline.flat_forest.warm_up()
+
+    wine_df, errors = combine_clean_and_validate_wine_datasets(config.app_config.training_data_file_names)
+    if errors:
+        raise ValueError(f"An error occurred during the validation of the wine datasets: {errors}")
+    X = wine_df[config.ml_model_config.features]
+
+    identical = np.array_equal(pipeline.predict_proba(X), flat_pipeline.predict_proba(X))
+    print(f"Identical probabilities on {len(X)} rows: {identical}")
+
+    print(f"{'rows':>8} {'sklearn (s)':>12} {'flat (s)':>12} {'speedup':>8}")
+    for batch_size in args.batch_sizes:
+        # Repeat the wine datasets for batches larger than the datasets
+        batch = pd.concat([X] * (batch_size // len(X) + 1), ignore_index=True).head(batch_size)
+        sklearn_latency = median_latency(pipeline.predict, batch, args.repeats)
+        flat_latency = median_latency(flat_pipeline.predict, batch, args.repeats)
+        print(f"{batch_size:>8} {sklearn_latency:>12.4f} {flat_latency:>12.4f} {sklearn_latency / flat_latency:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
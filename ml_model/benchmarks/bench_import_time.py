@@ -0,0 +1,71 @@
+"""
+Benchmark of the import time of the modules that are imported when the API or a CLI tool starts. Every module is
+imported in a fresh interpreter, without the storage connection string in the environment. Fails when a module takes
+longer than `--max-seconds` to import or pulls in one of the `--forbidden` packages, so regressions of the lazy
+imports are caught.
+
+Run with: python -m ml_model.benchmarks.bench_import_time
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+from typing import List, Tuple
+
+
+# Packages that should only be imported when they are needed, e.g. when a model is downloaded or loaded
+FORBIDDEN_PACKAGES = ["azure", "sklearn", "feature_engine", "numba"]
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "modules": sorted({{name.split(".")[0] for name in sys.modules}})}}))
+"""
+
+
+def measure_import(module: str) -> Tuple[float, List[str]]:
+    """Imports the module in a fresh interpreter and returns the import time and the imported top level packages."""
+    env = {key: value for key, value in os.environ.items() if key != "ML_MODELS_STORAGE_CONNECTION_STRING"}
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT.format(module=module)],
+        capture_output=True, text=True, check=True, env=env
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+
+    return result["seconds"], result["modules"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the import time of the API and prediction modules.")
+    parser.add_argument("--modules", nargs="+", default=["ml_model.model.predict", "api.main"])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=None, help="Fail when an import takes longer.")
+    parser.add_argument("--forbidden", nargs="*", default=FORBIDDEN_PACKAGES)
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'module':<28} {'median (s)':>10} {'max (s)':>8}")
+    for module in args.modules:
+        timings = []
+        for _ in range(args.repeats):
+            seconds, modules = measure_import(module)
+            timings.append(seconds)
+        print(f"{module:<28} {np.median(timings):>10.3f} {max(timings):>8.3f}")
+
+        if args.max_seconds is not None and np.median(timings) > args.max_seconds:
+            failures.append(f"{module} takes {np.median(timings):.3f}s to import")
+        imported = sorted(set(args.forbidden) & set(modules))
+        if imported:
+            failures.append(f"{module} imports {', '.join(imported)}")
+
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
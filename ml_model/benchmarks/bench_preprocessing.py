@@ -0,0 +1,43 @@
+"""
+Benchmark of the fused preprocessing transform against the preprocessing steps of the pipeline, on the wine datasets.
+Checks that both give identical feature matrices and reports the median latency per batch size.
+
+Run with: python -m ml_model.benchmarks.bench_preprocessing
+"""
+import argparse
+import numpy as np
+import pandas as pd
+from ml_model.benchmarks.bench_flat_forest import median_latency
+from ml_model.config.dynamic_config import config
+from ml_model.model.data_validation import combine_clean_and_validate_wine_datasets
+from ml_model.model.fused_preprocessing import compile_preprocessing, is_equivalent
+from ml_model.model.model_utils import load_pipeline
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fused preprocessing against the pipeline steps.")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 100, 6497, 100_000])
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    pipeline = load_pipeline()
+    fused = compile_preprocessing(pipeline[:-1])
+    if fused is None:
+        raise ValueError("The preprocessing steps of the pipeline can not be fused.")
+
+    wine_df, errors = combine_clean_and_validate_wine_datasets(config.app_config.training_data_file_names)
+    if errors:
+        raise ValueError(f"An error occurred during the validation of the wine datasets: {errors}")
+    X = wine_df[config.ml_model_config.features]
+    print(f"Identical feature matrices on {len(X)} rows: {is_equivalent(pipeline[:-1], fused, X)}")
+
+    print(f"{'rows':>8} {'pipeline (s)':>13} {'fused (s)':>12} {'speedup':>8}")
+    for batch_size in args.batch_sizes:
+        batch = pd.concat([X] * (batch_size // len(X) + 1), ignore_index=True).head(batch_size)
+        pipeline_latency = median_latency(pipeline[:-1].transform, batch, args.repeats)
+        fused_latency = median_latency(fused.transform, batch, args.repeats)
+        print(f"{batch_size:>8} {pipeline_latency:>13.5f} {fused_latency:>12.5f} {pipeline_latency / fused_latency:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
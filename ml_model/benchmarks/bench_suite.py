@@ -0,0 +1,265 @@
+"""
+Benchmark and load-test suite of the training and inference paths, on synthetic wine datasets (see synthetic_data.py).
+
+- Stages: the median time and the peak memory (measured with tracemalloc) of loading, cleaning, validating and
+  predicting an upload, for every dataset size, and of fitting the pipeline. Loading is measured both in the regular
+  and in the fast ingestion mode (load_fast).
+- API: uploads to /predict followed by polling /status and fetching /results, and requests to /predict/json, by
+  several concurrent clients through the Flask test client. Reports the throughput and the latency percentiles.
+
+The results are written to a JSON file. When a baseline, saved with --save-baseline on an earlier run on the same
+machine, is given, the suite fails if any measurement regressed by more than the threshold. Timings are lower-is-better,
+measurements ending in "_per_second" are higher-is-better.
+
+Run with: python -m ml_model.benchmarks.bench_suite --baseline tmp/benchmark_baseline.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+from ml_model.benchmarks.synthetic_data import fit_wine_distributions, generate_wine_dataset, write_upload
+from ml_model.config.dynamic_config import config
+from ml_model.model.data_utils import clean_raw_data, load_dataset
+from ml_model.model.data_validation import validate_data
+
+
+def measure(fn: Callable[[], object], repeats: int) -> Tuple[float, int]:
+    """Returns the median time of `repeats` calls and the peak memory allocated by a separate, traced call."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return float(np.median(timings)), peak_bytes
+
+
+def benchmark_stages(row_counts: List[int], repeats: int, distributions, temp_dir: Path) -> Dict[str, float]:
+    from ml_model.model.model_utils import model_registry
+
+    predictor = model_registry.get_predictor()
+    results = {}
+    for n_rows in row_counts:
+        file_path = write_upload(generate_wine_dataset(n_rows, seed=n_rows, distributions=distributions),
+                                 temp_dir / f"wines_{n_rows}.csv")
+        raw_data = load_dataset(full_path=str(file_path))
+        cleaned_data = clean_raw_data(raw_data)
+        valid_data, errors = validate_data(cleaned_data)
+        if errors:
+            raise ValueError(f"The synthetic dataset of {n_rows} rows is invalid: {errors}")
+        features = valid_data[config.ml_model_config.features]
+
+        stages = {
+            "load": lambda: load_dataset(full_path=str(file_path)),
+            "load_fast": lambda: load_dataset(full_path=str(file_path), fast=True),
+            "clean": lambda: clean_raw_data(raw_data),
+            "validate": lambda: validate_data(cleaned_data),
+            "predict": lambda: predictor.predict(features),
+        }
+        for stage, fn in stages.items():
+            seconds, peak_bytes = measure(fn, repeats)
+            results[f"stage.{stage}.{n_rows}.seconds"] = seconds
+            results[f"stage.{stage}.{n_rows}.peak_bytes"] = peak_bytes
+            print(f"{stage:<10} {n_rows:>9} rows {seconds:>9.4f} s {peak_bytes / 1e6:>9.1f} MB peak")
+
+    return results
+
+
+def benchmark_training(n_rows: int, n_trees: int, distributions) -> Dict[str, float]:
+    from sklearn.base import clone
+    from ml_model.model.pipeline import wine_pipeline
+
+    train_data, _ = validate_data(clean_raw_data(generate_wine_dataset(n_rows, distributions=distributions)))
+    pipeline = clone(wine_pipeline).set_params(classifier__n_estimators=n_trees)
+    seconds, peak_bytes = measure(
+        lambda: pipeline.fit(train_data[config.ml_model_config.features], train_data[config.ml_model_config.target]),
+        repeats=1
+    )
+    print(f"{'train':<10} {n_rows:>9} rows {seconds:>9.4f} s {peak_bytes / 1e6:>9.1f} MB peak ({n_trees} trees)")
+
+    return {f"stage.train.{n_rows}.seconds": seconds, f"stage.train.{n_rows}.peak_bytes": peak_bytes}
+
+
+def latency_summary(name: str, latencies: List[float], wall_seconds: float) -> Dict[str, float]:
+    results = {
+        f"{name}.requests_per_second": len(latencies) / wall_seconds,
+        f"{name}.p50_seconds": float(np.percentile(latencies, 50)),
+        f"{name}.p95_seconds": float(np.percentile(latencies, 95)),
+    }
+    print(f"{name:<18} {results[f'{name}.requests_per_second']:>9.1f} req/s "
+          f"p50 {results[f'{name}.p50_seconds']:.4f} s p95 {results[f'{name}.p95_seconds']:.4f} s")
+
+    return results
+
+
+def run_concurrently(request_fn: Callable[[object, int], None], n_clients: int, requests_per_client: int):
+    """Runs `requests_per_client` requests on each of `n_clients` threads, each with its own test client."""
+    from api.main import app
+
+    latencies = []
+    lock = threading.Lock()
+
+    def client_loop(client_index: int) -> None:
+        client = app.test_client()
+        for request_index in range(requests_per_client):
+            start = time.perf_counter()
+            request_fn(client, client_index * requests_per_client + request_index)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_clients) as executor:
+        # list() re-raises the first error of any client
+        list(executor.map(client_loop, range(n_clients)))
+
+    return latencies, time.perf_counter() - start
+
+
+def benchmark_api(
+        upload_rows: int,
+        n_clients: int,
+        requests_per_client: int,
+        poll_interval: float,
+        distributions
+) -> Dict[str, float]:
+    # Every request sends different wines, so repeated requests are not answered from the prediction cache
+    n_requests = n_clients * requests_per_client
+    uploads = [
+        generate_wine_dataset(upload_rows, seed=seed, distributions=distributions).to_csv(sep=";", index=False).encode()
+        for seed in range(n_requests)
+    ]
+    records = [
+        generate_wine_dataset(10, seed=n_requests + seed, distributions=distributions)
+        .drop(columns="quality").to_dict(orient="records")
+        for seed in range(n_requests)
+    ]
+    polls = []
+
+    def upload_and_poll(client, index: int) -> None:
+        response = client.post("/predict", data={"file": (io.BytesIO(uploads[index]), "wines.csv")})
+        task_id = response.get_json()["task_id"]
+        n_polls = 0
+        while True:
+            n_polls += 1
+            status = client.get(f"/status/{task_id}").get_json()["status"]
+            if status == "completed":
+                break
+            if status.startswith("failed"):
+                raise RuntimeError(f"Task {task_id} failed: {status}")
+            time.sleep(poll_interval)
+        client.get(f"/results/{task_id}").get_data()
+        polls.append(n_polls)
+
+    def predict_json(client, index: int) -> None:
+        response = client.post("/predict/json", json=records[index])
+        if response.status_code != 200:
+            raise RuntimeError(f"/predict/json returned {response.status_code}: {response.get_data(as_text=True)}")
+
+    latencies, wall_seconds = run_concurrently(upload_and_poll, n_clients, requests_per_client)
+    results = latency_summary("api.predict", latencies, wall_seconds)
+    # Every task takes an upload, the polls and a request for the results
+    results["api.predict.http_requests_per_second"] = (sum(polls) + 2 * len(polls)) / wall_seconds
+    latencies, wall_seconds = run_concurrently(predict_json, n_clients, requests_per_client)
+    results.update(latency_summary("api.predict_json", latencies, wall_seconds))
+
+    return results
+
+
+def compare_to_baseline(
+        results: Dict[str, float],
+        baseline: Dict[str, float],
+        threshold: float
+) -> List[Tuple[str, float, float, float]]:
+    """
+    Returns the measurements that regressed by more than `threshold` (0.2 means 20%) as (name, baseline, result,
+    relative change). Measurements that are missing from either side are skipped.
+    """
+    regressions = []
+    for name, value in results.items():
+        baseline_value = baseline.get(name)
+        if not baseline_value:
+            continue
+        change = (value - baseline_value) / baseline_value
+        if name.endswith("_per_second"):
+            change = -change
+        if change > threshold:
+            regressions.append((name, baseline_value, value, change))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the training and inference paths on synthetic data.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000, 100_000],
+                        help="Sizes of the datasets of the stage benchmarks.")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--train-rows", type=int, default=6_497, help="Rows to fit the pipeline on (0 skips it).")
+    parser.add_argument("--train-trees", type=int, default=50)
+    parser.add_argument("--upload-rows", type=int, default=1_000, help="Rows per upload of the API benchmark.")
+    parser.add_argument("--clients", type=int, default=4, help="Concurrent clients of the API benchmark.")
+    parser.add_argument("--requests-per-client", type=int, default=10, help="Requests per client (0 skips it).")
+    parser.add_argument("--poll-interval", type=float, default=0.01)
+    parser.add_argument("--output", type=Path, default=Path("tmp/benchmark_results.json"))
+    parser.add_argument("--baseline", type=Path, help="Results of an earlier run to compare against.")
+    parser.add_argument("--save-baseline", type=Path, help="Also save the results as the baseline at this path.")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Relative regression that fails the benchmark, 0.2 means 20%% slower.")
+    args = parser.parse_args()
+
+    # The API is benchmarked without the prediction cache and without loading the model in the background. This
+    # has to be configured before the API and the prediction module are imported.
+    config.serving_config.prediction_cache_max_entries = 0
+    config.serving_config.prewarm_model = False
+
+    distributions = fit_wine_distributions()
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        results.update(benchmark_stages(args.rows, args.repeats, distributions, Path(temp_dir)))
+    if args.train_rows:
+        results.update(benchmark_training(args.train_rows, args.train_trees, distributions))
+    if args.requests_per_client:
+        results.update(benchmark_api(
+            args.upload_rows, args.clients, args.requests_per_client, args.poll_interval, distributions
+        ))
+    # ru_maxrss is in kilobytes on Linux
+    results["process.max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    report = {
+        "environment": {"python": sys.version.split()[0], "platform": platform.platform(), "cpus": os.cpu_count()},
+        "results": results,
+    }
+    for path in filter(None, [args.output, args.save_baseline]):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(report, indent=2))
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())["results"]
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        for name, baseline_value, value, change in regressions:
+            print(f"REGRESSION {name}: {baseline_value:.4g} -> {value:.4g} ({change:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions of more than {args.threshold:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
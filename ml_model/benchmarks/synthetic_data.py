@@ -0,0 +1,98 @@
+"""
+Synthetic wine datasets for the benchmarks. The rows are drawn per color and quality from a multivariate normal
+distribution with the means and covariances of the measurements in winequality-red.csv and winequality-white.csv, so
+the features keep their correlations with each other and with the quality. Values are clipped to the range seen in the
+original datasets.
+
+The datasets have the layout of an upload: the original column names, separated by semicolons, with a quality and a
+color column.
+"""
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+from ml_model.config.dynamic_config import config
+from ml_model.model.data_utils import load_wine_datasets_and_add_color_col
+
+
+QUALITY_COLUMN = "quality"
+COLOR_COLUMN = "color"
+
+
+@dataclass
+class WineDistribution:
+    """Distribution of the measurements of the wines of one color and quality."""
+
+    color: str
+    quality: int
+    weight: float
+    mean: np.ndarray
+    cov: np.ndarray
+
+
+@dataclass
+class WineDistributions:
+    measurement_columns: List[str]
+    groups: List[WineDistribution]
+    minimum: pd.DataFrame
+    maximum: pd.DataFrame
+
+
+def fit_wine_distributions(file_names: Optional[List[str]] = None) -> WineDistributions:
+    """Estimates the distribution of every color and quality from the wine datasets."""
+    wine_df = pd.concat(
+        load_wine_datasets_and_add_color_col(file_names or config.app_config.training_data_file_names),
+        ignore_index=True
+    )
+    measurement_columns = [col for col in wine_df.columns if col not in (QUALITY_COLUMN, COLOR_COLUMN)]
+
+    groups = []
+    for (color, quality), group in wine_df.groupby([COLOR_COLUMN, QUALITY_COLUMN]):
+        values = group[measurement_columns].to_numpy(dtype=np.float64)
+        # Groups of a single wine have no covariance. Their wines are repeated as they are.
+        cov = np.cov(values, rowvar=False) if len(values) > 1 else np.zeros((len(measurement_columns),) * 2)
+        groups.append(WineDistribution(color, int(quality), len(group) / len(wine_df), values.mean(axis=0), cov))
+
+    by_color = wine_df.groupby(COLOR_COLUMN)[measurement_columns]
+
+    return WineDistributions(measurement_columns, groups, by_color.min(), by_color.max())
+
+
+def generate_wine_dataset(
+        n_rows: int,
+        seed: int = 0,
+        distributions: Optional[WineDistributions] = None
+) -> pd.DataFrame:
+    """Draws `n_rows` synthetic wines, in the layout of an upload."""
+    distributions = distributions or fit_wine_distributions()
+    rng = np.random.default_rng(seed)
+    weights = np.array([group.weight for group in distributions.groups])
+    counts = rng.multinomial(n_rows, weights / weights.sum())
+
+    frames = []
+    for group, count in zip(distributions.groups, counts):
+        if count == 0:
+            continue
+        values = rng.multivariate_normal(group.mean, group.cov, size=count, check_valid="ignore", method="eigh")
+        values = np.clip(
+            values,
+            distributions.minimum.loc[group.color].to_numpy(),
+            distributions.maximum.loc[group.color].to_numpy()
+        )
+        frame = pd.DataFrame(values.round(5), columns=distributions.measurement_columns)
+        frame[QUALITY_COLUMN] = group.quality
+        frame[COLOR_COLUMN] = group.color
+        frames.append(frame)
+
+    # Shuffle, so the wines of a group are not next to each other
+    dataset = pd.concat(frames, ignore_index=True)
+
+    return dataset.iloc[rng.permutation(len(dataset))].reset_index(drop=True)
+
+
+def write_upload(dataset: pd.DataFrame, file_path: Path) -> Path:
+    """Writes the dataset as a CSV file that can be uploaded to the API."""
+    dataset.to_csv(file_path, sep=";", index=False)
+
+    return file_path
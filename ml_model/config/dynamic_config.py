@@ -3,8 +3,9 @@ This file contains the logic for loading, parsing, and validating the configurat
 BaseModel is used to define the structure and validate the structure of the configuration data.
 """
 
+from functools import cached_property
 from pathlib import Path
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from pydantic_settings import BaseSettings
 from strictyaml import YAML, load
 from typing import List, Optional, Sequence
@@ -16,6 +17,7 @@ PACKAGE_ROOT = Path(ml_model.__file__).resolve().parent
 ROOT = PACKAGE_ROOT.parent
 STATIC_CONFIG_FILE_PATH = PACKAGE_ROOT / "config" / "static_config.yml"
 DATASET_DIR = ROOT / "ml_model" / "datasets"
+DATASET_CACHE_DIR = DATASET_DIR / "cache"
 TRAINED_MODEL_DIR = PACKAGE_ROOT / "trained_models"
 
 
@@ -41,6 +43,61 @@ class MLModelConfig(BaseModel):
     test_size: float
     random_state: int
     n_estimators: int
+    n_jobs: Optional[int] = -1
+
+
+class ServingConfig(BaseModel):
+    """
+    Configuration of the prediction service.
+    """
+
+    # pydantic reserves field names that start with "model_" unless told otherwise
+    model_config = ConfigDict(protected_namespaces=())
+
+    micro_batch_max_size: int = 256
+    micro_batch_max_wait_ms: float = 5.0
+    streaming_threshold_bytes: int = 50_000_000
+    streaming_chunk_size: int = 100_000
+    in_memory_upload_max_bytes: int = 10_000_000
+    fast_csv_ingestion: bool = True
+    csv_engine: str = "auto"
+    results_dir: str = "tmp"
+    task_store_backend: str = "memory"
+    task_store_path: str = "tmp/tasks.sqlite3"
+    task_store_max_tasks: int = 10_000
+    task_store_ttl_seconds: float = 3600.0
+    status_max_wait_seconds: float = 30.0
+    events_max_seconds: float = 600.0
+    events_keep_alive_seconds: float = 15.0
+    max_waiting_requests: int = 2
+    serving_workers: int = 0
+    serving_threads: int = 4
+    executor_workers: int = 5
+    asgi_connections: int = 1000
+    asgi_task_pool: str = "thread"
+    prediction_threads: int = 0
+    prediction_min_rows_per_shard: int = 20_000
+    native_threads: int = 1
+    admission_max_rows: int = 5_000_000
+    admission_max_queued_tasks: int = 100
+    admission_bytes_per_row: int = 64
+    admission_retry_after_seconds: float = 5.0
+    use_flat_forest: bool = True
+    use_fused_preprocessing: bool = True
+    prewarm_model: bool = True
+    model_artifact_format: str = "pickle"
+    model_artifact_compression: int = 0
+    model_download_chunk_bytes: int = 8_388_608
+    model_download_workers: int = 4
+    model_cache_max_bytes: int = 2_000_000_000
+    default_model_version: str = ""
+    model_pool_max_bytes: int = 1_000_000_000
+    prediction_cache_max_entries: int = 200_000
+    prediction_cache_path: str = ""
+    profile_sample_rate: float = 0.0
+    profile_slow_request_seconds: float = 5.0
+    profile_interval_ms: float = 5.0
+    profile_dir: str = "tmp/profiles"
 
 
 class SecretsConfig(BaseSettings):
@@ -56,7 +113,15 @@ class Config(BaseModel):
 
     app_config: AppConfig
     ml_model_config: MLModelConfig
-    secrets: SecretsConfig
+    serving_config: ServingConfig
+
+    @cached_property
+    def secrets(self) -> SecretsConfig:
+        """
+        The secrets are read from the environment on first use instead of when the configuration is created, so they
+        are only required by code that actually talks to the blob storage.
+        """
+        return SecretsConfig()
 
 
 def validate_static_config_file_path() -> Path:
@@ -84,13 +149,11 @@ def create_and_validate_config(parsed_config: YAML = None) -> Config:
     if parsed_config is None:
         parsed_config = get_config_from_yaml()
 
-    secrets = SecretsConfig()  # reads env vars at initialization
-
     # specify the data attribute from the strictyaml YAML type.
     cfg = Config(
         app_config=AppConfig(**parsed_config.data),
         ml_model_config=MLModelConfig(**parsed_config.data),
-        secrets=secrets
+        serving_config=ServingConfig(**parsed_config.data),
     )
 
     return cfg
@@ -0,0 +1,238 @@
+"""
+Offline batch scoring of many CSV files. The files are spread over a pool of worker processes, one per CPU core by
+default, that each load the model once. Every file is read, cleaned, validated and predicted in chunks, like large
+uploads to the API, so the memory of a worker stays bounded whatever the size of its files. The target column is not
+required.
+
+The predictions of a file are written next to it as `<name>.predictions.csv`, or into `--output-dir`, together with the
+number of the input row they belong to (0 is the first row after the header). Rows with missing values are not
+predicted, so these row numbers are what joins the predictions back to the input. With `--combined`, they are
+collected into a single CSV file with the file name, the row number and the prediction. A file that does not pass
+validation gets a `<name>.errors.json` instead, and the failures of all files are listed in a summary.
+
+Outputs are written to a temporary file and renamed into place when complete. An interrupted run can therefore be
+resumed by running it again: files whose output is newer than the file itself are not scored again.
+
+Run with: python -m ml_model.model.batch_score <directory, glob or file> ... [--output-dir DIR] [--combined FILE]
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import List, Optional
+from ml_model.config.dynamic_config import config
+from ml_model.model.data_utils import clean_raw_data, load_dataset_in_chunks
+from ml_model.model.data_validation import count_errors, validate_data
+
+
+PREDICTIONS_SUFFIX = ".predictions.csv"
+ERRORS_SUFFIX = ".errors.json"
+
+# Number of validation errors per file that are kept in the summary
+MAX_ERRORS_PER_FILE = 20
+
+
+def find_input_files(patterns: List[str]) -> List[Path]:
+    """Returns the CSV files in the given directories, matching the given globs or given directly, without outputs."""
+    files = set()
+    for pattern in patterns:
+        path = Path(pattern)
+        if path.is_dir():
+            files.update(path.glob("*.csv"))
+        else:
+            files.update(Path(match) for match in glob.glob(pattern, recursive=True))
+
+    return sorted(file for file in files if file.is_file() and not file.name.endswith(PREDICTIONS_SUFFIX))
+
+
+def output_paths(input_file: Path, output_dir: Optional[Path]) -> tuple:
+    """Returns the paths of the predictions and the errors of the file."""
+    directory = output_dir or input_file.parent
+    stem = input_file.name[:-len(".csv")] if input_file.name.endswith(".csv") else input_file.name
+
+    return directory / f"{stem}{PREDICTIONS_SUFFIX}", directory / f"{stem}{ERRORS_SUFFIX}"
+
+
+def is_done(input_file: Path, output_file: Path) -> bool:
+    return output_file.exists() and output_file.stat().st_mtime_ns >= input_file.stat().st_mtime_ns
+
+
+def _init_worker() -> None:
+    # Every worker evaluates one file at a time on a single core, so libraries should not start threads of their own
+    from threadpoolctl import threadpool_limits
+    from ml_model.model.model_utils import model_registry
+
+    threadpool_limits(1)
+    model_registry.get()
+
+
+def score_file(input_file: Path, predictions_file: Path, errors_file: Path, chunk_size: int) -> dict:
+    """
+    Scores one file in chunks of `chunk_size` rows and writes its predictions, or its validation errors. Returns a
+    summary of the file.
+    """
+    from ml_model.model.model_utils import model_registry
+
+    start = time.perf_counter()
+    predictor = model_registry.get_predictor()
+    features = config.ml_model_config.features
+    temp_file = predictions_file.with_name(predictions_file.name + f".{os.getpid()}.tmp")
+    n_rows = 0
+    n_predictions = 0
+    errors = None
+
+    try:
+        with open(temp_file, "w") as output:
+            output.write("row;prediction\n")
+            chunks = load_dataset_in_chunks(
+                chunk_size, full_path=str(input_file), fast=config.serving_config.fast_csv_ingestion
+            )
+            for chunk in chunks:
+                # The index of the chunks counts the rows of the whole file. Validation renumbers the rows, so the
+                # row numbers are taken after cleaning, which drops the rows with missing values.
+                clean_chunk = clean_raw_data(chunk)
+                valid_chunk, errors = validate_data(clean_chunk, require_target=False, row_offset=n_rows)
+                if errors:
+                    errors = json.loads(errors)
+                    break
+                predictions = predictor.predict(valid_chunk[features])
+                output.write("".join(
+                    f"{row};{prediction}\n" for row, prediction in zip(clean_chunk.index.tolist(), predictions.tolist())
+                ))
+                n_rows += len(chunk)
+                n_predictions += len(predictions)
+    except Exception as e:
+        errors = [{"type": "read_error", "msg": str(e)}]
+
+    summary = {
+        "file": str(input_file),
+        "status": "failed" if errors else "scored",
+        "rows": n_rows,
+        "predictions": n_predictions,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+    if errors:
+        # The temporary file does not exist when it could not be created
+        temp_file.unlink(missing_ok=True)
+        summary["n_errors"] = count_errors(errors)
+        summary["errors"] = errors[:MAX_ERRORS_PER_FILE]
+        write_atomically(errors_file, json.dumps(summary, indent=2))
+    else:
+        os.replace(temp_file, predictions_file)
+        if errors_file.exists():
+            errors_file.unlink()
+
+    return summary
+
+
+def write_atomically(file_path: Path, text: str) -> None:
+    temp_file = file_path.with_name(file_path.name + f".{os.getpid()}.tmp")
+    temp_file.write_text(text)
+    os.replace(temp_file, file_path)
+
+
+def combine_predictions(input_files: List[Path], parts_dir: Path, combined_file: Path) -> int:
+    """Writes the predictions of all scored files into one CSV file, in the order of the files. Returns the rows."""
+    n_rows = 0
+    temp_file = combined_file.with_name(combined_file.name + ".tmp")
+    with open(temp_file, "w") as combined:
+        combined.write("file;row;prediction\n")
+        for input_file in input_files:
+            predictions_file, _ = output_paths(input_file, parts_dir)
+            if not is_done(input_file, predictions_file):
+                continue
+            with open(predictions_file) as predictions:
+                next(predictions)
+                for line in predictions:
+                    combined.write(f"{input_file};{line}")
+                    n_rows += 1
+    os.replace(temp_file, combined_file)
+
+    return n_rows
+
+
+def run_batch_scoring(
+        patterns: List[str],
+        output_dir: Optional[Path] = None,
+        combined_file: Optional[Path] = None,
+        workers: Optional[int] = None,
+        chunk_size: int = 100_000,
+        retry_failed: bool = False
+) -> dict:
+    """Scores all files and returns the summary of the run. See the description of this file."""
+    input_files = find_input_files(patterns)
+    if combined_file is not None:
+        # The predictions of every file are kept as a part, so the combined file can be rebuilt after resuming
+        output_dir = combined_file.with_name(combined_file.name + ".parts")
+    if output_dir is not None:
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+    summaries = []
+    pending = []
+    for input_file in input_files:
+        predictions_file, errors_file = output_paths(input_file, output_dir)
+        if is_done(input_file, predictions_file):
+            summaries.append({"file": str(input_file), "status": "skipped"})
+        elif is_done(input_file, errors_file) and not retry_failed:
+            summaries.append({**json.loads(errors_file.read_text()), "status": "skipped_failed"})
+        else:
+            pending.append((input_file, predictions_file, errors_file))
+
+    workers = min(workers or os.cpu_count() or 1, max(len(pending), 1))
+    logging.info(f"Scoring {len(pending)} of {len(input_files)} files with {workers} workers")
+    start = time.perf_counter()
+    if pending:
+        with ProcessPoolExecutor(workers, initializer=_init_worker) as executor:
+            futures = [executor.submit(score_file, *paths, chunk_size) for paths in pending]
+            for i, future in enumerate(as_completed(futures), start=1):
+                summary = future.result()
+                summaries.append(summary)
+                logging.info(f"[{i}/{len(pending)}] {summary['status']} {summary['file']} ({summary['rows']} rows)")
+
+    run_summary = {
+        "files": len(input_files),
+        "scored": sum(summary["status"] == "scored" for summary in summaries),
+        "skipped": sum(summary["status"].startswith("skipped") for summary in summaries),
+        "failed": [summary for summary in summaries if summary["status"] in ("failed", "skipped_failed")],
+        "predictions": sum(summary.get("predictions", 0) for summary in summaries),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+    if combined_file is not None:
+        run_summary["combined_rows"] = combine_predictions(input_files, output_dir, combined_file)
+
+    return run_summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score directories of CSV files with the trained model.")
+    parser.add_argument("inputs", nargs="+", help="Directories, globs or CSV files to score.")
+    parser.add_argument("--output-dir", type=Path, help="Write the predictions here instead of next to the inputs.")
+    parser.add_argument("--combined", type=Path, help="Write all predictions into this single CSV file.")
+    parser.add_argument("--workers", type=int, help="Number of worker processes. Defaults to one per CPU core.")
+    parser.add_argument("--chunk-size", type=int, default=config.serving_config.streaming_chunk_size)
+    parser.add_argument("--retry-failed", action="store_true", help="Score files that failed before again.")
+    parser.add_argument("--summary", type=Path, default=Path("tmp/batch_score_summary.json"))
+    args = parser.parse_args()
+
+    run_summary = run_batch_scoring(
+        args.inputs, args.output_dir, args.combined, args.workers, args.chunk_size, args.retry_failed
+    )
+    args.summary.parent.mkdir(parents=True, exist_ok=True)
+    write_atomically(args.summary, json.dumps(run_summary, indent=2))
+
+    print(f"Scored {run_summary['scored']} files, skipped {run_summary['skipped']} finished files, "
+          f"{len(run_summary['failed'])} failed. {run_summary['predictions']} predictions in "
+          f"{run_summary['seconds']} seconds. Summary written to {args.summary}")
+    for failure in run_summary["failed"]:
+        first_error = failure["errors"][0] if failure.get("errors") else {}
+        print(f"  {failure['file']}: {failure.get('n_errors', 0)} errors, first: {first_error.get('msg', '')} "
+              f"at {first_error.get('loc', '')}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -1,10 +1,16 @@
+import csv
+import importlib.util
 from pathlib import Path
-from typing import List
-from ml_model.config.dynamic_config import DATASET_DIR
+from typing import IO, Iterator, List, Union
+from ml_model.config.dynamic_config import DATASET_DIR, config
 import pandas as pd
 
 
-def load_dataset(file_name: str = None, full_path: str = None) -> pd.DataFrame:
+# Delimiters that are recognized in the header of a CSV file. The wine datasets use semicolons.
+CSV_DELIMITERS = (";", ",", "\t", "|")
+
+
+def get_dataset_path(file_name: str = None, full_path: str = None) -> Path:
     if file_name is None and full_path is None:
         raise ValueError("Either 'file_name' or 'full_path' must be provided.")
 
@@ -18,19 +24,156 @@ def load_dataset(file_name: str = None, full_path: str = None) -> pd.DataFrame:
     if not file_path.exists():
         raise FileNotFoundError(f"The file {file_path} does not exist.")
 
+    return file_path
+
+
+def load_dataset(file_name: str = None, full_path: str = None, fast: bool = False) -> pd.DataFrame:
+    """Reads the dataset. With `fast`, only the model inputs are read, see get_fast_read_options."""
+    file_path = get_dataset_path(file_name, full_path)
+
+    return read_dataset(file_path, description=f"the file {file_path}", fast=fast)
+
+
+def load_dataset_from_buffer(buffer: IO, fast: bool = False) -> pd.DataFrame:
+    """Reads the dataset from an in-memory buffer or an open file, e.g. an upload that was never written to disk."""
+    return read_dataset(buffer, description="the uploaded data", fast=fast)
+
+
+def read_header(source: Union[Path, IO]) -> str:
+    """Returns the first line of a CSV file or buffer. A buffer is rewound to where it was."""
+    if isinstance(source, (str, Path)):
+        with open(source, "rb") as file:
+            line = file.readline()
+    else:
+        position = source.tell()
+        line = source.readline()
+        source.seek(position)
+    if isinstance(line, bytes):
+        line = line.decode("utf-8", errors="replace")
+
+    return line.lstrip("\ufeff").rstrip("\r\n")
+
+
+def sniff_delimiter(header: str) -> str:
+    """Returns the delimiter that occurs most often in the header, semicolons if none of them does."""
+    counts = {delimiter: header.count(delimiter) for delimiter in CSV_DELIMITERS}
+    delimiter = max(counts, key=counts.get)
+
+    return delimiter if counts[delimiter] else ";"
+
+
+def get_csv_engine() -> str:
+    """Returns the parser of the fast ingestion mode: the multithreaded pyarrow parser when it is installed."""
+    engine = config.serving_config.csv_engine
+    if engine == "auto":
+        return "pyarrow" if importlib.util.find_spec("pyarrow") is not None else "c"
+
+    return engine
+
+
+def get_fast_read_options(source: Union[Path, IO], engine: str = None) -> dict:
+    """
+    Returns the options of pd.read_csv that read only the model inputs of a CSV file. The delimiter is detected from
+    the header, and the column names are formatted (see format_feature_names) while parsing, so columns the model does
+    not use are skipped without being parsed. The numerical columns are parsed as floats instead of inferring their
+    type. Falls back to the options of the regular mode if formatting makes column names collide.
+    """
+    header = read_header(source)
+    delimiter = sniff_delimiter(header)
+    names = [format_feature_names(name) for name in next(csv.reader([header], delimiter=delimiter), [])]
+    if not names or len(set(names)) < len(names):
+        return {"sep": ";"}
+
+    model_config = config.ml_model_config
+    columns = set(model_config.features) | {model_config.target}
+
+    return {
+        "sep": delimiter,
+        "header": 0,
+        "names": names,
+        "usecols": [name for name in names if name in columns],
+        "dtype": {name: "float64" for name in model_config.numerical_vars if name in names},
+        "engine": engine or get_csv_engine(),
+    }
+
+
+def read_csv_with_fallback(source: Union[Path, IO], options: dict, **kwargs):
+    """
+    Reads a CSV file with pd.read_csv. If a value can not be parsed as the dtype of its column, the file is read
+    again without the dtypes, so the validation reports the invalid values row by row.
+    """
+    position = None if isinstance(source, (str, Path)) else source.tell()
+    try:
+        return pd.read_csv(source, **options, **kwargs)
+    except (ValueError, TypeError):
+        if not options.get("dtype"):
+            raise
+        if position is not None:
+            source.seek(position)
+        return pd.read_csv(source, **{**options, "dtype": None}, **kwargs)
+
+
+def read_dataset(source: Union[Path, IO], description: str, fast: bool = False) -> pd.DataFrame:
     # Read the dataset
     try:
-        df = pd.read_csv(file_path, sep=';')
+        if fast:
+            df = read_csv_with_fallback(source, get_fast_read_options(source))
+        else:
+            df = pd.read_csv(source, sep=';')
     except pd.errors.EmptyDataError:
-        raise ValueError(f"The file {file_path} is empty or cannot be read.")
+        raise ValueError(f"{description.capitalize()} is empty or cannot be read.")
     except pd.errors.ParserError:
-        raise ValueError(f"Error parsing the file {file_path}. Check the file format.")
+        raise ValueError(f"Error parsing {description}. Check the file format.")
     except Exception as e:
-        raise RuntimeError(f"An error occurred while reading the file {file_path}: {e}")
+        raise RuntimeError(f"An error occurred while reading {description}: {e}")
 
     return df
 
 
+def load_dataset_in_chunks(
+        chunk_size: int,
+        file_name: str = None,
+        full_path: str = None,
+        fast: bool = False
+) -> Iterator[pd.DataFrame]:
+    """
+    Reads the dataset in chunks of at most `chunk_size` rows, so only one chunk is held in memory at a time. With
+    `fast`, only the model inputs are read, see get_fast_read_options.
+    """
+    file_path = get_dataset_path(file_name, full_path)
+
+    try:
+        # The pyarrow parser does not read in chunks
+        options = get_fast_read_options(file_path, engine="c") if fast else {"sep": ";"}
+        n_rows = 0
+        try:
+            with pd.read_csv(file_path, **options, chunksize=chunk_size) as reader:
+                for chunk in reader:
+                    n_rows += len(chunk)
+                    yield chunk
+        except (ValueError, TypeError):
+            if not options.get("dtype"):
+                raise
+            # A value did not match the dtype of its column. Read the file again without the dtypes, so the validation
+            # reports the invalid values row by row. The rows that were already read are skipped by counting parsed
+            # rows, because quoted newlines and blank lines make physical lines differ from rows.
+            options = {**options, "dtype": None}
+            n_skipped = 0
+            with pd.read_csv(file_path, **options, chunksize=chunk_size) as reader:
+                for chunk in reader:
+                    if n_skipped < n_rows:
+                        skip = min(n_rows - n_skipped, len(chunk))
+                        n_skipped += skip
+                        chunk = chunk.iloc[skip:]
+                        if chunk.empty:
+                            continue
+                    yield chunk
+    except pd.errors.EmptyDataError:
+        raise ValueError(f"The file {file_path} is empty or cannot be read.")
+    except pd.errors.ParserError:
+        raise ValueError(f"Error parsing the file {file_path}. Check the file format.")
+
+
 def load_wine_datasets_and_add_color_col(file_names: List[str]) -> List[pd.DataFrame]:
     dfs = []
     for name in file_names:
@@ -61,10 +204,8 @@ def format_feature_names(input_string: str) -> str:
 
 def clean_raw_data(df: pd.DataFrame) -> pd.DataFrame:
     """Gets rid of rows containing missing values and formats the feature names."""
-    clean_df = df.copy()
-
-    # Get rid of rows containing missing values
-    clean_df.dropna(inplace=True)
+    # Get rid of rows containing missing values. dropna returns a new dataframe, so the input is left as it is.
+    clean_df = df.dropna()
 
     # Get rid of spaces in features in order to use pydantic schema for validation
     clean_df.columns = [format_feature_names(col) for col in clean_df.columns]
@@ -1,27 +1,219 @@
+import json
+import numpy as np
 import pandas as pd
-from pydantic import BaseModel, ValidationError
-from typing import List, Optional, Tuple
+from pydantic import BaseModel
+from pydantic.version import version_short
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Type
+from ml_model.config.dynamic_config import config
 from ml_model.model.data_utils import clean_raw_data, load_wine_datasets_and_add_color_col
 
 
-def validate_data(input_df: pd.DataFrame) -> Tuple[pd.DataFrame, Optional[dict]]:
-    """Validates if the input data follows the right schema"""
+# Invalid values reported per validation. The values left out are only counted, so a large upload with a bad column
+# does not produce an error for every row.
+MAX_REPORTED_ERRORS = 100
 
-    # Convert df to list of dicts. Each element represents a row.
-    records = input_df.to_dict(orient="records")
-    validated_df = pd.DataFrame()
-    try:
-        # Convert the validated dataframe into WineDataInputSchema to validate its schema.
-        validated_records = [WineDataInputSchema(**record) for record in records]
-        schema = WineDataBatchInputSchema(inputs=validated_records)
-        validated_df = convert_schema_to_dataframe(schema)
-        errors = None
-    except ValidationError as error:
-        errors = error.json()
+
+def validate_data(
+    input_df: pd.DataFrame,
+    require_target: bool = True,
+    row_offset: int = 0
+) -> Tuple[pd.DataFrame, Optional[str]]:
+    """
+    Validates if the input data follows the right schema.
+
+    The validation is done column by column with pandas instead of building a pydantic model for every row, but it
+    follows the same rules as WineDataInputSchema and reports errors in the same format as pydantic does. Every
+    invalid value is reported, up to MAX_REPORTED_ERRORS, with its location given as ["inputs", <row number>,
+    <field name>]. A missing column is reported once, at the first row. When the data is a chunk of a larger dataset, `row_offset` is the row number of
+    its first row. When `require_target` is False,
+    the target column is not validated and not part of the validated data.
+    """
+    exclude = () if require_target else (config.ml_model_config.target,)
+    validated_df, errors = validate_columns(input_df, WineDataInputSchema, exclude=exclude, row_offset=row_offset)
+    if errors:
+        return pd.DataFrame(), json.dumps(errors, separators=(",", ":"))
+
+    return validated_df, None
+
+
+def validate_columns(
+    input_df: pd.DataFrame,
+    schema: Type[BaseModel],
+    exclude: Sequence[str] = (),
+    row_offset: int = 0
+) -> Tuple[pd.DataFrame, List[dict]]:
+    """
+    Coerces the columns of the dataframe to the field types of the schema. Returns the coerced dataframe,
+    containing only the fields of the schema, and a list of pydantic style error details. Fields listed in
+    `exclude` are skipped and `row_offset` is added to the row numbers in the error locations. Only the first
+    MAX_REPORTED_ERRORS invalid values are listed, followed by a "too_many_errors" entry with the number of values
+    that were left out.
+    """
+    columns = {}
+    missing_errors = []
+    value_errors = []
+    n_invalid = 0
+    for name, field in schema.model_fields.items():
+        if name in exclude:
+            continue
+        if name not in input_df.columns:
+            if field.is_required():
+                missing_errors.append(_missing_field_error(name, input_df, row_offset))
+            continue
+
+        column, column_errors, column_n_invalid = _COLUMN_VALIDATORS[field.annotation](input_df[name])
+        columns[name] = column
+        n_invalid += column_n_invalid
+        value_errors.extend((row, name, error_type, value) for row, (error_type, value) in column_errors)
+
+    # Report the errors row by row, in the order of the schema fields, like pydantic does.
+    # Every column lists its first invalid values, so these are the first invalid values of the whole frame.
+    value_errors.sort(key=lambda error: error[0])
+    value_errors = value_errors[:MAX_REPORTED_ERRORS]
+    errors = missing_errors + [
+        _error_detail(error_type, ["inputs", row_offset + row, name], value)
+        for row, name, error_type, value in value_errors
+    ]
+    if n_invalid > len(value_errors):
+        errors.append(_left_out_errors_detail(n_invalid - len(value_errors)))
+
+    validated_df = pd.DataFrame(columns, index=input_df.index).reset_index(drop=True)
 
     return validated_df, errors
 
 
+# Pydantic error messages, per error type.
+_ERROR_MESSAGES = {
+    "missing": "Field required",
+    "float_type": "Input should be a valid number",
+    "float_parsing": "Input should be a valid number, unable to parse string as a number",
+    "int_type": "Input should be a valid integer",
+    "int_parsing": "Input should be a valid integer, unable to parse string as an integer",
+    "int_from_float": "Input should be a valid integer, got a number with a fractional part",
+    "finite_number": "Input should be a finite number",
+    "string_type": "Input should be a valid string",
+}
+
+
+def _error_detail(error_type: str, loc: list, value: Any) -> dict:
+    return {
+        "type": error_type,
+        "loc": loc,
+        "msg": _ERROR_MESSAGES[error_type],
+        "input": value,
+        "url": f"https://errors.pydantic.dev/{version_short()}/v/{error_type}",
+    }
+
+
+def _left_out_errors_detail(n_left_out: int) -> dict:
+    return {
+        "type": "too_many_errors",
+        "loc": ["inputs"],
+        "msg": f"{n_left_out} more invalid values were not reported",
+        "n_left_out": n_left_out,
+    }
+
+
+def count_errors(errors: List[dict]) -> int:
+    """Returns the number of errors in a list of error details, including the ones that were left out."""
+    return sum(error.get("n_left_out", 1) if error.get("type") == "too_many_errors" else 1 for error in errors)
+
+
+def _missing_field_error(name: str, input_df: pd.DataFrame, row_offset: int) -> dict:
+    # Pydantic reports the record that misses the field as input. Use the first row, as that is the row the
+    # validation would have failed on.
+    first_record = input_df.head(1).to_dict(orient="records")
+    return _error_detail("missing", ["inputs", row_offset, name], _to_python(first_record[0]) if first_record else {})
+
+
+def _to_python(value: Any) -> Any:
+    """Converts numpy scalars to python objects, so the error details can be serialized to JSON."""
+    if isinstance(value, dict):
+        return {key: _to_python(item) for key, item in value.items()}
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is pd.NA or value is pd.NaT or (isinstance(value, float) and value != value):
+        return None
+
+    return value
+
+
+def _invalid_values(column: pd.Series, mask: np.ndarray, error_type: str) -> List[Tuple[int, Tuple[str, Any]]]:
+    positions = np.flatnonzero(mask)[:MAX_REPORTED_ERRORS]
+    values = column.iloc[positions]
+
+    return [(int(row), (error_type, _to_python(value))) for row, value in zip(positions, values)]
+
+
+def _type_errors(column: pd.Series, invalid: np.ndarray, parsing_type: str, type_type: str) -> list:
+    """Splits invalid values in strings that could not be parsed and values of a wrong type."""
+    if not invalid.any():
+        return []
+    is_string = column.map(lambda value: isinstance(value, str)).to_numpy(dtype=bool)
+
+    return (
+        _invalid_values(column, invalid & is_string, parsing_type)
+        + _invalid_values(column, invalid & ~is_string, type_type)
+    )
+
+
+def _to_numeric(column: pd.Series) -> Tuple[pd.Series, np.ndarray]:
+    """
+    Converts a column to float64. Returns the converted column and a mask of values that could not be converted.
+    Missing values are invalid, like None is for pydantic, whether the column is numeric already or not.
+    """
+    if pd.api.types.is_bool_dtype(column) or pd.api.types.is_numeric_dtype(column):
+        return column.astype(np.float64), column.isna().to_numpy()
+
+    numeric = pd.to_numeric(column, errors="coerce").astype(np.float64)
+
+    return numeric, numeric.isna().to_numpy()
+
+
+def _validate_float_column(column: pd.Series) -> Tuple[pd.Series, list, int]:
+    numeric, invalid = _to_numeric(column)
+
+    return numeric, _type_errors(column, invalid, "float_parsing", "float_type"), int(invalid.sum())
+
+
+def _validate_int_column(column: pd.Series) -> Tuple[pd.Series, list, int]:
+    if pd.api.types.is_integer_dtype(column) and not column.hasnans:
+        return column.astype(np.int64), [], 0
+
+    numeric, invalid = _to_numeric(column)
+    errors = _type_errors(column, invalid, "int_parsing", "int_type")
+
+    values = numeric.to_numpy()
+    not_finite = ~np.isfinite(values) & ~invalid
+    fractional = np.isfinite(values) & (values != np.floor(values))
+    errors += _invalid_values(column, not_finite, "finite_number")
+    errors += _invalid_values(column, fractional, "int_from_float")
+
+    invalid_any = invalid | not_finite | fractional
+    if invalid_any.any():
+        return numeric, errors, int(invalid_any.sum())
+
+    return numeric.astype(np.int64), errors, 0
+
+
+def _validate_str_column(column: pd.Series) -> Tuple[pd.Series, list, int]:
+    if pd.api.types.is_string_dtype(column) and not pd.api.types.is_object_dtype(column):
+        invalid = column.isna().to_numpy()
+    elif pd.api.types.is_object_dtype(column):
+        invalid = ~column.map(lambda value: isinstance(value, str)).to_numpy(dtype=bool)
+    else:
+        invalid = np.ones(len(column), dtype=bool)
+
+    return column, _invalid_values(column, invalid, "string_type"), int(invalid.sum())
+
+
+_COLUMN_VALIDATORS: Dict[type, Any] = {
+    float: _validate_float_column,
+    int: _validate_int_column,
+    str: _validate_str_column,
+}
+
+
 class WineDataInputSchema(BaseModel):
     FixedAcidity: float
     VolatileAcidity: float
@@ -38,26 +230,6 @@ class WineDataInputSchema(BaseModel):
     Color: str  # Added to dataset
 
 
-class WineDataBatchInputSchema(BaseModel):
-    inputs: List[WineDataInputSchema]
-
-
-# Extract data and convert to DataFrame
-def convert_schema_to_dataframe(batch_schema: WineDataBatchInputSchema) -> pd.DataFrame:
-    """
-    This function converts a WineDataBatchInputSchema into a pandas DataFrame. This ensures that the
-    data used by the model follows the right schema.
-    """
-
-    # Convert schema to list of dictionaries
-    data = [item.model_dump() for item in batch_schema.inputs]
-
-    # Create DataFrame
-    df = pd.DataFrame(data)
-
-    return df
-
-
 def process_user_input(input_data: pd.DataFrame) -> Tuple[pd.DataFrame, dict]:
     """Cleans an validates the raw input data from the user."""
     input_data = clean_raw_data(input_data)
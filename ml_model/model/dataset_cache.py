@@ -0,0 +1,84 @@
+"""
+This file contains the cache of the validated training data. Reading both wine datasets, cleaning and validating them
+is repeated on every training run although the result only changes when the datasets or the configuration change.
+The combined, validated frame is therefore stored column by column in an uncompressed NumPy archive, keyed by a hash of
+the source files and the static configuration, so later runs can skip parsing and validation.
+"""
+import hashlib
+import logging
+import os
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import List, Optional, Tuple
+from ml_model import __version__ as package_version
+from ml_model.config.dynamic_config import DATASET_CACHE_DIR, STATIC_CONFIG_FILE_PATH
+from ml_model.model.data_utils import get_dataset_path
+from ml_model.model.data_validation import combine_clean_and_validate_wine_datasets
+
+
+def get_cache_key(file_names: List[str]) -> str:
+    """Returns a hash of the contents of the datasets, the static configuration and the package version."""
+    digest = hashlib.sha256(package_version.encode())
+    for file_path in [*(get_dataset_path(name) for name in file_names), STATIC_CONFIG_FILE_PATH]:
+        digest.update(file_path.name.encode())
+        with open(file_path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+
+def get_cache_file_path(file_names: List[str], cache_dir: Path = DATASET_CACHE_DIR) -> Path:
+    return Path(cache_dir) / f"training_data_{get_cache_key(file_names)[:16]}.npz"
+
+
+def save_frame(df: pd.DataFrame, file_path: Path) -> None:
+    """Saves every column of the frame as a separate array. The arrays are written to a temporary file first."""
+    columns = {f"column_{i}": df[column].to_numpy() for i, column in enumerate(df.columns)}
+    # Text columns are stored as fixed width unicode arrays, so the archive can be loaded without pickle
+    columns = {key: values.astype(str) if values.dtype == object else values for key, values in columns.items()}
+
+    temp_path = file_path.with_name(file_path.name + ".tmp")
+    with open(temp_path, "wb") as file:
+        np.savez(file, column_names=np.asarray(df.columns, dtype=str), **columns)
+    os.replace(temp_path, file_path)
+
+
+def load_frame(file_path: Path) -> pd.DataFrame:
+    with np.load(file_path, allow_pickle=False) as archive:
+        column_names = archive["column_names"].tolist()
+        return pd.DataFrame({
+            name: archive[f"column_{i}"].astype(object) if archive[f"column_{i}"].dtype.kind == "U"
+            else archive[f"column_{i}"]
+            for i, name in enumerate(column_names)
+        })
+
+
+def load_validated_training_data(
+        file_names: List[str],
+        use_cache: bool = True,
+        cache_dir: Path = DATASET_CACHE_DIR
+) -> Tuple[pd.DataFrame, Optional[str]]:
+    """
+    Returns the combined, cleaned and validated wine datasets and the validation errors, like
+    combine_clean_and_validate_wine_datasets. Valid data is taken from and written to the cache when `use_cache` is set.
+    """
+    if not use_cache:
+        return combine_clean_and_validate_wine_datasets(file_names)
+
+    file_path = get_cache_file_path(file_names, cache_dir)
+    if file_path.exists():
+        logging.info(f"Loading the validated training data from the cache at {file_path}")
+        return load_frame(file_path), None
+
+    training_df, errors = combine_clean_and_validate_wine_datasets(file_names)
+    if errors is None:
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        # Only one version of the training data is kept
+        for old_file in file_path.parent.glob("training_data_*.npz"):
+            old_file.unlink()
+        save_frame(training_df, file_path)
+        logging.info(f"Cached the validated training data at {file_path}")
+
+    return training_df, errors
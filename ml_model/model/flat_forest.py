@@ -0,0 +1,231 @@
+"""
+This file contains a flat, array based representation of the fitted random forest and a compiled evaluator for it.
+The nodes of all trees are stored in a few contiguous NumPy arrays. The evaluator walks every tree for a block of rows
+at the same time, so the memory loads of different rows overlap, and it avoids the per-estimator Python overhead of
+scikit-learn.
+
+The evaluation follows scikit-learn exactly: the features are compared as float32 against float64 thresholds and the
+class distributions of the leaves are normalized per tree and summed in tree order, so the predictions are
+bit-identical to those of RandomForestClassifier.
+"""
+from dataclasses import dataclass, fields, replace
+import hashlib
+import joblib
+from numba import njit
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from sklearn.ensemble import RandomForestClassifier
+from typing import Any, Union
+
+
+# Number of rows that walk a tree together
+ROW_BLOCK_SIZE = 64
+
+
+@njit(nogil=True, cache=True)
+def _accumulate_tree_probas(X, feature, threshold, children, leaf_values, roots, out):
+    """
+    Adds the leaf probabilities of every tree to `out`. Internal nodes have a feature index >= 0 and their children
+    at children[2 * node] (left) and children[2 * node + 1] (right). Leaves have feature -1 and their row in
+    `leaf_values` at children[2 * node].
+    """
+    n_rows = X.shape[0]
+    nodes = np.empty(ROW_BLOCK_SIZE, dtype=np.int64)
+    rows = np.empty(ROW_BLOCK_SIZE, dtype=np.int64)
+
+    # Trees are walked in order, so the probabilities of every row are summed in the same order as scikit-learn
+    for tree in range(roots.shape[0]):
+        for start in range(0, n_rows, ROW_BLOCK_SIZE):
+            n_active = min(ROW_BLOCK_SIZE, n_rows - start)
+            for j in range(n_active):
+                nodes[j] = roots[tree]
+                rows[j] = start + j
+
+            # Move all rows of the block one level down per pass, dropping rows that reached a leaf
+            while n_active > 0:
+                n_remaining = 0
+                for j in range(n_active):
+                    node = nodes[j]
+                    row = rows[j]
+                    if feature[node] >= 0:
+                        nodes[n_remaining] = children[2 * node + (X[row, feature[node]] > threshold[node])]
+                        rows[n_remaining] = row
+                        n_remaining += 1
+                    else:
+                        leaf = children[2 * node]
+                        for c in range(leaf_values.shape[1]):
+                            out[row, c] += leaf_values[leaf, c]
+                n_active = n_remaining
+
+
+@dataclass
+class FlatForest:
+    """The nodes of all trees of a forest, indexed by global node number, and the class distributions of the leaves."""
+
+    feature: np.ndarray
+    threshold: np.ndarray
+    children: np.ndarray
+    leaf_values: np.ndarray
+    roots: np.ndarray
+    classes: np.ndarray
+    n_features: int
+    fingerprint: str
+
+    @property
+    def n_trees(self) -> int:
+        return len(self.roots)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, field.name).nbytes for field in fields(self) if field.type is np.ndarray)
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        """Returns the class probabilities of every row, like RandomForestClassifier.predict_proba."""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        proba = np.zeros((X.shape[0], len(self.classes)), dtype=np.float64)
+        _accumulate_tree_probas(
+            X, self.feature, self.threshold, self.children, self.leaf_values, self.roots, proba
+        )
+        proba /= self.n_trees
+
+        return proba
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        """Returns the predicted class of every row, like RandomForestClassifier.predict."""
+        return self.classes.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
+
+    def warm_up(self) -> None:
+        """Compiles the evaluator, so the first request does not have to wait for it."""
+        self.predict_proba(np.zeros((1, self.n_features), dtype=np.float32))
+
+    def to_arrays(self) -> dict:
+        return {field.name: getattr(self, field.name) for field in fields(self)}
+
+
+def forest_fingerprint(forest: RandomForestClassifier) -> str:
+    """Returns a hash of the split thresholds of all trees, used to check that a FlatForest belongs to a forest."""
+    digest = hashlib.sha1()
+    for estimator in forest.estimators_:
+        digest.update(estimator.tree_.threshold.tobytes())
+
+    return digest.hexdigest()
+
+
+def flatten_forest(forest: RandomForestClassifier) -> FlatForest:
+    """Flattens the trees of a fitted forest into a FlatForest."""
+    features, thresholds, children, leaf_values, roots = [], [], [], [], []
+    node_offset = 0
+    leaf_offset = 0
+
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        is_leaf = tree.children_left == -1
+        leaf_ids = np.cumsum(is_leaf) - 1 + leaf_offset
+
+        tree_children = np.empty(2 * tree.node_count, dtype=np.int64)
+        tree_children[0::2] = np.where(is_leaf, leaf_ids, tree.children_left + node_offset)
+        tree_children[1::2] = np.where(is_leaf, leaf_ids, tree.children_right + node_offset)
+
+        features.append(np.where(is_leaf, -1, tree.feature))
+        thresholds.append(tree.threshold)
+        children.append(tree_children)
+
+        # Normalize the class distributions like DecisionTreeClassifier.predict_proba does
+        value = tree.value[is_leaf, 0, :estimator.n_classes_]
+        normalizer = value.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        leaf_values.append(value / normalizer)
+
+        roots.append(node_offset)
+        node_offset += tree.node_count
+        leaf_offset += int(is_leaf.sum())
+
+    index_dtype = np.int32 if node_offset < np.iinfo(np.int32).max else np.int64
+
+    return FlatForest(
+        feature=np.concatenate(features).astype(np.int32),
+        threshold=np.concatenate(thresholds),
+        children=np.concatenate(children).astype(index_dtype),
+        leaf_values=np.concatenate(leaf_values),
+        roots=np.asarray(roots, dtype=index_dtype),
+        classes=forest.classes_,
+        n_features=forest.n_features_in_,
+        fingerprint=forest_fingerprint(forest),
+    )
+
+
+class FlatForestPipeline:
+    """
+    Drop-in replacement for the predict methods of the fitted pipeline. Runs the preprocessing steps of the pipeline,
+    i.e. `pipeline[:-1]` or an equivalent fused transform, and evaluates the forest with a FlatForest.
+    """
+
+    def __init__(self, preprocessing: Any, flat_forest: FlatForest):
+        self.preprocessing = preprocessing
+        self.flat_forest = flat_forest
+        self.classes_ = flat_forest.classes
+
+    def predict_proba(self, X: Union[pd.DataFrame, np.ndarray]) -> np.ndarray:
+        return self.flat_forest.predict_proba(self.preprocessing.transform(X))
+
+    def predict(self, X: Union[pd.DataFrame, np.ndarray]) -> np.ndarray:
+        return self.flat_forest.predict(self.preprocessing.transform(X))
+
+
+def compact_flat_forest(flat_forest: FlatForest) -> FlatForest:
+    """
+    Returns a smaller FlatForest that gives exactly the same predictions.
+
+    - Thresholds are stored as float32, rounded down. The features are float32, so for a feature x and a float64
+      threshold t, x > t holds exactly when x > t32 for the largest float32 t32 <= t.
+    - Leaves with the same class distribution share one row of leaf values. Trees that are grown until their leaves
+      are pure only have one distinct distribution per class.
+    - Feature indices use the smallest integer type that holds them.
+    """
+    threshold = flat_forest.threshold.astype(np.float32)
+    rounded_up = threshold.astype(np.float64) > flat_forest.threshold
+    threshold[rounded_up] = np.nextafter(threshold[rounded_up], np.float32(-np.inf))
+
+    leaf_values, leaf_ids = np.unique(flat_forest.leaf_values, axis=0, return_inverse=True)
+    is_leaf = flat_forest.feature < 0
+    children = flat_forest.children.copy()
+    children[0::2][is_leaf] = leaf_ids.reshape(-1)[flat_forest.children[0::2][is_leaf]]
+    children[1::2][is_leaf] = children[0::2][is_leaf]
+
+    feature_dtype = np.int8 if flat_forest.n_features <= np.iinfo(np.int8).max else np.int16
+
+    return replace(
+        flat_forest,
+        feature=flat_forest.feature.astype(feature_dtype),
+        threshold=threshold,
+        children=children,
+        leaf_values=leaf_values,
+    )
+
+
+def save_flat_forest(flat_forest: FlatForest, file_path: Path, compress: int = 0) -> None:
+    """
+    Saves the arrays of the flat forest. Without compression, the arrays can be memory mapped when loading. With
+    compression (zlib level 1 - 9) the file is smaller, but the arrays have to be decompressed into memory.
+    """
+    save_arrays(flat_forest.to_arrays(), file_path, compress)
+
+
+def load_flat_forest(file_path: Path, mmap: bool = True) -> FlatForest:
+    return FlatForest(**load_arrays(file_path, mmap))
+
+
+def save_arrays(payload: dict, file_path: Path, compress: int = 0) -> None:
+    temp_path = file_path.with_name(file_path.name + ".tmp")
+    joblib.dump(payload, temp_path, compress=("zlib", compress) if compress else 0)
+    temp_path.replace(file_path)
+
+
+def load_arrays(file_path: Path, mmap: bool = True) -> dict:
+    """Loads a file written by save_arrays. Uncompressed arrays are memory mapped read-only if `mmap` is set."""
+    with open(file_path, "rb") as file:
+        # Uncompressed files are plain pickles, which start with the PROTO opcode. Compressed files can not be mapped.
+        compressed = file.read(1) != b"\x80"
+
+    return joblib.load(file_path, mmap_mode="r" if mmap and not compressed else None)
@@ -0,0 +1,189 @@
+"""
+This file turns the fitted preprocessing steps of the wine pipeline into a single fused transform. At prediction time
+the imputers, the one-hot encoder and the scaler each copy the data and check its columns again. For this model the
+whole chain reduces to filling missing values, one indicator column per encoded category and an affine transform, so
+the fused transform builds the feature matrix once and scales it in a single NumPy operation.
+
+The fused transform performs the same floating point operations as the original steps, so its output is identical.
+That is checked when the transform is compiled.
+"""
+from dataclasses import dataclass
+import logging
+import warnings
+from feature_engine.imputation import CategoricalImputer, MeanMedianImputer
+import numpy as np
+import pandas as pd
+from sklearn.compose import ColumnTransformer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+from typing import Dict, List, Optional, Tuple
+
+
+@dataclass
+class FusedPreprocessor:
+    """
+    Builds the scaled feature matrix from the validated input data in one pass.
+
+    Output column `value_positions[i]` holds input column `value_columns[i]`, and output column
+    `indicator_positions[i]` is 1 where the input column equals the category given by `indicator_columns[i]`.
+    """
+
+    value_columns: List[str]
+    value_positions: np.ndarray
+    indicator_columns: List[Tuple[str, str]]
+    indicator_positions: np.ndarray
+    fill_values: Dict[str, object]
+    mean: np.ndarray
+    scale: np.ndarray
+
+    def transform(self, X: pd.DataFrame, dtype: type = np.float32) -> np.ndarray:
+        features = np.empty((len(X), len(self.mean)), dtype=np.float64)
+
+        values = X[self.value_columns].to_numpy(dtype=np.float64)
+        missing = np.isnan(values)
+        if missing.any():
+            fill_values = np.array([self.fill_values.get(column, np.nan) for column in self.value_columns])
+            values = np.where(missing, fill_values, values)
+        features[:, self.value_positions] = values
+
+        for (column, category), position in zip(self.indicator_columns, self.indicator_positions):
+            categories = X[column]
+            if column in self.fill_values:
+                categories = categories.fillna(self.fill_values[column])
+            features[:, position] = (categories.to_numpy() == category)
+
+        # The affine transform of the scaler, applied to the whole matrix at once
+        features -= self.mean
+        features /= self.scale
+
+        return features.astype(dtype, copy=False)
+
+
+def fuse_preprocessing(preprocessing: Pipeline) -> FusedPreprocessor:
+    """
+    Compiles the fitted preprocessing steps of a pipeline, i.e. `pipeline[:-1]`, into a FusedPreprocessor. Raises a
+    ValueError when there are steps that can not be fused.
+    """
+    fill_values = {}
+    column_transformer = None
+    scaler = None
+
+    for name, step in preprocessing.steps:
+        if isinstance(step, (CategoricalImputer, MeanMedianImputer)) and column_transformer is None:
+            fill_values.update(step.imputer_dict_)
+        elif isinstance(step, ColumnTransformer) and column_transformer is None:
+            column_transformer = step
+        elif isinstance(step, StandardScaler) and column_transformer is not None and scaler is None:
+            scaler = step
+        else:
+            raise ValueError(f"The preprocessing step {name!r} can not be fused.")
+
+    if column_transformer is None or scaler is None:
+        raise ValueError("The pipeline needs a ColumnTransformer followed by a StandardScaler to be fused.")
+
+    value_columns, value_positions = [], []
+    indicator_columns, indicator_positions = [], []
+    input_columns = list(column_transformer.feature_names_in_)
+
+    with warnings.catch_warnings():
+        # Reading the remainder columns warns about a future change of their format, both formats are handled below
+        warnings.simplefilter("ignore", FutureWarning)
+        transformers = [
+            (name, transformer, list(columns)) for name, transformer, columns in column_transformer.transformers_
+        ]
+
+    for name, transformer, columns in transformers:
+        output_slice = column_transformer.output_indices_[name]
+        if transformer == "drop" or output_slice.start == output_slice.stop:
+            continue
+        columns = [input_columns[column] if isinstance(column, (int, np.integer)) else column for column in columns]
+
+        if name == "remainder" and column_transformer.remainder == "passthrough":
+            value_columns.extend(columns)
+            value_positions.extend(range(output_slice.start, output_slice.stop))
+        elif isinstance(transformer, OneHotEncoder) and transformer.handle_unknown == "ignore":
+            encoded = _one_hot_output_columns(transformer, columns)
+            indicator_columns.extend(encoded)
+            indicator_positions.extend(range(output_slice.start, output_slice.start + len(encoded)))
+        else:
+            raise ValueError(f"The transformer {name!r} of the column transformer can not be fused.")
+
+    n_features = len(value_columns) + len(indicator_columns)
+
+    return FusedPreprocessor(
+        value_columns=value_columns,
+        value_positions=np.asarray(value_positions, dtype=np.intp),
+        indicator_columns=indicator_columns,
+        indicator_positions=np.asarray(indicator_positions, dtype=np.intp),
+        fill_values=fill_values,
+        mean=scaler.mean_ if scaler.with_mean else np.zeros(n_features),
+        scale=scaler.scale_ if scaler.with_std else np.ones(n_features),
+    )
+
+
+def _one_hot_output_columns(encoder: OneHotEncoder, columns: List[str]) -> List[Tuple[str, str]]:
+    if getattr(encoder, "infrequent_categories_", None) and any(
+        categories is not None for categories in encoder.infrequent_categories_
+    ):
+        raise ValueError("One-hot encoders with infrequent categories can not be fused.")
+
+    output_columns = []
+    drop_idx = encoder.drop_idx_ if encoder.drop_idx_ is not None else [None] * len(columns)
+    for column, categories, dropped in zip(columns, encoder.categories_, drop_idx):
+        output_columns.extend(
+            (column, category) for i, category in enumerate(categories) if dropped is None or i != dropped
+        )
+
+    return output_columns
+
+
+def make_equivalence_sample(fused: FusedPreprocessor) -> pd.DataFrame:
+    """
+    Creates input data that covers the fused transform: values around the mean of every column, missing values,
+    every encoded category and an unknown category.
+    """
+    value_positions = list(fused.value_positions)
+    categorical_columns = sorted({column for column, _ in fused.indicator_columns})
+    categories = [category for _, category in fused.indicator_columns] + ["unknown", None]
+
+    rng = np.random.default_rng(0)
+    n_rows = 8 * len(categories)
+    data = {
+        column: fused.mean[position] + fused.scale[position] * rng.normal(size=n_rows)
+        for column, position in zip(fused.value_columns, value_positions)
+    }
+    for column in fused.value_columns:
+        data[column][::7] = np.nan
+    for column in categorical_columns:
+        data[column] = [categories[i % len(categories)] for i in range(n_rows)]
+
+    return pd.DataFrame(data)
+
+
+def is_equivalent(preprocessing: Pipeline, fused: FusedPreprocessor, X: Optional[pd.DataFrame] = None) -> bool:
+    """Checks that the fused transform gives exactly the same output as the preprocessing steps."""
+    if X is None:
+        X = make_equivalence_sample(fused)
+    X = X[list(preprocessing.feature_names_in_)]
+
+    with warnings.catch_warnings():
+        # The sample contains an unknown category on purpose
+        warnings.simplefilter("ignore", UserWarning)
+        expected = preprocessing.transform(X)
+
+    return np.array_equal(fused.transform(X, dtype=np.float64), expected, equal_nan=True)
+
+
+def compile_preprocessing(preprocessing: Pipeline) -> Optional[FusedPreprocessor]:
+    """Fuses the preprocessing steps. Returns None if they can not be fused exactly."""
+    try:
+        fused = fuse_preprocessing(preprocessing)
+    except ValueError as e:
+        logging.warning(f"Falling back to the pipeline's preprocessing steps: {e}")
+        return None
+
+    if not is_equivalent(preprocessing, fused):
+        logging.warning("The fused preprocessing differs from the pipeline's preprocessing steps. Not using it.")
+        return None
+
+    return fused
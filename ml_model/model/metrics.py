@@ -0,0 +1,244 @@
+"""
+This file contains the metrics of the prediction service, and their exposition in the Prometheus text format. The
+metrics are kept in memory per process. Updating a metric takes a lock and a few additions, so the metrics are cheap
+enough to be left on in production.
+
+With several worker processes (see api/serve.py), every process has its own metrics and a scrape reports those of the
+process that handled it.
+"""
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+import math
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+# Upper bounds of the buckets of the timing histograms, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric(ABC):
+    """A metric with a value per combination of label values."""
+
+    metric_type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}, got {tuple(labels)}")
+
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abstractmethod
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        """Returns the samples of the metric as (name, labels, value)."""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for name, labels, value in self.samples():
+            label_text = ",".join(f'{key}="{_escape(label_value)}"' for key, label_value in labels.items())
+            lines.append(f"{name}{{{label_text}}} {_format_value(value)}" if label_text else
+                         f"{name} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """
+    A value that only goes up. If `function` is given, the value is read from it on every scrape instead, for counts
+    that are already kept elsewhere.
+    """
+
+    metric_type = "counter"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            function: Optional[Callable[[], float]] = None
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        if amount < 0:
+            raise ValueError("Counters can only be increased")
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        if self.function is not None:
+            return self.function()
+        return self._values.get(self._label_values(labels), 0.0)
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        if self.function is not None:
+            return [(self.name, {}, self.function())]
+        with self._lock:
+            values = list(self._values.items())
+
+        return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in values]
+
+
+class Gauge(Counter):
+    """A value that goes up and down, such as the number of tasks in flight."""
+
+    metric_type = "gauge"
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """Counts observations, such as durations, in buckets with the given upper bounds."""
+
+    metric_type = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Per combination of label values: the count per bucket, the sum and the number of observations
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._label_values(labels)
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = ([0] * len(self.buckets), [0.0, 0])
+            counts, totals = self._values[key]
+            counts[bucket] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observes the duration of the block, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        values = self._values.get(self._label_values(labels))
+        return values[1][1] if values else 0
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            values = [(key, list(counts), list(totals)) for key, (counts, totals) in self._values.items()]
+
+        samples = []
+        for key, counts, (total, count) in values:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", {**labels, "le": _format_value(upper_bound)}, cumulative))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, count))
+
+        return samples
+
+
+class MetricsRegistry:
+    """The metrics of a process, in the order they were registered."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"A metric named {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = (), function=None) -> Counter:
+        return self.register(Counter(name, documentation, labelnames, function))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (), function=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        return "".join(metric.render() for metric in metrics)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+
+# Process wide registry and the metrics of the prediction path. The metrics of the API are registered in api/main.py.
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.histogram(
+    "ml_model_stage_seconds",
+    "Time spent in every stage of processing an upload: load, clean, validate and predict.",
+    labelnames=["stage"]
+)
+ROWS_TOTAL = metrics.counter(
+    "ml_model_rows_total",
+    "Number of rows processed, by outcome: predicted or rejected by validation.",
+    labelnames=["outcome"]
+)
+TASKS_TOTAL = metrics.counter(
+    "ml_model_tasks_total",
+    "Number of finished prediction tasks, by status.",
+    labelnames=["status"]
+)
+MODEL_LOAD_SECONDS = metrics.histogram(
+    "ml_model_model_load_seconds",
+    "Time spent loading the model artifact.",
+)
@@ -0,0 +1,102 @@
+"""
+This file contains the micro-batcher used by the synchronous prediction endpoint. Requests that arrive at nearly the
+same time are combined into a single batch, so the forest is evaluated once for the whole group instead of once per
+request.
+"""
+from concurrent.futures import Future
+import logging
+import queue
+import threading
+import time
+import numpy as np
+import pandas as pd
+from typing import Callable, List, Optional, Tuple
+
+
+class MicroBatcher:
+    """
+    Collects prediction requests on a queue and evaluates them in batches on a single background thread.
+
+    A batch is closed as soon as it holds `max_batch_size` rows or when `max_wait_ms` milliseconds have passed since
+    its first request arrived. Requests that are larger than `max_batch_size` are predicted on their own.
+    """
+
+    def __init__(self, predict_fn: Callable[[pd.DataFrame], np.ndarray], max_batch_size: int, max_wait_ms: float):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: "queue.Queue[Tuple[pd.DataFrame, Future]]" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+        self.batch_count = 0
+        self.request_count = 0
+
+    def submit(self, input_data: pd.DataFrame) -> Future:
+        """Queues the input data for prediction. The returned future resolves to an array of predictions."""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((input_data, future))
+
+        return future
+
+    def predict(self, input_data: pd.DataFrame, timeout: Optional[float] = None) -> np.ndarray:
+        """Queues the input data and waits for its predictions."""
+        return self.submit(input_data).result(timeout=timeout)
+
+    def queue_size(self) -> int:
+        """Returns the number of requests waiting to be batched."""
+        return self._queue.qsize()
+
+    def _ensure_worker(self) -> None:
+        # The worker thread is started on first use instead of on creation. Threads do not survive a fork, so this
+        # keeps the batcher usable in processes that are forked after this module is imported.
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                self._worker.start()
+
+    def _collect_batch(self) -> List[Tuple[pd.DataFrame, Future]]:
+        batch = [self._queue.get()]
+        n_rows = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+
+        while n_rows < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            n_rows += len(item[0])
+
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            # Skip requests whose callers are no longer waiting for them
+            batch = [(input_data, future) for input_data, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                combined = pd.concat([input_data for input_data, _ in batch], ignore_index=True)
+                predictions = self.predict_fn(combined)
+            except Exception as e:
+                logging.error(f"Prediction failed for a batch of {len(batch)} requests: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.batch_count += 1
+            self.request_count += len(batch)
+
+            # Hand every request the predictions for its own rows
+            offset = 0
+            for input_data, future in batch:
+                future.set_result(predictions[offset:offset + len(input_data)])
+                offset += len(input_data)
@@ -0,0 +1,229 @@
+"""
+This file contains the download manager for model artifacts. Artifacts are downloaded in ranged chunks by several
+threads into a `.part` file next to the destination. The chunks that are done are recorded in a small sidecar file,
+so an interrupted download resumes where it stopped. When all chunks are in, the content hash is checked against the
+hash stored with the blob and the file is renamed into place, so the destination either does not exist or is
+complete.
+
+The downloaded artifacts are kept in a local cache directory. When the artifacts in it take up more than the
+configured number of bytes, the least recently used ones are removed. Use is tracked by the access time of the
+artifacts only: their modification time is part of the signature the model registry uses to notice a new artifact.
+"""
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+
+# Suffixes of the files in the cache directory that are model artifacts
+ARTIFACT_SUFFIXES = (".pkl", ".flat.joblib", ".compact.joblib")
+
+# Metadata key under which the SHA-256 of an artifact is stored with its blob
+SHA256_METADATA_KEY = "sha256"
+
+
+@dataclass
+class BlobInfo:
+    size: int
+    sha256: Optional[str] = None
+
+
+class BlobSource(ABC):
+    """A store the artifacts can be downloaded from, in ranges of bytes."""
+
+    @abstractmethod
+    def get_info(self, name: str) -> BlobInfo:
+        """Returns the size of the blob and its SHA-256, if one was stored with it."""
+
+    @abstractmethod
+    def read_range(self, name: str, offset: int, length: int) -> bytes:
+        """Returns `length` bytes of the blob, starting at `offset`."""
+
+
+class AzureBlobSource(BlobSource):
+    """Downloads from a container in Azure Blob Storage, or from a local Azurite emulator."""
+
+    def __init__(self, connection_string: str, container_name: str):
+        from azure.storage.blob import BlobServiceClient
+
+        self.container_client = BlobServiceClient.from_connection_string(connection_string).get_container_client(
+            container_name
+        )
+
+    def get_info(self, name: str) -> BlobInfo:
+        properties = self.container_client.get_blob_client(name).get_blob_properties()
+        return BlobInfo(size=properties.size, sha256=(properties.metadata or {}).get(SHA256_METADATA_KEY))
+
+    def read_range(self, name: str, offset: int, length: int) -> bytes:
+        return self.container_client.get_blob_client(name).download_blob(offset=offset, length=length).readall()
+
+
+class FileSystemBlobSource(BlobSource):
+    """
+    Serves blobs from a local directory. The SHA-256 of a blob is read from a `<name>.sha256` file next to it, if
+    there is one. Used to test the download manager without a blob store.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def get_info(self, name: str) -> BlobInfo:
+        checksum_path = self.root / f"{name}.sha256"
+        sha256 = checksum_path.read_text().strip() if checksum_path.exists() else None
+        return BlobInfo(size=(self.root / name).stat().st_size, sha256=sha256)
+
+    def read_range(self, name: str, offset: int, length: int) -> bytes:
+        with open(self.root / name, "rb") as file:
+            file.seek(offset)
+            return file.read(length)
+
+
+def file_sha256(file_path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def download_blob(
+        source: BlobSource,
+        name: str,
+        destination: Path,
+        chunk_bytes: int = 8 << 20,
+        max_workers: int = 4
+) -> Path:
+    """
+    Downloads the blob to `destination` in chunks of `chunk_bytes`, with up to `max_workers` chunks in flight.
+    Resumes a previous download of the same blob. Raises a ValueError when the content does not match the SHA-256
+    stored with the blob.
+    """
+    destination = Path(destination)
+    part_path = destination.with_name(destination.name + ".part")
+    state_path = destination.with_name(destination.name + ".part.json")
+    info = source.get_info(name)
+    state = {"size": info.size, "sha256": info.sha256, "chunk_bytes": chunk_bytes, "completed": []}
+
+    # Resume only if the blob has not changed since the previous attempt
+    completed = set()
+    if part_path.exists() and state_path.exists():
+        previous_state = json.loads(state_path.read_text())
+        if all(previous_state.get(key) == state[key] for key in ("size", "sha256", "chunk_bytes")):
+            completed = set(previous_state["completed"])
+            logging.info(f"Resuming download of {name}, {len(completed)} chunks already downloaded")
+
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    with open(part_path, "r+b" if completed else "wb") as part_file:
+        part_file.truncate(info.size)
+
+    n_chunks = max(1, -(-info.size // chunk_bytes))
+    state_lock = threading.Lock()
+
+    def download_chunk(chunk: int) -> None:
+        offset = chunk * chunk_bytes
+        length = min(chunk_bytes, info.size - offset)
+        data = source.read_range(name, offset, length)
+        if len(data) != length:
+            raise IOError(f"Expected {length} bytes of {name} at offset {offset}, got {len(data)}")
+
+        fd = os.open(part_path, os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, offset)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        with state_lock:
+            completed.add(chunk)
+            state["completed"] = sorted(completed)
+            state_path.write_text(json.dumps(state))
+
+    missing_chunks = [chunk for chunk in range(n_chunks) if chunk not in completed]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # list() re-raises the first error of any chunk. The chunks that succeeded stay recorded for the next attempt.
+        list(executor.map(download_chunk, missing_chunks))
+
+    if info.sha256 is not None:
+        sha256 = file_sha256(part_path)
+        if sha256 != info.sha256:
+            part_path.unlink()
+            state_path.unlink()
+            raise ValueError(f"Checksum mismatch for {name}: expected {info.sha256}, got {sha256}")
+    else:
+        logging.warning(f"No checksum stored with {name}, the download can not be verified")
+
+    os.replace(part_path, destination)
+    state_path.unlink()
+    logging.info(f"Downloaded {name} ({info.size} bytes) to {destination}")
+
+    return destination
+
+
+class ArtifactCache:
+    """
+    Keeps downloaded artifacts in `cache_dir`. Artifacts are versioned by their file name, so artifacts of several
+    model versions can be kept side by side. Once the artifacts take up more than `max_bytes`, the least recently
+    used ones are removed.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int, chunk_bytes: int = 8 << 20, max_workers: int = 4):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.chunk_bytes = chunk_bytes
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+
+    def fetch(self, source: BlobSource, name: str, keep: Iterable[Path] = ()) -> Path:
+        """
+        Returns the path of the artifact in the cache, downloading it first if needed. Eviction never removes the
+        artifact or the artifacts in `keep`.
+        """
+        file_path = self.cache_dir / name
+        with self._lock:
+            if not file_path.exists():
+                download_blob(source, name, file_path, self.chunk_bytes, self.max_workers)
+            self.touch(file_path)
+            self.evict(keep=[file_path, *keep])
+
+        return file_path
+
+    @staticmethod
+    def touch(file_path: Path) -> None:
+        """Marks the artifact as used. Only the access time is updated, the modification time is kept."""
+        stat = file_path.stat()
+        os.utime(file_path, ns=(time.time_ns(), stat.st_mtime_ns))
+
+    def artifacts(self) -> List[Path]:
+        """Returns the artifacts in the cache, least recently used first."""
+        if not self.cache_dir.exists():
+            return []
+        files = [path for path in self.cache_dir.iterdir() if path.name.endswith(ARTIFACT_SUFFIXES)]
+
+        return sorted(files, key=lambda path: path.stat().st_atime_ns)
+
+    def evict(self, keep: Iterable[Path] = ()) -> List[Path]:
+        """Removes the least recently used artifacts until the cache fits in `max_bytes`. Never removes `keep`."""
+        keep = {Path(path).resolve() for path in keep}
+        artifacts = self.artifacts()
+        total_bytes = sum(path.stat().st_size for path in artifacts)
+        evicted = []
+
+        for path in artifacts:
+            if total_bytes <= self.max_bytes:
+                break
+            if path.resolve() in keep:
+                continue
+            total_bytes -= path.stat().st_size
+            path.unlink()
+            evicted.append(path)
+            logging.info(f"Evicted {path.name} from the artifact cache")
+
+        return evicted
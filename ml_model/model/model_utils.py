@@ -1,16 +1,103 @@
+from collections import OrderedDict
+from dataclasses import dataclass
 import logging
 import os
+import re
+import threading
+import time
 import joblib
-from sklearn.pipeline import Pipeline
 from ml_model.config.dynamic_config import config, TRAINED_MODEL_DIR
 from ml_model import __version__ as package_version
-from azure.storage.blob import BlobServiceClient
+from ml_model.model.metrics import MODEL_LOAD_SECONDS
 from pathlib import Path
+from typing import List, Optional, Tuple, TYPE_CHECKING, Union
+
+# scikit-learn, numba and the Azure SDK take most of the import time of the package. They are imported where they are
+# used, so importing this module stays fast and the model can be loaded in the background.
+if TYPE_CHECKING:
+    from sklearn.pipeline import Pipeline
+    from ml_model.model.flat_forest import FlatForest, FlatForestPipeline
+
+
+# Model versions are part of file names, so they may only contain these characters
+MODEL_VERSION_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]*")
+
+
+def validate_model_version(version: str) -> str:
+    """Returns the version, or raises a ValueError if it is not a valid model version."""
+    if not MODEL_VERSION_PATTERN.fullmatch(version):
+        raise ValueError(f"Invalid model version: {version!r}")
+
+    return version
+
+
+def get_pipeline_file_path(version: Optional[str] = None) -> Path:
+    """Returns the path of the pipeline file of the version, by default the package version, in the models directory."""
+    file_name = config.app_config.pipeline_save_file + '_' + validate_model_version(version or package_version) + '.pkl'
+
+    return TRAINED_MODEL_DIR / file_name
+
+
+def get_flat_forest_file_path(pipeline_file_path: Path) -> Path:
+    """Returns the path of the flattened forest that belongs to a pipeline file."""
+    return pipeline_file_path.with_suffix(".flat.joblib")
+
+
+def get_compact_artifact_file_path(pipeline_file_path: Path) -> Path:
+    """Returns the path of the compact artifact that belongs to a pipeline file."""
+    return pipeline_file_path.with_suffix(".compact.joblib")
+
+
+def get_artifact_file_paths(version: Optional[str] = None) -> List[Path]:
+    """Returns the paths of all artifacts of the version: the pipeline file, the flattened forest and the compact one."""
+    pipeline_file_path = get_pipeline_file_path(version)
+
+    return [
+        pipeline_file_path,
+        get_flat_forest_file_path(pipeline_file_path),
+        get_compact_artifact_file_path(pipeline_file_path),
+    ]
+
+
+def get_pinned_artifact_file_paths(version: Optional[str] = None) -> List[Path]:
+    """
+    Returns the artifacts that may not be evicted from the models directory while the artifacts of the version, by
+    default the package version, are saved or loaded: those of the version itself and those of the version the API
+    serves by default.
+    """
+    default_version = config.serving_config.default_model_version or package_version
+
+    return get_artifact_file_paths(version) + get_artifact_file_paths(default_version)
+
+
+def get_model_file_path(version: Optional[str] = None) -> Path:
+    """Returns the path of the artifact the API serves, which depends on the configured artifact format."""
+    pipeline_file_path = get_pipeline_file_path(version)
+    if config.serving_config.model_artifact_format == "compact":
+        return get_compact_artifact_file_path(pipeline_file_path)
+
+    return pipeline_file_path
+
+
+def list_model_versions() -> List[str]:
+    """Returns the versions of which an artifact is in the trained models directory."""
+    prefix = config.app_config.pipeline_save_file + '_'
+    versions = set()
+    for file_name in os.listdir(TRAINED_MODEL_DIR):
+        for suffix in (".pkl", ".compact.joblib"):
+            version = file_name[len(prefix):-len(suffix)]
+            if file_name.startswith(prefix) and file_name.endswith(suffix) and MODEL_VERSION_PATTERN.fullmatch(version):
+                versions.add(version)
+
+    return sorted(versions)
 
 
 def upload_to_blob(file_path: Path, container_name: str) -> None:
     """Upload a file to Azure Blob Storage."""
 
+    from azure.storage.blob import BlobServiceClient
+    from ml_model.model.model_download import SHA256_METADATA_KEY, file_sha256
+
     connect_str = config.secrets.ml_models_storage_connection_string
     if not connect_str:
         raise ValueError("Azure Storage connection string not found in environment variables.")
@@ -19,11 +106,13 @@ def upload_to_blob(file_path: Path, container_name: str) -> None:
     blob_client = blob_service_client.get_blob_client(container=container_name, blob=file_path.name)
 
     with open(file_path, "rb") as data:
-        blob_client.upload_blob(data, overwrite=True)
+        # The checksum lets downloads verify that they received the complete artifact
+        blob_client.upload_blob(data, overwrite=True, metadata={SHA256_METADATA_KEY: file_sha256(file_path)})
 
     logging.info(f"Uploaded model to Azure Blob Storage: {container_name}/{file_path.name}")
 
-def save_pipeline(pipeline: Pipeline):
+
+def save_pipeline(pipeline: "Pipeline"):
     """
     Save the fitted pipeline to a directory specified in the configuration file.
 
@@ -31,59 +120,110 @@ def save_pipeline(pipeline: Pipeline):
     - pipeline: The fitted pipeline object to save.
 
     The function will check if a pipeline file already exists in the directory.
-    If it does, the existing file will be replaced with the new pipeline.
+    If it does, the existing file will be replaced with the new pipeline. The artifacts of other versions are kept, so
+    they can still be served, up to the configured size of the models directory.
     """
 
     # Fetch the directory from the configuration
-    file_name = config.app_config.pipeline_save_file + '_' + package_version + '.pkl'
-    file_path = TRAINED_MODEL_DIR / file_name
+    file_path = get_pipeline_file_path()
+    file_name = file_path.name
     save_dir = file_path.parent
 
-    # Check if there is already a pipeline file in the directory
-    if os.path.exists(save_dir):
-        for file in os.listdir(save_dir):
-            if file.endswith(".pkl"):
-                # Remove the existing pipeline file
-                os.remove(os.path.join(save_dir, file))
-
-    # Save the new pipeline locally
-    joblib.dump(pipeline, file_path)
+    # Save the new pipeline locally. The pipeline is written to a temporary file first and then moved into
+    # place, so a running API process never picks up a half written artifact.
+    compress = config.serving_config.model_artifact_compression
+    temp_path = file_path.with_suffix(".pkl.tmp")
+    joblib.dump(pipeline, temp_path, compress=("zlib", compress) if compress else 0)
+    os.replace(temp_path, file_path)
     logging.info(f"Pipeline saved as {file_name} in {save_dir}")
 
-    # Save the pipeline in a blob container
-    try:
-        upload_to_blob(file_path, container_name="ml-models")
-    except Exception as e:
-        logging.error(f"Failed to upload model to blob storage: {e}")
+    saved_files = [file_path]
+    if config.serving_config.model_artifact_format == "compact":
+        saved_files.append(save_compact_artifact(pipeline, get_compact_artifact_file_path(file_path), compress))
 
+    # Remove the least recently used artifacts of other versions when the models directory has grown too large
+    from ml_model.model.model_download import ArtifactCache
 
-def download_model_if_missing(model_path: Path) -> None:
-    if model_path.exists():
-        return
+    cache = ArtifactCache(save_dir, max_bytes=config.serving_config.model_cache_max_bytes)
+    cache.evict(keep=get_pinned_artifact_file_paths())
 
-    logging.info("Model not found locally. Downloading from blob storage...")
+    # Save the pipeline, and the compact artifact if there is one, in a blob container
+    for saved_file in saved_files:
+        try:
+            upload_to_blob(saved_file, container_name="ml-models")
+        except Exception as e:
+            logging.error(f"Failed to upload model to blob storage: {e}")
+
+
+def save_compact_artifact(pipeline: "Pipeline", file_path: Path, compress: int = 0) -> Path:
+    """
+    Saves the preprocessing steps and the compacted flat forest of the pipeline in one file. The API can serve this
+    artifact without unpickling the scikit-learn forest. Without compression, the forest arrays are memory mapped when
+    the artifact is loaded.
+    """
+    from ml_model.model.flat_forest import compact_flat_forest, flatten_forest, save_arrays
+
+    flat_forest = compact_flat_forest(flatten_forest(pipeline[-1]))
+    save_arrays({"preprocessing": pipeline[:-1], **flat_forest.to_arrays()}, file_path, compress)
+    logging.info(f"Compact artifact saved as {file_path.name} in {file_path.parent}")
+
+    return file_path
+
+
+def load_compact_artifact(file_path: Path, mmap: bool = True) -> Tuple["Pipeline", "FlatForest"]:
+    """Loads the preprocessing steps and the flat forest saved by save_compact_artifact."""
+    from ml_model.model.flat_forest import FlatForest, load_arrays
 
-    blob_service_client = BlobServiceClient.from_connection_string(
-        config.secrets.ml_models_storage_connection_string
+    payload = load_arrays(file_path, mmap)
+    preprocessing = payload.pop("preprocessing")
+
+    return preprocessing, FlatForest(**payload)
+
+
+def export_flat_forest(pipeline: "Pipeline") -> Path:
+    """
+    Flattens the forest of the fitted pipeline into contiguous node arrays and saves them next to the pipeline file,
+    so the API can evaluate the forest with the compiled FlatForest evaluator.
+    """
+    from ml_model.model.flat_forest import compact_flat_forest, flatten_forest, save_flat_forest
+
+    file_path = get_flat_forest_file_path(get_pipeline_file_path())
+    save_flat_forest(
+        compact_flat_forest(flatten_forest(pipeline[-1])),
+        file_path,
+        compress=config.serving_config.model_artifact_compression
     )
-    container_client = blob_service_client.get_container_client("ml-models")
-    blob_client = container_client.get_blob_client(model_path.name)
+    logging.info(f"Flattened forest saved as {file_path.name} in {file_path.parent}")
 
-    # Ensure the directory exists before saving
-    model_path.parent.mkdir(parents=True, exist_ok=True)
+    return file_path
 
-    with open(model_path, "wb") as f:
-        blob_data = blob_client.download_blob()
-        content = blob_data.readall()
-        logging.info(f"Downloaded blob content size: {len(content)} bytes")
-        f.write(content)
-        f.flush()
-        os.fsync(f.fileno())  # Make sure everything is flushed to disk
 
+def download_model_if_missing(model_path: Path, version: Optional[str] = None) -> None:
+    """
+    Downloads the artifact of the version from blob storage if it is not on disk yet. The download is chunked,
+    resumable and verified against the checksum stored with the blob, and the artifacts of several versions are kept in
+    the model directory up to the configured cache size. The artifacts of the version and of the default version are
+    never evicted to make room for the download.
+    """
+    from ml_model.model.model_download import ArtifactCache, AzureBlobSource
+
+    cache = ArtifactCache(
+        model_path.parent,
+        max_bytes=config.serving_config.model_cache_max_bytes,
+        chunk_bytes=config.serving_config.model_download_chunk_bytes,
+        max_workers=config.serving_config.model_download_workers
+    )
+    if model_path.exists():
+        cache.touch(model_path)
+        return
+
+    logging.info("Model not found locally. Downloading from blob storage...")
+    source = AzureBlobSource(config.secrets.ml_models_storage_connection_string, container_name="ml-models")
+    cache.fetch(source, model_path.name, keep=get_pinned_artifact_file_paths(version))
     logging.info("Model downloaded.")
 
 
-def load_pipeline() -> Pipeline:
+def load_pipeline() -> "Pipeline":
     """
     Load a fitted pipeline from a directory specified in the configuration file.
 
@@ -95,8 +235,7 @@ def load_pipeline() -> Pipeline:
     """
 
     # Fetch the directory and file name from the configuration
-    file_name = config.app_config.pipeline_save_file + '_' + package_version + '.pkl'
-    file_path = TRAINED_MODEL_DIR / file_name
+    file_path = get_pipeline_file_path()
 
     download_model_if_missing(file_path)
 
@@ -106,3 +245,340 @@ def load_pipeline() -> Pipeline:
     logging.info(f"Pipeline loaded from {file_path}")
 
     return pipeline
+
+
+def estimate_pipeline_nbytes(pipeline: "Pipeline") -> int:
+    """
+    Estimates the memory footprint of the fitted pipeline. The tree arrays of the forest make up nearly all of
+    the memory used by the pipeline, so only those are counted.
+    """
+    nbytes = 0
+    for _, step in pipeline.steps:
+        for estimator in getattr(step, "estimators_", []):
+            tree = getattr(estimator, "tree_", None)
+            if tree is None:
+                continue
+            state = tree.__getstate__()
+            nbytes += state["nodes"].nbytes + state["values"].nbytes
+
+    return nbytes
+
+
+def get_file_signature(file_path: Path) -> Optional[Tuple[int, int]]:
+    """Returns the modification time and size of a file, or None if the file does not exist."""
+    try:
+        stat = file_path.stat()
+    except FileNotFoundError:
+        return None
+
+    return stat.st_mtime_ns, stat.st_size
+
+
+def build_flat_forest_pipeline(pipeline: "Pipeline", pipeline_file_path: Path) -> "FlatForestPipeline":
+    """
+    Combines the pipeline with its flattened forest. The exported forest is used when it belongs to this pipeline,
+    otherwise the forest is flattened in memory.
+    """
+    from ml_model.model.flat_forest import compact_flat_forest, flatten_forest, forest_fingerprint, load_flat_forest
+
+    fingerprint = forest_fingerprint(pipeline[-1])
+    file_path = get_flat_forest_file_path(pipeline_file_path)
+    flat_forest = load_flat_forest(file_path) if file_path.exists() else None
+
+    if flat_forest is None or flat_forest.fingerprint != fingerprint:
+        logging.info("No exported flattened forest found for this pipeline. Flattening the forest in memory.")
+        flat_forest = compact_flat_forest(flatten_forest(pipeline[-1]))
+
+    return make_flat_forest_pipeline(pipeline[:-1], flat_forest)
+
+
+def make_flat_forest_pipeline(preprocessing: "Pipeline", flat_forest: "FlatForest") -> "FlatForestPipeline":
+    """
+    Combines the preprocessing steps with the flat forest and compiles the evaluator. If enabled, the preprocessing
+    steps are replaced by their fused transform when it gives exactly the same output.
+    """
+    from ml_model.model.flat_forest import FlatForestPipeline
+    from ml_model.model.fused_preprocessing import compile_preprocessing
+
+    flat_forest.warm_up()
+    if config.serving_config.use_fused_preprocessing:
+        preprocessing = compile_preprocessing(preprocessing) or preprocessing
+
+    return FlatForestPipeline(preprocessing, flat_forest)
+
+
+@dataclass(frozen=True)
+class LoadedModel:
+    """
+    A fitted pipeline together with information about the artifact it was loaded from. Compact artifacts do not contain
+    the scikit-learn forest, so for those the pipeline is the FlatForestPipeline that is also used as predictor.
+    """
+
+    pipeline: "Union[Pipeline, FlatForestPipeline]"
+    predictor: "Union[Pipeline, FlatForestPipeline]"
+    file_path: Path
+    version: str
+    file_signature: Tuple[int, int]
+    load_seconds: float
+    artifact_bytes: int
+    memory_bytes: int
+    loaded_at: float
+
+
+class ModelRegistry:
+    """
+    Keeps a single fitted pipeline in memory that is shared by all threads of the process.
+
+    The pipeline is loaded on first use. Afterwards, the artifact on disk is checked at most once every
+    `check_interval` seconds. When it has changed, the new artifact is loaded by the thread that noticed the change
+    and swapped in with a single reference assignment. Other threads keep using the previous pipeline in the
+    meantime, so requests that are already running are never blocked or interrupted by a reload.
+    """
+
+    def __init__(self, file_path: Optional[Path] = None, check_interval: float = 5.0, version: Optional[str] = None):
+        self._file_path = file_path
+        self.version = validate_model_version(version or package_version)
+        self.check_interval = check_interval
+        self._current: Optional[LoadedModel] = None
+        self._last_check = 0.0
+        self._load_lock = threading.Lock()
+        self._load_count = 0
+        self._failed_reload_count = 0
+
+    @property
+    def file_path(self) -> Path:
+        return self._file_path or get_model_file_path(self.version)
+
+    def get(self) -> LoadedModel:
+        """Returns the current model, loading it first if needed."""
+        current = self._current
+        if current is None:
+            return self._load_initial()
+
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return current
+        self._last_check = now
+
+        signature = get_file_signature(self.file_path)
+        if signature is None or signature == current.file_signature:
+            return current
+
+        # Only one thread reloads. Everyone else keeps serving the current model.
+        if not self._load_lock.acquire(blocking=False):
+            return current
+        try:
+            if self._current is not None and self._current.file_signature == signature:
+                return self._current
+            try:
+                self._current = self._load()
+                logging.info(f"Swapped in new model artifact from {self.file_path}")
+            except Exception as e:
+                self._failed_reload_count += 1
+                logging.error(f"Failed to reload model artifact, keeping the current model: {e}")
+        finally:
+            self._load_lock.release()
+
+        return self._current
+
+    def get_pipeline(self) -> "Pipeline":
+        """Returns the current fitted pipeline."""
+        return self.get().pipeline
+
+    def get_predictor(self) -> "Union[Pipeline, FlatForestPipeline]":
+        """Returns the object that should be used to make predictions with the current pipeline."""
+        return self.get().predictor
+
+    def prewarm(self) -> threading.Thread:
+        """Loads the model in a background thread, so it is ready before the first request arrives."""
+        def load():
+            try:
+                self.get()
+            except Exception as e:
+                logging.error(f"Failed to pre-warm the model, it will be loaded on first use: {e}")
+
+        thread = threading.Thread(target=load, name="model-prewarm", daemon=True)
+        thread.start()
+
+        return thread
+
+    def reload(self) -> LoadedModel:
+        """Loads the artifact from disk and swaps it in, regardless of whether it has changed."""
+        with self._load_lock:
+            self._current = self._load()
+            self._last_check = time.monotonic()
+
+        return self._current
+
+    def clear(self) -> None:
+        """Drops the loaded model. The next call to `get` loads it again."""
+        with self._load_lock:
+            self._current = None
+
+    def metrics(self) -> dict:
+        """Returns information about the loaded model and the load history of this registry."""
+        current = self._current
+        metrics = {
+            "loaded": current is not None,
+            "load_count": self._load_count,
+            "failed_reload_count": self._failed_reload_count,
+        }
+        if current is not None:
+            metrics.update({
+                "file_path": str(current.file_path),
+                "version": current.version,
+                "load_seconds": current.load_seconds,
+                "artifact_bytes": current.artifact_bytes,
+                "memory_bytes": current.memory_bytes,
+                "loaded_at": current.loaded_at,
+            })
+
+        return metrics
+
+    def _load_initial(self) -> LoadedModel:
+        with self._load_lock:
+            if self._current is None:
+                self._current = self._load()
+                self._last_check = time.monotonic()
+
+            return self._current
+
+    def _load(self) -> LoadedModel:
+        file_path = self.file_path
+        download_model_if_missing(file_path, self.version)
+
+        # Take the signature before loading, so a file that changes during the load is picked up on the next check.
+        signature = get_file_signature(file_path)
+
+        logging.info(f"Loading model from {file_path}...")
+        start = time.perf_counter()
+        if file_path.name.endswith(".compact.joblib"):
+            preprocessing, flat_forest = load_compact_artifact(file_path)
+        else:
+            pipeline = joblib.load(file_path)
+        load_seconds = time.perf_counter() - start
+        self._load_count += 1
+        MODEL_LOAD_SECONDS.observe(load_seconds)
+        logging.info(f"Model loaded from {file_path} in {load_seconds:.2f} seconds")
+
+        if file_path.name.endswith(".compact.joblib"):
+            pipeline = predictor = make_flat_forest_pipeline(preprocessing, flat_forest)
+            memory_bytes = flat_forest.nbytes
+        else:
+            predictor = pipeline
+            memory_bytes = estimate_pipeline_nbytes(pipeline)
+            if config.serving_config.use_flat_forest:
+                predictor = build_flat_forest_pipeline(pipeline, file_path)
+                memory_bytes += predictor.flat_forest.nbytes
+
+        return LoadedModel(
+            pipeline=pipeline,
+            predictor=predictor,
+            file_path=file_path,
+            version=self.version,
+            file_signature=signature,
+            load_seconds=load_seconds,
+            artifact_bytes=signature[1],
+            memory_bytes=memory_bytes,
+            loaded_at=time.time(),
+        )
+
+
+class ModelPool:
+    """
+    Keeps the models of several versions in memory, each in its own ModelRegistry. A version is loaded on first use.
+    When the loaded models take up more than `max_bytes`, the least recently used versions are unloaded until they
+    fit again. Requests that are still using an unloaded model keep it alive until they are done.
+    """
+
+    def __init__(self, default_version: str, max_bytes: int, check_interval: float = 5.0):
+        self.default_version = validate_model_version(default_version)
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self._registries: "OrderedDict[str, ModelRegistry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.eviction_count = 0
+
+    def resolve(self, version: Optional[str] = None) -> str:
+        """Returns the version that serves a request for `version`. Raises a ValueError for invalid versions."""
+        return validate_model_version(version) if version else self.default_version
+
+    def registry(self, version: Optional[str] = None) -> ModelRegistry:
+        """Returns the registry of the version, marking it as the most recently used one."""
+        version = self.resolve(version)
+        with self._lock:
+            registry = self._registries.get(version)
+            if registry is None:
+                registry = self._registries[version] = ModelRegistry(
+                    check_interval=self.check_interval, version=version
+                )
+            self._registries.move_to_end(version)
+
+        return registry
+
+    def get(self, version: Optional[str] = None) -> LoadedModel:
+        """Returns the model of the version, by default the default version, loading it first if needed."""
+        registry = self.registry(version)
+        try:
+            model = registry.get()
+        except Exception:
+            # Forget versions that could not be loaded, so requests for unknown versions do not pile up registries
+            with self._lock:
+                if registry.version != self.default_version and not registry.metrics()["loaded"]:
+                    self._registries.pop(registry.version, None)
+            raise
+        self._evict(keep=registry)
+
+        return model
+
+    def available_versions(self) -> List[str]:
+        """Returns the versions that are loaded or whose artifacts are on disk."""
+        with self._lock:
+            loaded = [version for version, registry in self._registries.items() if registry.metrics()["loaded"]]
+
+        return sorted(set(loaded) | set(list_model_versions()))
+
+    def metrics(self) -> dict:
+        with self._lock:
+            loaded = {
+                version: registry.metrics()
+                for version, registry in self._registries.items() if registry.metrics()["loaded"]
+            }
+
+        return {
+            "default_version": self.default_version,
+            "loaded_versions": loaded,
+            "memory_bytes": sum(model["memory_bytes"] for model in loaded.values()),
+            "max_bytes": self.max_bytes,
+            "eviction_count": self.eviction_count,
+        }
+
+    def _evict(self, keep: ModelRegistry) -> None:
+        evicted = []
+        with self._lock:
+            loaded = [registry for registry in self._registries.values() if registry.metrics()["loaded"]]
+            total_bytes = sum(registry.metrics()["memory_bytes"] for registry in loaded)
+            # Least recently used first
+            for registry in loaded:
+                if total_bytes <= self.max_bytes:
+                    break
+                if registry is keep:
+                    continue
+                total_bytes -= registry.metrics()["memory_bytes"]
+                evicted.append(registry)
+            self.eviction_count += len(evicted)
+
+        # Clearing waits for a load of the registry in progress, which should not block the pool for all versions
+        for registry in evicted:
+            registry.clear()
+            logging.info(f"Unloaded model version {registry.version} to stay within the memory budget")
+
+
+# Process wide pool. All threads of the API share the models loaded by this pool.
+model_pool = ModelPool(
+    default_version=config.serving_config.default_model_version or package_version,
+    max_bytes=config.serving_config.model_pool_max_bytes,
+)
+
+# Registry of the default version
+model_registry = model_pool.registry()
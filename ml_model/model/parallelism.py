@@ -0,0 +1,120 @@
+"""
+This file contains the parallelism budget of the prediction path. Every prediction runs on the thread that asks for
+it, once the budget has a thread free for it. A large batch is also split into row shards that are predicted on helper
+threads at the same time, but only on as many threads as there are idle cores. The calling threads and the helper
+threads together never exceed the budget: when it is used up, a request waits for a thread to become free instead of
+oversubscribing the cores. On a quiet server a large upload uses all cores, while on a busy server every request
+predicts on its own thread only, so the throughput does not drop.
+
+Rows are predicted independently of each other, so the predictions of a sharded batch are identical to those of a
+single call. The flat forest evaluator and the trees of scikit-learn release the GIL while walking the trees.
+
+Native thread pools, like those of BLAS and OpenMP, are limited with threadpoolctl, so libraries do not start threads
+of their own on top of the budget.
+"""
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import numpy as np
+import pandas as pd
+from typing import Callable, Iterator, Union
+from ml_model.config.dynamic_config import config
+
+
+class ParallelismBudget:
+    """Hands out at most `max_threads` prediction threads, including the threads of the requests themselves."""
+
+    def __init__(self, max_threads: int):
+        self.max_threads = max(1, max_threads)
+        self._active_threads = 0
+        self._released = threading.Condition()
+        # Threads are only started when work is submitted, so the pool can be created before the server forks
+        self._helpers = (
+            ThreadPoolExecutor(self.max_threads - 1, thread_name_prefix="predict-shard")
+            if self.max_threads > 1 else None
+        )
+
+    @property
+    def active_threads(self) -> int:
+        return self._active_threads
+
+    @contextmanager
+    def reserve(self, wanted: int) -> Iterator[int]:
+        """
+        Reserves up to `wanted` threads, including the calling thread, while the block runs and yields the number of
+        threads granted. Waits until at least one thread is free.
+        """
+        with self._released:
+            self._released.wait_for(lambda: self._active_threads < self.max_threads)
+            granted = min(max(1, wanted), self.max_threads - self._active_threads)
+            self._active_threads += granted
+        try:
+            yield granted
+        finally:
+            with self._released:
+                self._active_threads -= granted
+                self._released.notify_all()
+
+    def predict(
+            self,
+            predict_fn: Callable[[Union[pd.DataFrame, np.ndarray]], np.ndarray],
+            X: Union[pd.DataFrame, np.ndarray],
+            min_rows_per_shard: int
+    ) -> np.ndarray:
+        """
+        Calls `predict_fn` on the rows of X, split into shards of at least `min_rows_per_shard` rows over the threads
+        the budget grants. The results of the shards are concatenated in row order.
+        """
+        wanted = max(1, len(X) // max(1, min_rows_per_shard))
+        with self.reserve(wanted) as n_threads:
+            if n_threads == 1:
+                return predict_fn(X)
+
+            bounds = np.linspace(0, len(X), n_threads + 1).astype(int)
+            shards = [
+                X.iloc[start:stop] if isinstance(X, pd.DataFrame) else X[start:stop]
+                for start, stop in zip(bounds[:-1], bounds[1:])
+            ]
+            # The calling thread predicts the first shard itself
+            futures = [self._helpers.submit(predict_fn, shard) for shard in shards[1:]]
+            try:
+                results = [predict_fn(shards[0])]
+            finally:
+                # The threads stay reserved until every shard is done, also when one of them failed
+                wait(futures)
+
+            return np.concatenate(results + [future.result() for future in futures])
+
+
+def limit_native_threads(n_threads: int) -> None:
+    """Limits the thread pools of native libraries, like BLAS and OpenMP, to `n_threads` threads each."""
+    from threadpoolctl import threadpool_limits
+
+    threadpool_limits(limits=n_threads)
+    logging.info(f"Native thread pools limited to {n_threads} threads")
+
+
+def default_prediction_threads() -> int:
+    """
+    Returns the budget of a worker process when prediction_threads is 0: the CPU cores divided over the worker
+    processes, at least one thread. api.serve sets serving_workers to the number of workers it forks before the app is
+    imported. Otherwise the app runs in a single process.
+    """
+    workers = max(1, config.serving_config.serving_workers)
+
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+# Process wide budget, shared by all requests. Every thread that predicts, like the executor threads and the
+# micro-batcher, counts against it, so the budget is the total over all of them.
+parallelism_budget = ParallelismBudget(config.serving_config.prediction_threads or default_prediction_threads())
+
+
+def predict_in_parallel(
+        predict_fn: Callable[[Union[pd.DataFrame, np.ndarray]], np.ndarray],
+        X: Union[pd.DataFrame, np.ndarray]
+) -> np.ndarray:
+    """Predicts the rows of X with the process wide budget. See ParallelismBudget.predict."""
+    return parallelism_budget.predict(predict_fn, X, config.serving_config.prediction_min_rows_per_shard)
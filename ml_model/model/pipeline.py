@@ -55,6 +55,7 @@ wine_pipeline = Pipeline(
 
         # --- Classification --- #
         ('classifier', RandomForestClassifier(n_estimators=config.ml_model_config.n_estimators,
+                                              n_jobs=config.ml_model_config.n_jobs,
                                               random_state=config.ml_model_config.random_state))
 
     ]
@@ -1,21 +1,33 @@
 from dataclasses import dataclass
+from functools import partial
 import logging
 import os
+import numpy as np
 import pandas as pd
-import threading
-from typing import Union
+from typing import Dict, IO, List, Optional, Tuple, Union
 from ml_model.config.dynamic_config import config
-from ml_model import __version__ as package_version
-from ml_model.model.data_utils import clean_raw_data, load_dataset
+from ml_model.model.data_utils import (
+    clean_raw_data,
+    format_feature_names,
+    load_dataset,
+    load_dataset_from_buffer,
+    load_dataset_in_chunks
+)
 from ml_model.model.data_validation import validate_data
-from ml_model.model.model_utils import load_pipeline
+from ml_model.model.metrics import ROWS_TOTAL, STAGE_SECONDS, TASKS_TOTAL
+from ml_model.model.micro_batching import MicroBatcher
+from ml_model.model.model_utils import model_pool
+from ml_model.model.parallelism import predict_in_parallel
+from ml_model.model.prediction_cache import PredictionCache
+from ml_model.model.profiling import profile_slow_request
+from ml_model.model.task_store import TaskStore
 
 
 logging.basicConfig(level=logging.INFO)
 
 
-def predict(input_data: Union[pd.DataFrame, dict]) -> dict:
-    """Make prediction using a saved ML model given input data."""
+def predict(input_data: Union[pd.DataFrame, dict], version: Optional[str] = None) -> dict:
+    """Make prediction using a saved ML model given input data. Uses the default model version unless one is given."""
 
     logging.info("converting input data into pd dataframe...")
     # Convert input data to dataframe
@@ -23,75 +35,273 @@ def predict(input_data: Union[pd.DataFrame, dict]) -> dict:
         input_data = pd.DataFrame(input_data)
     logging.info("converting input data into pd dataframe -- DONE")
 
-    # Make predictions
-    logging.info("loading the pipeline...")
-    pipeline = load_pipeline()
-    logging.info("Pipeline loaded!")
-
     logging.info("Making predictions...")
-    predictions = pipeline.predict(
-        X=input_data[config.ml_model_config.features]
-    )
+    version = model_pool.resolve(version)
+    predictions = predict_labels(input_data, version)
     logging.info("Predictions have been made!")
 
     results = {
         "predictions": predictions.tolist(),
-        "version": package_version,
+        "version": version,
     }
 
     return results
 
 
+# Caches the predictions of rows that were predicted before with the same model.
+prediction_cache = (
+    PredictionCache(
+        max_entries=config.serving_config.prediction_cache_max_entries,
+        disk_path=config.serving_config.prediction_cache_path or None
+    )
+    if config.serving_config.prediction_cache_max_entries > 0 else None
+)
+
+
+def predict_labels(input_data: pd.DataFrame, version: Optional[str] = None) -> np.ndarray:
+    """Predicts the quality of every row of validated input data with the given model version, or the default one."""
+    # The pipeline is loaded once per process and shared between threads.
+    model = model_pool.get(version)
+    features = input_data[config.ml_model_config.features]
+    # The cache is cleared whenever the model changes, so it only holds the predictions of the default version
+    # Large batches are predicted on several cores when they are idle
+    predict_fn = partial(predict_in_parallel, model.predictor.predict)
+    if prediction_cache is None or model.version != model_pool.default_version:
+        return predict_fn(features)
+
+    # The artifact's signature changes with every new model file, also when the package version stays the same
+    model_key = f"{model.version}:{model.file_path.name}:{model.file_signature}"
+    return prediction_cache.predict(features, predict_fn, model_key)
+
+
+# Combines concurrent requests of the synchronous prediction endpoint into a single call to the pipeline.
+micro_batcher = MicroBatcher(
+    predict_fn=predict_labels,
+    max_batch_size=config.serving_config.micro_batch_max_size,
+    max_wait_ms=config.serving_config.micro_batch_max_wait_ms,
+)
+
+
+# What a prediction returns: the predicted class, the probability of every class, or the k most likely classes
+OUTPUT_MODES = ("labels", "proba", "topk")
+
+
+def predict_probabilities(input_data: pd.DataFrame, version: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the classes of the model and the probability of every class for every row of validated input data."""
+    predictor = model_pool.get(version).predictor
+    probabilities = predict_in_parallel(predictor.predict_proba, input_data[config.ml_model_config.features])
+
+    return predictor.classes_, probabilities
+
+
+def predict_columns(
+        input_data: pd.DataFrame,
+        output: str = "labels",
+        k: int = 3,
+        version: Optional[str] = None
+) -> Dict[str, np.ndarray]:
+    """
+    Predicts every row of validated input data and returns the output as named columns, one array per column:
+
+    - labels: "prediction" holds the predicted class.
+    - proba: "proba_<class>" holds the probability of every class.
+    - topk: "class_<rank>" and "score_<rank>" hold the k most likely classes and their probabilities.
+    """
+    if output == "labels":
+        return {"prediction": predict_labels(input_data, version)}
+
+    classes, probabilities = predict_probabilities(input_data, version)
+    if output == "proba":
+        return {f"proba_{label}": probabilities[:, i] for i, label in enumerate(classes.tolist())}
+
+    if output == "topk":
+        # A stable sort keeps the order of the classes for equal probabilities, like argmax does
+        top = np.argsort(-probabilities, axis=1, kind="stable")[:, :k]
+        top_scores = np.take_along_axis(probabilities, top, axis=1)
+        columns = {}
+        for rank in range(top.shape[1]):
+            columns[f"class_{rank + 1}"] = classes.take(top[:, rank])
+            columns[f"score_{rank + 1}"] = top_scores[:, rank]
+        return columns
+
+    raise ValueError(f"Unknown output mode {output!r}. Use one of {', '.join(OUTPUT_MODES)}.")
+
+
+def validate_and_predict_records(
+        records: List[dict],
+        output: str = "labels",
+        k: int = 3,
+        version: Optional[str] = None
+) -> Tuple[Optional[Dict[str, np.ndarray]], Optional[str]]:
+    """
+    Validates a list of records and predicts them. Labels of the default model version are predicted through the
+    micro-batcher, other versions are predicted directly. The records do not need to contain the target. Returns the
+    output columns (see predict_columns), or the validation errors if the records are invalid.
+    """
+    input_data = pd.DataFrame.from_records(records)
+    input_data.columns = [format_feature_names(col) for col in input_data.columns]
+    with STAGE_SECONDS.time(stage="validate"):
+        valid_data, errors = validate_data(input_data, require_target=False)
+
+    if errors:
+        ROWS_TOTAL.inc(len(input_data), outcome="rejected")
+        return None, errors
+
+    with STAGE_SECONDS.time(stage="predict"):
+        if output == "labels" and model_pool.resolve(version) == model_pool.default_version:
+            columns = {"prediction": micro_batcher.predict(valid_data)}
+        else:
+            columns = predict_columns(valid_data, output, k, version)
+    ROWS_TOTAL.inc(len(valid_data), outcome="predicted")
+
+    return columns, None
+
+
 # NOTE:
 # This TaskContext is defined as a standard @dataclass instead of a Pydantic model.
-# This is intentional: Pydantic models may copy or wrap mutable fields (like dicts and locks),
-# which breaks shared state between threads (e.g., updating task_results in main.py).
+# This is intentional: Pydantic models may copy or wrap mutable fields (like the task store and its locks),
+# which breaks shared state between threads (e.g., updating task results in main.py).
 # Using a dataclass ensures that all fields are passed by reference and updates are preserved.
 @dataclass
 class TaskContext:
     task_id: str
-    status_lock: threading.Lock
-    processing_status: dict
-    task_results: dict
-    task_results_lock: threading.Lock
-    temp_file_name: str
+    task_store: TaskStore
+    temp_file_name: Optional[str] = None
+    output: str = "labels"
+    k: int = 3
+    # Model version that predicts the task. None means the default version.
+    version: Optional[str] = None
 
 
 def handle_context_errors(context: TaskContext, errors: dict) -> dict:
-    with context.status_lock:
-        context.processing_status[context.task_id] = f"failed: {str(errors)}"
-    with context.task_results_lock:
-        context.task_results[context.task_id] = {"status": "failed", "error": str(errors)}
+    TASKS_TOTAL.inc(status="failed")
+    context.task_store.update(
+        context.task_id,
+        status=f"failed: {str(errors)}",
+        result={"status": "failed", "error": str(errors)}
+    )
 
     return {"errors": errors}
 
 
 def make_predictions(context: TaskContext, valid_data: pd.DataFrame) -> dict:
-    results = predict(valid_data)
+    with STAGE_SECONDS.time(stage="predict"):
+        if context.output == "labels":
+            results = predict(valid_data, context.version)
+        else:
+            # Probabilities are kept as arrays in a file instead of as lists in the task store
+            output_file_name = os.path.join(config.serving_config.results_dir, f"{context.task_id}.npz")
+            os.makedirs(config.serving_config.results_dir, exist_ok=True)
+            np.savez(output_file_name, **predict_columns(valid_data, context.output, context.k, context.version))
+            results = {
+                "output_file": output_file_name,
+                "n_predictions": len(valid_data),
+                "version": model_pool.resolve(context.version),
+            }
+    ROWS_TOTAL.inc(len(valid_data), outcome="predicted")
     logging.info(f"Results gathered for task {context.task_id}")
-    with context.status_lock:
-        context.processing_status[context.task_id] = "completed"
-    with context.task_results_lock:
-        context.task_results[context.task_id] = results
+    context.task_store.update(context.task_id, status="completed", result=results)
+    TASKS_TOTAL.inc(status="completed")
 
     return results
 
 
-def clean_validate_and_predict(context: TaskContext, file_path: str) -> dict:
+def clean_validate_and_predict(context: TaskContext, source: Union[str, IO]) -> dict:
+    """
+    Cleans, validates and predicts an upload. The upload is either the path of a file it was spooled to, which is
+    always removed afterwards, or an in-memory buffer holding it.
+    """
+    try:
+        with profile_slow_request(f"task-{context.task_id}"):
+            return _clean_validate_and_predict(context, source)
+    except Exception as e:
+        logging.error(f"Processing failed for task {context.task_id}: {e}")
+        return handle_context_errors(context, str(e))
+    finally:
+        # Ensure temporary file is deleted, whether the upload was valid or not
+        if isinstance(source, str) and os.path.exists(source):
+            os.remove(source)
+
+
+def _clean_validate_and_predict(context: TaskContext, source: Union[str, IO]) -> dict:
     # Gather data
-    input_data = load_dataset(full_path=file_path)
-    cleaned_data = clean_raw_data(input_data)
-    valid_data, errors = validate_data(cleaned_data)
+    with STAGE_SECONDS.time(stage="load"):
+        if isinstance(source, str):
+            input_data = load_dataset(full_path=source, fast=config.serving_config.fast_csv_ingestion)
+        else:
+            input_data = load_dataset_from_buffer(source, fast=config.serving_config.fast_csv_ingestion)
+    with STAGE_SECONDS.time(stage="clean"):
+        cleaned_data = clean_raw_data(input_data)
+    with STAGE_SECONDS.time(stage="validate"):
+        valid_data, errors = validate_data(cleaned_data)
 
     if errors:
+        ROWS_TOTAL.inc(len(cleaned_data), outcome="rejected")
         return handle_context_errors(context, errors)
 
     logging.info(f"Input data valid for task {context.task_id}. Making predictions.")
     results = make_predictions(context, valid_data)
     logging.info(f"predictions made! {results}")
 
-    # Ensure temporary file is deleted
-    if os.path.exists(file_path):
-        os.remove(file_path)
+    return results
+
+
+def clean_validate_and_predict_in_chunks(context: TaskContext, file_path: str, chunk_size: int) -> dict:
+    """
+    Cleans, validates and predicts the uploaded file in chunks of at most `chunk_size` rows, so memory usage stays
+    bounded regardless of the size of the file. The predictions are appended to a file next to the upload, one per
+    line, and the task results refer to that file instead of holding the predictions in memory.
+    """
+    predictions_file_name = f"{file_path}.predictions"
+    processed_rows = 0
+    n_predictions = 0
+    errors = None
+
+    try:
+        with profile_slow_request(f"task-{context.task_id}"), open(predictions_file_name, "w") as predictions_file:
+            chunks = load_dataset_in_chunks(
+                chunk_size, full_path=file_path, fast=config.serving_config.fast_csv_ingestion
+            )
+            while True:
+                with STAGE_SECONDS.time(stage="load"):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                with STAGE_SECONDS.time(stage="clean"):
+                    cleaned_chunk = clean_raw_data(chunk)
+                with STAGE_SECONDS.time(stage="validate"):
+                    valid_chunk, errors = validate_data(cleaned_chunk, row_offset=n_predictions)
+                if errors:
+                    ROWS_TOTAL.inc(len(cleaned_chunk), outcome="rejected")
+                    break
+
+                with STAGE_SECONDS.time(stage="predict"):
+                    predictions = predict_labels(valid_chunk, context.version)
+                predictions_file.write("".join(f"{prediction}\n" for prediction in predictions.tolist()))
+                ROWS_TOTAL.inc(len(predictions), outcome="predicted")
+                n_predictions += len(predictions)
+                processed_rows += len(chunk)
+                context.task_store.update(context.task_id, processed_rows=processed_rows)
+                logging.info(f"Processed {processed_rows} rows for task {context.task_id}")
+    except Exception as e:
+        logging.error(f"Processing failed for task {context.task_id}: {e}")
+        errors = str(e)
+    finally:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    if errors:
+        # The predictions file does not exist when opening it is what failed
+        if os.path.exists(predictions_file_name):
+            os.remove(predictions_file_name)
+        return handle_context_errors(context, errors)
+
+    results = {
+        "predictions_file": predictions_file_name,
+        "n_predictions": n_predictions,
+        "version": model_pool.resolve(context.version),
+    }
+    context.task_store.update(context.task_id, status="completed", result=results)
+    TASKS_TOTAL.inc(status="completed")
 
     return results
@@ -0,0 +1,190 @@
+"""
+This file contains the prediction cache. Customers often send the same wines again, so the predictions are cached
+per row, keyed by a 64-bit hash of the validated feature values and by the model they were made with. Only the rows
+that are not in the cache are sent to the model.
+
+The cache keeps the most recently used rows in memory. Optionally, predictions are also kept in a SQLite file, which
+survives restarts and is shared by the worker processes of the API. Cached predictions are dropped as soon as
+a different model is used.
+"""
+from collections import OrderedDict
+import json
+import logging
+import os
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+
+# Number of hashes per SQLite query, below the limit on the number of query parameters
+DISK_QUERY_BATCH_SIZE = 500
+
+
+def hash_rows(input_data: pd.DataFrame) -> np.ndarray:
+    """
+    Returns a 64-bit hash of the values of every row. The index is ignored, so the same values always give the same
+    hash. With a million cached rows, the chance that two different rows share a hash is about 1 in 30 million.
+    """
+    return pd.util.hash_pandas_object(input_data, index=False).to_numpy()
+
+
+class PredictionCache:
+    """
+    Caches the predictions of individual rows for the model identified by `model_key`. At most `max_entries` rows are
+    kept in memory, evicting the least recently used ones. If `disk_path` is given, the predictions are also kept in a
+    SQLite database at that path.
+    """
+
+    def __init__(self, max_entries: int, disk_path: Optional[Path] = None):
+        self.max_entries = max_entries
+        self.disk_path = Path(disk_path) if disk_path else None
+        self._entries: "OrderedDict[int, object]" = OrderedDict()
+        self._model_key: Optional[str] = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_path is not None:
+            self.disk_path.parent.mkdir(parents=True, exist_ok=True)
+            with self._connection() as connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS predictions ("
+                    "model_key TEXT NOT NULL, row_hash INTEGER NOT NULL, prediction TEXT NOT NULL, "
+                    "PRIMARY KEY (model_key, row_hash))"
+                )
+
+    def predict(
+            self,
+            input_data: pd.DataFrame,
+            predict_fn: Callable[[pd.DataFrame], np.ndarray],
+            model_key: str
+    ) -> np.ndarray:
+        """Returns the predictions of all rows, calling `predict_fn` only for rows that are not in the cache."""
+        self._check_model(model_key)
+        hashes = hash_rows(input_data)
+        cached = self._get_many(hashes)
+
+        # Rows that occur more than once in the input data are predicted once
+        missing = [i for i, row_hash in enumerate(hashes.tolist()) if row_hash not in cached]
+        missing_hashes, first_rows = np.unique(hashes[missing], return_index=True)
+        if len(missing_hashes):
+            predictions = predict_fn(input_data.iloc[np.asarray(missing)[first_rows]])
+            new_entries = dict(zip(missing_hashes.tolist(), predictions.tolist()))
+            self._put_many(new_entries, model_key)
+            cached.update(new_entries)
+
+        with self._lock:
+            self.hits += len(hashes) - len(missing)
+            self.misses += len(missing)
+
+        return np.asarray([cached[row_hash] for row_hash in hashes.tolist()])
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        if self.disk_path is not None:
+            with self._connection() as connection:
+                connection.execute("DELETE FROM predictions")
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _check_model(self, model_key: str) -> None:
+        """Drops the cached predictions when a different model is used."""
+        with self._lock:
+            if model_key == self._model_key:
+                return
+            if self._model_key is not None:
+                logging.info("The model has changed. Clearing the prediction cache.")
+            self._entries.clear()
+            self._model_key = model_key
+
+        if self.disk_path is not None:
+            with self._connection() as connection:
+                connection.execute("DELETE FROM predictions WHERE model_key != ?", (model_key,))
+
+    def _get_many(self, hashes: np.ndarray) -> Dict[int, object]:
+        found = {}
+        with self._lock:
+            for row_hash in hashes.tolist():
+                if row_hash in self._entries:
+                    self._entries.move_to_end(row_hash)
+                    found[row_hash] = self._entries[row_hash]
+
+        if self.disk_path is not None:
+            missing = list({row_hash for row_hash in hashes.tolist() if row_hash not in found})
+            from_disk = self._get_from_disk(missing)
+            with self._lock:
+                self.disk_hits += len(from_disk)
+                self._put_in_memory(from_disk)
+            found.update(from_disk)
+
+        return found
+
+    def _put_many(self, entries: Dict[int, object], model_key: str) -> None:
+        with self._lock:
+            # Predictions of a model that was replaced in the meantime are not cached
+            if model_key != self._model_key:
+                return
+            self._put_in_memory(entries)
+
+        if self.disk_path is not None:
+            with self._connection() as connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO predictions (model_key, row_hash, prediction) VALUES (?, ?, ?)",
+                    [(model_key, _to_signed(row_hash), json.dumps(value)) for row_hash, value in entries.items()]
+                )
+
+    def _put_in_memory(self, entries: Dict[int, object]) -> None:
+        self._entries.update(entries)
+        for row_hash in entries:
+            self._entries.move_to_end(row_hash)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _get_from_disk(self, hashes: list) -> Dict[int, object]:
+        found = {}
+        connection = self._connection()
+        for start in range(0, len(hashes), DISK_QUERY_BATCH_SIZE):
+            batch = hashes[start:start + DISK_QUERY_BATCH_SIZE]
+            rows = connection.execute(
+                f"SELECT row_hash, prediction FROM predictions WHERE model_key = ? "
+                f"AND row_hash IN ({', '.join('?' * len(batch))})",
+                (self._model_key, *(_to_signed(row_hash) for row_hash in batch))
+            ).fetchall()
+            found.update({_to_unsigned(row_hash): json.loads(prediction) for row_hash, prediction in rows})
+
+        return found
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections can not be shared between threads, nor be used in a forked process
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.disk_path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        return connection
+
+
+def _to_signed(row_hash: int) -> int:
+    # SQLite integers are signed 64-bit
+    return row_hash - (1 << 64) if row_hash >= 1 << 63 else row_hash
+
+
+def _to_unsigned(row_hash: int) -> int:
+    return row_hash + (1 << 64) if row_hash < 0 else row_hash
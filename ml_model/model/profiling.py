@@ -0,0 +1,97 @@
+"""
+This file contains a sampling profiler for slow requests. A sampled fraction of the requests is profiled by a
+background thread that records the stack of the request's thread at a fixed interval. The thread being profiled is
+not slowed down by tracing, unlike with cProfile. If the request turns out to be slow, the samples are written as
+folded stacks, one line per distinct stack with the number of times it was seen, which flamegraph.pl, speedscope and
+most other flame graph tools read.
+"""
+from collections import Counter
+from contextlib import contextmanager
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+from ml_model.config.dynamic_config import config
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread every `interval_seconds` until stopped."""
+
+    def __init__(self, thread_id: int, interval_seconds: float):
+        self.thread_id = thread_id
+        self.interval_seconds = interval_seconds
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_seconds):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def write_folded(self, file_path: Path) -> None:
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(file_path, "w") as file:
+            file.writelines(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+@contextmanager
+def profile_if_slow(
+        name: str,
+        sample_rate: float,
+        slow_seconds: float,
+        profile_dir: Path,
+        interval_seconds: float = 0.005
+) -> Iterator[Optional[SamplingProfiler]]:
+    """
+    Profiles the block with probability `sample_rate`. If the block takes at least `slow_seconds`, the samples are
+    written to `<profile_dir>/<name>-<timestamp>.folded`. Yields the profiler, or None if the block is not profiled.
+    """
+    if sample_rate <= 0 or random.random() >= sample_rate:
+        yield None
+        return
+
+    profiler = SamplingProfiler(threading.get_ident(), interval_seconds)
+    start = time.perf_counter()
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        elapsed = time.perf_counter() - start
+        if elapsed >= slow_seconds and profiler.stacks:
+            safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+            file_path = Path(profile_dir) / f"{safe_name}-{time.strftime('%Y%m%dT%H%M%S')}.folded"
+            profiler.write_folded(file_path)
+            logging.info(f"{name} took {elapsed:.2f} seconds. Profile written to {file_path}")
+
+
+def profile_slow_request(name: str):
+    """Profiles a request or task as configured in the serving configuration. See profile_if_slow."""
+    serving_config = config.serving_config
+    return profile_if_slow(
+        name,
+        sample_rate=serving_config.profile_sample_rate,
+        slow_seconds=serving_config.profile_slow_request_seconds,
+        profile_dir=Path(serving_config.profile_dir),
+        interval_seconds=serving_config.profile_interval_ms / 1000,
+    )
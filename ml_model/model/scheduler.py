@@ -0,0 +1,193 @@
+"""
+This file contains the admission scheduler of the prediction tasks. Every task has a cost, the number of rows it
+predicts. A task is only admitted while the rows of the queued and running tasks stay below a limit, so a burst of
+uploads can not grow the queue, its temporary files and the memory without bound. A rejected client is told how long
+to wait before trying again.
+
+Admitted tasks wait in a fair queue. Every task gets a virtual finish time, the finish time of the previous task of
+the same client (or the current virtual time, if the client has no tasks waiting) plus its number of rows. The task
+with the earliest virtual finish time runs first. A client that uploads many large files therefore gets the same
+share of rows as a client with a single small file, instead of delaying it until all of its files are done.
+"""
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+
+class QueueFullError(Exception):
+    """Raised when a task is not admitted because the queue is full."""
+
+    def __init__(self, retry_after_seconds: int):
+        super().__init__(f"The prediction queue is full. Retry after {retry_after_seconds} seconds.")
+        self.retry_after_seconds = retry_after_seconds
+
+
+@dataclass(order=True)
+class Ticket:
+    """A reserved place in the queue. Tickets are ordered by their virtual finish time."""
+
+    finish_tag: float
+    sequence: int
+    task_id: str = field(compare=False)
+    client_id: str = field(compare=False)
+    rows: int = field(compare=False)
+    fn: Optional[Callable[[], object]] = field(default=None, compare=False)
+
+
+class AdmissionScheduler:
+    """
+    Runs admitted tasks on `executor`, at most `max_running` at a time. Tasks are admitted while the queued and
+    running tasks hold at most `max_rows` rows in total and at most `max_queued_tasks` tasks are waiting. A task is
+    always admitted when nothing else is queued or running, however large it is.
+    """
+
+    def __init__(
+            self,
+            executor: Executor,
+            max_running: int,
+            max_rows: int,
+            max_queued_tasks: int,
+            default_retry_after_seconds: float = 5.0
+    ):
+        self.executor = executor
+        self.max_running = max_running
+        self.max_rows = max_rows
+        self.max_queued_tasks = max_queued_tasks
+        self.default_retry_after_seconds = default_retry_after_seconds
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        # Tickets that were reserved but whose task has not been submitted yet, e.g. while the upload is spooled
+        self._reserved: Dict[str, Ticket] = {}
+        self._queue: List[Ticket] = []
+        self._running: Dict[str, Ticket] = {}
+        self._client_finish_tags: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._rows_per_second: Optional[float] = None
+        self.rejected_count = 0
+
+    @property
+    def outstanding_rows(self) -> int:
+        tickets = itertools.chain(self._reserved.values(), self._queue, self._running.values())
+        return sum(ticket.rows for ticket in tickets)
+
+    def reserve(self, task_id: str, client_id: str, rows: int) -> Ticket:
+        """Reserves a place in the queue for a task of `rows` rows. Raises a QueueFullError if it is not admitted."""
+        rows = max(1, rows)
+        with self._lock:
+            outstanding_rows = self.outstanding_rows
+            n_waiting = len(self._reserved) + len(self._queue)
+            if outstanding_rows and (outstanding_rows + rows > self.max_rows or n_waiting >= self.max_queued_tasks):
+                self.rejected_count += 1
+                raise QueueFullError(self._retry_after(outstanding_rows))
+
+            start_tag = max(self._virtual_time, self._client_finish_tags.get(client_id, 0.0))
+            ticket = Ticket(start_tag + rows, next(self._sequence), task_id, client_id, rows)
+            self._client_finish_tags[client_id] = ticket.finish_tag
+            self._reserved[task_id] = ticket
+
+        return ticket
+
+    def resize(self, ticket: Ticket, rows: int) -> None:
+        """
+        Changes the number of rows of a reserved ticket, e.g. once the size of an upload without a Content-Length is
+        known. Raises a QueueFullError and releases the ticket if the task is not admitted with its new size.
+        """
+        rows = max(1, rows)
+        with self._lock:
+            other_rows = self.outstanding_rows - ticket.rows
+            if other_rows and other_rows + rows > self.max_rows:
+                self._reserved.pop(ticket.task_id, None)
+                self.rejected_count += 1
+                raise QueueFullError(self._retry_after(other_rows))
+
+            finish_tag = ticket.finish_tag + rows - ticket.rows
+            if self._client_finish_tags.get(ticket.client_id) == ticket.finish_tag:
+                self._client_finish_tags[ticket.client_id] = finish_tag
+            ticket.finish_tag = finish_tag
+            ticket.rows = rows
+
+    def submit(self, ticket: Ticket, fn: Callable, *args) -> None:
+        """Queues the task of a reserved ticket. It runs as soon as it is the first in line and a worker is free."""
+        with self._lock:
+            del self._reserved[ticket.task_id]
+            ticket.fn = lambda: fn(*args)
+            heapq.heappush(self._queue, ticket)
+        self._dispatch()
+
+    def cancel(self, ticket: Ticket) -> None:
+        """Releases a reserved ticket whose task will not be submitted."""
+        with self._lock:
+            self._reserved.pop(ticket.task_id, None)
+
+    def queue_position(self, task_id: str) -> Optional[int]:
+        """Returns the number of tasks that run before the task (0 means it runs next), or None if it is not queued."""
+        with self._lock:
+            ticket = next((ticket for ticket in self._queue if ticket.task_id == task_id), None)
+            if ticket is None:
+                return None
+
+            return sum(other < ticket for other in self._queue)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "queued_tasks": len(self._reserved) + len(self._queue),
+                "running_tasks": len(self._running),
+                "outstanding_rows": self.outstanding_rows,
+                "max_rows": self.max_rows,
+                "rejected_count": self.rejected_count,
+            }
+
+    def _dispatch(self) -> None:
+        while True:
+            with self._lock:
+                if not self._queue or len(self._running) >= self.max_running:
+                    return
+                ticket = heapq.heappop(self._queue)
+                self._virtual_time = max(self._virtual_time, ticket.finish_tag - ticket.rows)
+                self._running[ticket.task_id] = ticket
+                # Clients whose tasks all started before the current virtual time start from it again
+                self._client_finish_tags = {
+                    client_id: tag for client_id, tag in self._client_finish_tags.items() if tag > self._virtual_time
+                }
+            try:
+                self.executor.submit(self._run, ticket)
+            except Exception:
+                with self._lock:
+                    del self._running[ticket.task_id]
+                raise
+
+    def _run(self, ticket: Ticket) -> None:
+        start = time.perf_counter()
+        try:
+            ticket.fn()
+        except Exception as e:
+            logging.error(f"Task {ticket.task_id} raised an error: {e}")
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                del self._running[ticket.task_id]
+                self._observe_throughput(ticket.rows, elapsed)
+            self._dispatch()
+
+    def _observe_throughput(self, rows: int, elapsed: float) -> None:
+        # Rows per second of all workers together, as an exponentially weighted moving average
+        rows_per_second = rows / max(elapsed, 1e-3) * self.max_running
+        if self._rows_per_second is None:
+            self._rows_per_second = rows_per_second
+        else:
+            self._rows_per_second = 0.8 * self._rows_per_second + 0.2 * rows_per_second
+
+    def _retry_after(self, outstanding_rows: int) -> int:
+        if self._rows_per_second is None:
+            seconds = self.default_retry_after_seconds
+        else:
+            seconds = outstanding_rows / self._rows_per_second
+
+        return int(min(max(math.ceil(seconds), 1), 60))
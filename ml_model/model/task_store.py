@@ -0,0 +1,249 @@
+"""
+This file contains the stores that keep track of the status, progress and results of prediction tasks. The in-memory
+store is bounded in size and evicts old tasks. The SQLite store keeps the tasks in a local file, so they survive
+restarts and can be shared by several API worker processes on the same machine.
+
+Clients can wait for a task to change instead of polling for it. Waiters are woken up by updates made in the same
+process. Updates made by other processes, which share a SQLite store, are picked up by checking the store every
+`WAIT_CHECK_INTERVAL` seconds.
+"""
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, replace
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+from ml_model.config.dynamic_config import ServingConfig
+
+
+@dataclass
+class TaskRecord:
+    status: str
+    processed_rows: Optional[int] = None
+    result: Optional[dict] = None
+    updated_at: float = 0.0
+
+
+def remove_result_files(record: TaskRecord) -> None:
+    """
+    Removes files that belong to the result of a task, like the predictions file of a chunked task or the output file
+    of a task that predicted probabilities.
+    """
+    for key in ("predictions_file", "output_file"):
+        file_name = (record.result or {}).get(key)
+        if file_name and os.path.exists(file_name):
+            os.remove(file_name)
+
+
+def is_finished(status: str) -> bool:
+    return status == "completed" or status.startswith("failed")
+
+
+class TaskStore(ABC):
+    """Keeps track of the status, the number of processed rows and the result of every task."""
+
+    # Seconds between checks of the store while waiting for a task to change
+    WAIT_CHECK_INTERVAL = 0.1
+
+    def __init__(self):
+        self._changed = threading.Condition()
+        self._listeners: List[Callable[[], None]] = []
+
+    @abstractmethod
+    def get(self, task_id: str) -> Optional[TaskRecord]:
+        """Returns the task, or None if the task is unknown or has been evicted."""
+
+    @abstractmethod
+    def update(self, task_id: str, **changes) -> None:
+        """Updates the given fields of the task. The task is created if it does not exist yet."""
+
+    def create(self, task_id: str, status: str = "processing") -> None:
+        self.update(task_id, status=status)
+
+    def get_status(self, task_id: str) -> Optional[str]:
+        record = self.get(task_id)
+        return record.status if record else None
+
+    def get_result(self, task_id: str) -> Optional[dict]:
+        record = self.get(task_id)
+        return record.result if record else None
+
+    def wait(self, task_id: str, since: float, timeout: float) -> Optional[TaskRecord]:
+        """
+        Waits at most `timeout` seconds until the task has been updated after `since` (an `updated_at` of the task) or
+        is finished, and returns it. Returns the task as it is after the timeout, or None if it is unknown.
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                record = self.get(task_id)
+                remaining = deadline - time.monotonic()
+                if record is None or record.updated_at > since or is_finished(record.status) or remaining <= 0:
+                    return record
+                self._changed.wait(min(remaining, self.WAIT_CHECK_INTERVAL))
+
+    def add_listener(self, listener: Callable[[], None]) -> None:
+        """Calls `listener` after every update made in this process, e.g. to wake up waiters of an event loop."""
+        self._listeners.append(listener)
+
+    def _notify_waiters(self) -> None:
+        with self._changed:
+            self._changed.notify_all()
+        for listener in self._listeners:
+            listener()
+
+
+class InMemoryTaskStore(TaskStore):
+    """
+    Keeps the tasks in memory. Tasks that have not been updated for `ttl_seconds` are evicted, and when more than
+    `max_tasks` tasks are stored, the least recently updated ones are evicted.
+    """
+
+    def __init__(self, max_tasks: int, ttl_seconds: float):
+        super().__init__()
+        self.max_tasks = max_tasks
+        self.ttl_seconds = ttl_seconds
+        self._tasks: "OrderedDict[str, TaskRecord]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, task_id: str) -> Optional[TaskRecord]:
+        with self._lock:
+            record = self._tasks.get(task_id)
+            if record is None or time.time() - record.updated_at > self.ttl_seconds:
+                return None
+
+            return replace(record)
+
+    def update(self, task_id: str, **changes) -> None:
+        with self._lock:
+            record = self._tasks.pop(task_id, None) or TaskRecord(status="processing")
+            for field, value in changes.items():
+                setattr(record, field, value)
+            record.updated_at = time.time()
+            self._tasks[task_id] = record
+            evicted = self._evict()
+        self._notify_waiters()
+
+        for record in evicted:
+            remove_result_files(record)
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def _evict(self) -> List[TaskRecord]:
+        evicted = []
+        expire_before = time.time() - self.ttl_seconds
+        while self._tasks:
+            task_id, record = next(iter(self._tasks.items()))
+            if len(self._tasks) <= self.max_tasks and record.updated_at >= expire_before:
+                break
+            del self._tasks[task_id]
+            evicted.append(record)
+
+        return evicted
+
+
+class SqliteTaskStore(TaskStore):
+    """
+    Keeps the tasks in a SQLite database file. Every process and thread uses its own connection. Tasks that have not
+    been updated for `ttl_seconds` are evicted.
+    """
+
+    # Expired tasks are removed at most once per this many seconds
+    EVICTION_INTERVAL = 60.0
+
+    def __init__(self, path: Path, ttl_seconds: float):
+        super().__init__()
+        self.path = Path(path)
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+        self._last_eviction = 0.0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "task_id TEXT PRIMARY KEY, status TEXT NOT NULL, processed_rows INTEGER, result TEXT, "
+                "updated_at REAL NOT NULL)"
+            )
+
+    def get(self, task_id: str) -> Optional[TaskRecord]:
+        row = self._connection().execute(
+            "SELECT status, processed_rows, result, updated_at FROM tasks WHERE task_id = ? AND updated_at >= ?",
+            (task_id, time.time() - self.ttl_seconds)
+        ).fetchone()
+        if row is None:
+            return None
+
+        status, processed_rows, result, updated_at = row
+        return TaskRecord(
+            status=status,
+            processed_rows=processed_rows,
+            result=json.loads(result) if result is not None else None,
+            updated_at=updated_at
+        )
+
+    def update(self, task_id: str, **changes) -> None:
+        record = TaskRecord(status="processing")
+        values = {**asdict(record), **changes, "updated_at": time.time()}
+        values["result"] = json.dumps(values["result"]) if values["result"] is not None else None
+
+        # Insert the task with default values if needed, and only overwrite the fields that were given
+        assignments = ", ".join(f"{field} = excluded.{field}" for field in [*changes, "updated_at"])
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT INTO tasks (task_id, status, processed_rows, result, updated_at) "
+                "VALUES (:task_id, :status, :processed_rows, :result, :updated_at) "
+                f"ON CONFLICT(task_id) DO UPDATE SET {assignments}",
+                {"task_id": task_id, **values}
+            )
+        self._notify_waiters()
+
+        if time.time() - self._last_eviction > self.EVICTION_INTERVAL:
+            self._evict()
+
+    def _evict(self) -> None:
+        self._last_eviction = time.time()
+        expire_before = time.time() - self.ttl_seconds
+        with self._connection() as connection:
+            rows = connection.execute(
+                "SELECT status, result FROM tasks WHERE updated_at < ?", (expire_before,)
+            ).fetchall()
+            connection.execute("DELETE FROM tasks WHERE updated_at < ?", (expire_before,))
+
+        for status, result in rows:
+            remove_result_files(TaskRecord(status=status, result=json.loads(result) if result else None))
+        if rows:
+            logging.info(f"Evicted {len(rows)} expired tasks from {self.path}")
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections can not be shared between threads, nor be used in a forked process
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        return connection
+
+
+def create_task_store(serving_config: ServingConfig) -> TaskStore:
+    """Creates the task store backend selected in the configuration."""
+    if serving_config.task_store_backend == "memory":
+        return InMemoryTaskStore(
+            max_tasks=serving_config.task_store_max_tasks,
+            ttl_seconds=serving_config.task_store_ttl_seconds
+        )
+    if serving_config.task_store_backend == "sqlite":
+        return SqliteTaskStore(
+            path=Path(serving_config.task_store_path),
+            ttl_seconds=serving_config.task_store_ttl_seconds
+        )
+
+    raise ValueError(f"Unknown task store backend: {serving_config.task_store_backend!r}")
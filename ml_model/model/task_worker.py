@@ -0,0 +1,53 @@
+"""
+This file contains the entry points of the worker processes that the asynchronous API can process uploads in (see
+`asgi_task_pool`). It imports nothing of the API, so a worker process does not build the scheduler, the task store or
+the other state of an API process, and does not pre-warm a model of its own.
+
+The serving configuration of the API is passed to the workers when they start, and applied before the prediction
+modules are imported, so the workers serve with the same settings as the API. With the SQLite task store, the workers
+report the progress of their tasks in the store the API reads. Otherwise they keep the task in a store of their own,
+and the API copies the final state of the task into its store.
+"""
+import io
+from typing import Optional, Union
+from ml_model.config.dynamic_config import config, ServingConfig
+from ml_model.model.task_store import create_task_store, InMemoryTaskStore, TaskRecord, TaskStore
+
+
+# The task store shared with the API, if the API uses a store that other processes can share
+shared_task_store: Optional[TaskStore] = None
+
+
+def init_worker(serving_config: ServingConfig) -> None:
+    """Applies the serving configuration of the API and loads the model, before the first upload arrives."""
+    global shared_task_store
+    config.serving_config = serving_config
+    if serving_config.task_store_backend == "sqlite":
+        shared_task_store = create_task_store(serving_config)
+
+    from ml_model.model.model_utils import model_pool
+
+    model_pool.get()
+
+
+def process_upload(
+        task_id: str,
+        output: str,
+        k: int,
+        version: Optional[str],
+        source: Union[str, bytes],
+        chunk_size: Optional[int]
+) -> TaskRecord:
+    """Cleans, validates and predicts an upload and returns the final state of its task."""
+    from ml_model.model.predict import clean_validate_and_predict, clean_validate_and_predict_in_chunks, TaskContext
+
+    task_store = shared_task_store or InMemoryTaskStore(max_tasks=1, ttl_seconds=float("inf"))
+    if shared_task_store is None:
+        task_store.create(task_id)
+    context = TaskContext(task_id=task_id, task_store=task_store, output=output, k=k, version=version)
+    if chunk_size:
+        clean_validate_and_predict_in_chunks(context, source, chunk_size)
+    else:
+        clean_validate_and_predict(context, source if isinstance(source, str) else io.BytesIO(source))
+
+    return task_store.get(task_id)
@@ -1,14 +1,20 @@
+import argparse
+import logging
 from sklearn.model_selection import train_test_split
 from ml_model.config.dynamic_config import config
-from ml_model.model.data_validation import combine_clean_and_validate_wine_datasets
-from ml_model.model.model_utils import save_pipeline
+from ml_model.model.dataset_cache import load_validated_training_data
+from ml_model.model.model_utils import export_flat_forest, load_pipeline, save_pipeline
 from ml_model.model.pipeline import wine_pipeline
+from typing import Optional
 
 
-def run_training() -> None:
-    """Train the model."""
-    # Get and clean training data
-    training_df, errors = combine_clean_and_validate_wine_datasets(config.app_config.training_data_file_names)
+def run_training(use_cache: bool = True, warm_start_trees: Optional[int] = None) -> None:
+    """
+    Train the model. With `warm_start_trees`, the saved pipeline is loaded and that many trees are added to its forest,
+    keeping the fitted preprocessing steps and the existing trees.
+    """
+    # Get and clean training data, from the cache of validated data if possible
+    training_df, errors = load_validated_training_data(config.app_config.training_data_file_names, use_cache)
 
     if errors is None:
         # divide train and test
@@ -20,14 +26,41 @@ def run_training() -> None:
             random_state=config.ml_model_config.random_state,
         )
 
-        # fit model
-        wine_pipeline.fit(X_train, y_train)
+        if warm_start_trees:
+            # fit only the new trees on the output of the fitted preprocessing steps
+            pipeline = load_pipeline()
+            forest = pipeline[-1]
+            forest.set_params(
+                warm_start=True,
+                n_estimators=forest.n_estimators + warm_start_trees,
+                n_jobs=config.ml_model_config.n_jobs
+            )
+            forest.fit(pipeline[:-1].transform(X_train), y_train)
+            forest.set_params(warm_start=False)
+            logging.info(f"Added {warm_start_trees} trees to the forest, which now has {forest.n_estimators} trees")
+        else:
+            # fit model
+            pipeline = wine_pipeline.fit(X_train, y_train)
+
+        # The API evaluates one request at a time per thread, so the saved forest should not start its own workers
+        pipeline[-1].set_params(n_jobs=None)
 
         # persist trained model
-        save_pipeline(pipeline=wine_pipeline)
+        save_pipeline(pipeline=pipeline)
+
+        # export the forest as flat arrays for the compiled evaluator used by the API
+        export_flat_forest(pipeline=pipeline)
     else:
         raise ValueError(f"An error occurred during the validation of the training data: {errors}")
 
 
 if __name__ == "__main__":
-    run_training()
+    parser = argparse.ArgumentParser(description="Train the wine quality model.")
+    parser.add_argument("--no-cache", action="store_true", help="Parse and validate the datasets again.")
+    parser.add_argument(
+        "--warm-start", type=int, default=None, metavar="N",
+        help="Add N trees to the forest of the saved pipeline instead of training a new pipeline."
+    )
+    args = parser.parse_args()
+
+    run_training(use_cache=not args.no_cache, warm_start_trees=args.warm_start)
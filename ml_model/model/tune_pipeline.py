@@ -0,0 +1,236 @@
+"""
+This file contains the hyperparameter search for the random forest. The preprocessing steps of the pipeline are fitted
+once and their output is shared by all candidates, so only the forest is fitted per candidate and fold. The candidates
+are evaluated with successive halving: every round, all remaining candidates are cross-validated on a larger sample of
+the training data in a process pool, and only the best 1 / `factor` of them continue to the next round.
+
+Besides the score, every evaluation reports the fit time, the latency of the compiled evaluator used by the API and
+the size of the pickled forest, and all evaluations are written to a leaderboard CSV. Models can then be picked that
+meet a latency or size budget, not just the best score. Given a latency budget, candidates over it are pruned in every
+round, so the rounds on more data are spent on candidates that can still be picked.
+
+Run with: python -m ml_model.model.tune_pipeline
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import math
+import os
+import pickle
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from sklearn.base import clone
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import get_scorer
+from sklearn.model_selection import ParameterGrid, StratifiedKFold, train_test_split
+from typing import Dict, List, Optional
+from ml_model.config.dynamic_config import config
+from ml_model.model.dataset_cache import load_validated_training_data
+from ml_model.model.flat_forest import flatten_forest
+from ml_model.model.pipeline import wine_pipeline
+
+
+# Forest parameters searched by default
+PARAM_GRID = {
+    "n_estimators": [100, 250, 500],
+    "max_depth": [None, 12, 20],
+    "min_samples_leaf": [1, 2, 4],
+    "max_features": ["sqrt", 0.5],
+}
+
+# Rounds of successive halving never use fewer training rows than this
+MIN_RESOURCES = 500
+
+# The feature matrix and targets shared by the worker processes
+_shared: Dict[str, np.ndarray] = {}
+
+
+def _init_worker(X: np.ndarray, y: np.ndarray) -> None:
+    _shared["X"] = X
+    _shared["y"] = y
+
+
+def median_seconds(fn, repeats: int = 20) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    return float(np.median(timings))
+
+
+def evaluate_candidate(params: dict, n_samples: int, n_splits: int, scoring: str, random_state: int) -> dict:
+    """
+    Cross-validates a forest with the given parameters on the first `n_samples` rows of the shared data. The folds are
+    stratified, because the quality classes are very imbalanced.
+    """
+    X, y = _shared["X"][:n_samples], _shared["y"][:n_samples]
+    scorer = get_scorer(scoring)
+    scores, fit_seconds = [], []
+
+    for train_index, test_index in StratifiedKFold(n_splits, shuffle=True, random_state=random_state).split(X, y):
+        forest = RandomForestClassifier(**params, n_jobs=1, random_state=random_state)
+        start = time.perf_counter()
+        forest.fit(X[train_index], y[train_index])
+        fit_seconds.append(time.perf_counter() - start)
+        scores.append(scorer(forest, X[test_index], y[test_index]))
+
+    # Latency of the compiled evaluator used by the API, for the forest of the last fold
+    flat_forest = flatten_forest(forest)
+    flat_forest.warm_up()
+    row, batch = X[:1], X[:1000]
+
+    return {
+        **params,
+        "n_samples": n_samples,
+        "mean_score": float(np.mean(scores)),
+        "std_score": float(np.std(scores)),
+        "fit_seconds": float(np.mean(fit_seconds)),
+        "predict_latency_ms": 1000 * median_seconds(lambda: flat_forest.predict(row)),
+        "batch_latency_ms": 1000 * median_seconds(lambda: flat_forest.predict(batch), repeats=5),
+        "model_bytes": len(pickle.dumps(forest, protocol=pickle.HIGHEST_PROTOCOL)),
+    }
+
+
+def successive_halving(
+        X: np.ndarray,
+        y: np.ndarray,
+        candidates: List[dict],
+        factor: int = 3,
+        n_splits: int = 5,
+        scoring: str = "accuracy",
+        n_workers: Optional[int] = None,
+        random_state: int = 0,
+        max_latency_ms: Optional[float] = None
+) -> pd.DataFrame:
+    """
+    Evaluates the candidates with successive halving and returns every evaluation, one row per candidate and round.
+    The last round uses all rows. Candidates whose single row latency exceeds `max_latency_ms` do not continue to the
+    next round, and the search stops early when no candidate is left.
+    """
+    # Shuffle once, so every round samples the first rows of the same permutation
+    permutation = np.random.default_rng(random_state).permutation(len(X))
+    X, y = X[permutation], y[permutation]
+
+    n_rounds = max(1, math.ceil(math.log(len(candidates), factor))) if len(candidates) > 1 else 1
+    remaining = list(enumerate(candidates))
+    evaluations = []
+
+    with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(X, y)) as executor:
+        for round_number in range(n_rounds):
+            n_samples = min(len(X), max(MIN_RESOURCES, int(len(X) / factor ** (n_rounds - 1 - round_number))))
+            logging.info(f"Round {round_number}: {len(remaining)} candidates on {n_samples} rows")
+
+            futures = [
+                executor.submit(evaluate_candidate, params, n_samples, n_splits, scoring, random_state)
+                for _, params in remaining
+            ]
+            results = [
+                {"candidate": candidate, "round": round_number, **future.result()}
+                for (candidate, _), future in zip(remaining, futures)
+            ]
+            evaluations.extend(results)
+
+            # Keep the best 1 / factor of the candidates within the latency budget for the next round
+            n_keep = max(1, math.ceil(len(remaining) / factor))
+            eligible = [
+                i for i, result in enumerate(results)
+                if max_latency_ms is None or result["predict_latency_ms"] <= max_latency_ms
+            ]
+            best = sorted(eligible, key=lambda i: results[i]["mean_score"], reverse=True)[:n_keep]
+            remaining = [remaining[i] for i in sorted(best)]
+            if not remaining:
+                logging.info(f"No candidate of round {round_number} meets the latency budget")
+                break
+
+    return pd.DataFrame(evaluations)
+
+
+def make_leaderboard(evaluations: pd.DataFrame) -> pd.DataFrame:
+    """Keeps the evaluation of every candidate in the last round it reached, best candidates first."""
+    last_rounds = evaluations.sort_values("round").groupby("candidate").tail(1)
+
+    return last_rounds.sort_values(["round", "mean_score"], ascending=False).reset_index(drop=True)
+
+
+def pick_best_candidate(leaderboard: pd.DataFrame, max_latency_ms: Optional[float] = None) -> Optional[pd.Series]:
+    """
+    Returns the best candidate of the leaderboard whose single row latency is within `max_latency_ms`, preferring
+    candidates that reached later rounds. Returns None if no candidate meets the budget.
+    """
+    if max_latency_ms is not None:
+        leaderboard = leaderboard[leaderboard["predict_latency_ms"] <= max_latency_ms]
+
+    return leaderboard.iloc[0] if not leaderboard.empty else None
+
+
+def run_tuning(
+        param_grid: Optional[dict] = None,
+        factor: int = 3,
+        n_splits: int = 5,
+        scoring: str = "accuracy",
+        n_workers: Optional[int] = None,
+        output_path: Path = Path("tmp/tuning_leaderboard.csv"),
+        max_latency_ms: Optional[float] = None
+) -> pd.DataFrame:
+    """Runs the hyperparameter search on the training split and writes the leaderboard to `output_path`."""
+    training_df, errors = load_validated_training_data(config.app_config.training_data_file_names)
+    if errors is not None:
+        raise ValueError(f"An error occurred during the validation of the training data: {errors}")
+
+    # Use the same training split as train_pipeline, so the test rows are never seen during the search
+    X_train, _, y_train, _ = train_test_split(
+        training_df[config.ml_model_config.features],
+        training_df[config.ml_model_config.target],
+        test_size=config.ml_model_config.test_size,
+        random_state=config.ml_model_config.random_state,
+    )
+
+    # Fit the preprocessing steps once. They are fitted on all training rows instead of per fold, which only affects
+    # the scaling and the imputed values, neither of which changes the splits a tree can make.
+    preprocessing = clone(wine_pipeline)[:-1]
+    X = preprocessing.fit_transform(X_train).astype(np.float32)
+
+    candidates = list(ParameterGrid(param_grid or PARAM_GRID))
+    evaluations = successive_halving(
+        X, y_train.to_numpy(), candidates, factor, n_splits, scoring, n_workers,
+        random_state=config.ml_model_config.random_state, max_latency_ms=max_latency_ms
+    )
+    leaderboard = make_leaderboard(evaluations)
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    leaderboard.to_csv(output_path, index=False)
+    evaluations.to_csv(output_path.with_name(output_path.stem + "_all_rounds.csv"), index=False)
+    logging.info(f"Leaderboard of {len(leaderboard)} candidates written to {output_path}")
+
+    return leaderboard
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Search the forest parameters with successive halving.")
+    parser.add_argument("--factor", type=int, default=3, help="Keep the best 1 / factor of the candidates per round.")
+    parser.add_argument("--cv", type=int, default=5, help="Number of cross-validation folds.")
+    parser.add_argument("--scoring", default="accuracy", help="Name of a scikit-learn scorer.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes.")
+    parser.add_argument("--output", type=Path, default=Path("tmp/tuning_leaderboard.csv"))
+    parser.add_argument(
+        "--max-latency-ms", type=float, default=None,
+        help="Prune candidates whose single row predict latency exceeds this budget, and pick the best within it."
+    )
+    args = parser.parse_args()
+
+    leaderboard = run_tuning(
+        factor=args.factor, n_splits=args.cv, scoring=args.scoring, n_workers=args.workers, output_path=args.output,
+        max_latency_ms=args.max_latency_ms
+    )
+    best = pick_best_candidate(leaderboard, args.max_latency_ms)
+
+    print(leaderboard.head(10).to_string(index=False))
+    if best is None:
+        print("No candidate meets the latency budget.")
+    else:
+        print(f"Best candidate: {best[list(PARAM_GRID)].to_dict()}")
@@ -0,0 +1,96 @@
+import json
+import threading
+import time
+import uuid
+import pytest
+from api import main
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+@pytest.fixture
+def task_id():
+    task_id = str(uuid.uuid4())
+    main.task_store.create(task_id)
+
+    return task_id
+
+
+def update_later(task_id: str, seconds: float, **changes) -> threading.Timer:
+    timer = threading.Timer(seconds, main.task_store.update, args=(task_id,), kwargs=changes)
+    timer.start()
+
+    return timer
+
+
+def parse_events(body: str) -> list:
+    """Returns the (event, data) pairs of a Server-Sent Events stream, without the comments."""
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n") if not line.startswith(":"))
+        if lines:
+            events.append((lines["event"], json.loads(lines["data"])))
+
+    return events
+
+
+def test_status_long_poll_returns_on_the_next_update(client, task_id):
+    since = main.task_store.get(task_id).updated_at
+    update_later(task_id, 0.2, processed_rows=10)
+
+    start = time.monotonic()
+    response = client.get(f"/status/{task_id}?wait=10&since={since}")
+
+    assert response.status_code == 200
+    assert response.get_json()["processed_rows"] == 10
+    assert time.monotonic() - start < 5
+
+
+def test_event_stream_ends_with_the_completed_task(client, task_id, monkeypatch):
+    monkeypatch.setattr(main, "waiting_requests", threading.BoundedSemaphore(1))
+    update_later(task_id, 0.2, processed_rows=1)
+    update_later(task_id, 0.4, status="completed", result={"predictions": [6], "version": "1.0.0"})
+
+    response = client.get(f"/events/{task_id}")
+    events = parse_events(response.get_data(as_text=True))
+    response.close()
+
+    assert response.mimetype == "text/event-stream"
+    assert events[0][0] == "status"
+    assert events[0][1]["status"] == "processing"
+    assert events[-1][0] == "completed"
+    assert events[-1][1]["result"]["predictions"] == [6]
+    # The stream no longer counts as waiting once it is closed
+    assert main.waiting_requests.acquire(blocking=False)
+    main.waiting_requests.release()
+
+
+def test_waiting_requests_past_the_limit_are_refused(client, task_id, monkeypatch):
+    monkeypatch.setattr(main, "waiting_requests", threading.BoundedSemaphore(1))
+    main.waiting_requests.acquire()
+
+    for url in [f"/status/{task_id}?wait=10", f"/events/{task_id}"]:
+        response = client.get(url)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == str(main.WAIT_RETRY_AFTER_SECONDS)
+
+    # Polls that do not wait are always answered
+    assert client.get(f"/status/{task_id}").get_json()["status"] == "processing"
+
+
+def test_record_with_a_missing_value_is_rejected_in_a_batch(client):
+    record = {
+        "fixed acidity": 7.4, "volatile acidity": 0.7, "citric acid": 0.0, "residual sugar": 1.9, "chlorides": 0.076,
+        "free sulfur dioxide": 11, "total sulfur dioxide": 34, "density": 0.9978, "pH": 3.51, "sulphates": 0.56,
+        "alcohol": 9.4, "color": "red",
+    }
+
+    response = client.post("/predict/json", json=[record, {**record, "alcohol": None}])
+
+    assert response.status_code == 400
+    assert [(error["type"], error["loc"], error["input"]) for error in response.get_json()["errors"]] == [
+        ("float_type", ["inputs", 1, "Alcohol"], None)
+    ]
@@ -0,0 +1,168 @@
+import asyncio
+import io
+import json
+import os
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+import pytest
+from api import asgi, main
+from ml_model.config.dynamic_config import config
+from ml_model.model.scheduler import AdmissionScheduler
+
+CSV = b"fixed acidity;color\n7.4;red\n7.8;white\n"
+
+
+@pytest.fixture(autouse=True)
+def task_updates(monkeypatch):
+    """Every test runs its own event loop, so the task updates are bound to a new one."""
+    monkeypatch.setattr(asgi, "task_updates", None)
+    monkeypatch.setattr(main.task_store, "_listeners", [])
+
+
+@pytest.fixture
+def processed_uploads(monkeypatch):
+    """Replaces the processing of uploads, and records what each task was given."""
+    processed = SimpleNamespace(uploads=[], done=threading.Event())
+
+    def process_upload(context, source, chunk_size):
+        if isinstance(source, io.BytesIO):
+            processed.uploads.append(("memory", source.getvalue()))
+        else:
+            with open(source, "rb") as file:
+                processed.uploads.append(("file", file.read()))
+            os.remove(source)
+        context.task_store.update(context.task_id, status="completed", result={"predictions": [], "version": "1"})
+        processed.done.set()
+
+    monkeypatch.setattr(asgi, "process_upload", process_upload)
+
+    return processed
+
+
+def multipart(filename: str, content: bytes) -> bytes:
+    return (
+        b'--boundary\r\nContent-Disposition: form-data; name="file"; filename="' + filename.encode() + b'"\r\n'
+        b"Content-Type: text/csv\r\n\r\n" + content + b"\r\n--boundary--\r\n"
+    )
+
+
+def call(method: str, path: str, query: str = "", body: bytes = b"", headers: dict = None, chunk_bytes: int = 0):
+    """Sends a request to the ASGI app and returns the status, the headers and the body of the response."""
+    chunk_bytes = chunk_bytes or max(len(body), 1)
+    chunks = [body[start:start + chunk_bytes] for start in range(0, len(body), chunk_bytes)] or [b""]
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1} for i, chunk in enumerate(chunks)
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query.encode(),
+        "headers": [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80),
+    }
+    asyncio.run(asgi.application(scope, receive, send))
+
+    return sent[0]["status"], dict(sent[0]["headers"]), b"".join(message.get("body", b"") for message in sent[1:])
+
+
+def upload(content: bytes, filename: str = "wines.csv", chunk_bytes: int = 0):
+    body = multipart(filename, content)
+    headers = {"Content-Type": "multipart/form-data; boundary=boundary", "Content-Length": str(len(body))}
+
+    return call("POST", "/predict", body=body, headers=headers, chunk_bytes=chunk_bytes)
+
+
+def test_small_upload_is_read_into_memory(processed_uploads):
+    status, _, body = upload(CSV)
+
+    assert status == 200
+    assert processed_uploads.done.wait(5)
+    assert processed_uploads.uploads == [("memory", CSV)]
+    assert main.task_store.get_status(json.loads(body)["task_id"]) == "completed"
+
+
+def test_large_upload_is_spooled_to_a_file(processed_uploads, monkeypatch):
+    monkeypatch.setattr(config.serving_config, "in_memory_upload_max_bytes", 0)
+    content = CSV * 1000
+
+    status, _, _ = upload(content, chunk_bytes=1000)
+
+    assert status == 200
+    assert processed_uploads.done.wait(5)
+    assert processed_uploads.uploads == [("file", content)]
+
+
+def test_upload_that_is_not_a_csv_file_is_rejected(processed_uploads):
+    status, _, body = upload(CSV, filename="wines.txt")
+
+    assert status == 400
+    assert "CSV" in json.loads(body)["msg"]
+    assert processed_uploads.uploads == []
+
+
+def test_upload_is_rejected_when_the_queue_is_full(processed_uploads, monkeypatch):
+    scheduler = AdmissionScheduler(main.executor, max_running=1, max_rows=1, max_queued_tasks=10)
+    scheduler.reserve("running", "other client", 1)
+    monkeypatch.setattr(asgi, "scheduler", scheduler)
+
+    status, headers, _ = upload(CSV)
+
+    assert status == 429
+    assert int(headers[b"retry-after"]) >= 1
+    assert processed_uploads.uploads == []
+
+
+def test_status_long_poll_wakes_up_on_an_update():
+    task_id = str(uuid.uuid4())
+    main.task_store.create(task_id)
+    since = main.task_store.get(task_id).updated_at
+    threading.Timer(0.2, main.task_store.update, args=(task_id,), kwargs={"processed_rows": 10}).start()
+
+    start = time.monotonic()
+    status, _, body = call("GET", f"/status/{task_id}", query=f"wait=10&since={since}")
+
+    assert status == 200
+    assert json.loads(body)["processed_rows"] == 10
+    # Woken up by the update instead of the periodic check of the store
+    assert time.monotonic() - start < asgi.WAIT_CHECK_INTERVAL
+
+
+def test_event_stream_ends_with_the_completed_task():
+    task_id = str(uuid.uuid4())
+    main.task_store.create(task_id)
+    result = {"predictions": [6], "version": "1.0.0"}
+    changes = {"status": "completed", "result": result}
+    threading.Timer(0.2, main.task_store.update, args=(task_id,), kwargs=changes).start()
+
+    status, headers, body = call("GET", f"/events/{task_id}")
+    events = [block for block in body.decode().strip().split("\n\n") if not block.startswith(":")]
+
+    assert status == 200
+    assert headers[b"content-type"].startswith(b"text/event-stream")
+    assert events[0].startswith("event: status\n")
+    assert events[-1].startswith("event: completed\n")
+    assert json.loads(events[-1].split("data: ", 1)[1])["result"] == result
+
+
+def test_other_routes_are_served_by_the_flask_app():
+    status, _, body = call(
+        "POST", "/predict/json", body=b"[]", headers={"Content-Type": "application/json", "Content-Length": "2"}
+    )
+    assert status == 400
+    assert json.loads(body)["msg"].startswith("Invalid input")
+
+    status, _, body = call("GET", "/results/unknown")
+    assert status == 404
+    assert json.loads(body) == {"error": "Task not found"}
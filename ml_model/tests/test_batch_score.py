@@ -0,0 +1,66 @@
+import json
+import os
+import numpy as np
+import pytest
+from ml_model.benchmarks.synthetic_data import generate_wine_dataset, write_upload
+from ml_model.model import model_utils
+from ml_model.model.batch_score import find_input_files, is_done, output_paths, run_batch_scoring, score_file
+
+
+class ConstantPredictor:
+    def predict(self, X):
+        return np.full(len(X), 6)
+
+
+@pytest.fixture
+def input_dir(tmp_path, monkeypatch):
+    """Fixture with a valid and an invalid CSV file, scored in this process by a stand-in for the model."""
+    monkeypatch.setattr(model_utils.model_registry, "get_predictor", lambda: ConstantPredictor())
+    good = generate_wine_dataset(25, seed=0).drop(columns="quality")
+    # Rows with missing values are skipped
+    good.loc[3, "alcohol"] = np.nan
+    write_upload(good, tmp_path / "good.csv")
+    invalid = generate_wine_dataset(5, seed=1).astype({"alcohol": object})
+    invalid.loc[2, "alcohol"] = "strong"
+    write_upload(invalid, tmp_path / "bad.csv")
+
+    return tmp_path
+
+
+def test_files_are_scored_in_chunks_or_their_errors_reported(input_dir):
+    for name in ("good.csv", "bad.csv"):
+        summary = score_file(input_dir / name, *output_paths(input_dir / name, None), chunk_size=10)
+
+    predictions_file, _ = output_paths(input_dir / "good.csv", None)
+    _, errors_file = output_paths(input_dir / "bad.csv", None)
+    expected_lines = ["row;prediction"] + [f"{row};6" for row in range(25) if row != 3]
+    assert predictions_file.read_text().splitlines() == expected_lines
+    assert summary["status"] == "failed"
+    assert json.loads(errors_file.read_text())["errors"][0]["loc"] == ["inputs", 2, "Alcohol"]
+    assert find_input_files([str(input_dir)]) == [input_dir / "bad.csv", input_dir / "good.csv"]
+
+
+def test_finished_files_are_not_scored_again(input_dir):
+    for name in ("good.csv", "bad.csv"):
+        score_file(input_dir / name, *output_paths(input_dir / name, None), chunk_size=10)
+
+    run_summary = run_batch_scoring([str(input_dir / "*.csv")])
+
+    assert run_summary["scored"] == 0
+    assert run_summary["skipped"] == 2
+    assert [failure["file"] for failure in run_summary["failed"]] == [str(input_dir / "bad.csv")]
+
+    # A file that changed after it was scored is scored again
+    predictions_file, _ = output_paths(input_dir / "good.csv", None)
+    os.utime(input_dir / "good.csv", ns=(0, predictions_file.stat().st_mtime_ns + 1))
+    assert not is_done(input_dir / "good.csv", predictions_file)
+
+
+def test_file_that_can_not_be_written_is_reported_as_failed(input_dir):
+    # The temporary predictions file can not be created in a directory that does not exist
+    predictions_file = input_dir / "missing" / "good.predictions.csv"
+
+    summary = score_file(input_dir / "good.csv", predictions_file, input_dir / "good.errors.json", chunk_size=10)
+
+    assert summary["status"] == "failed"
+    assert summary["errors"][0]["type"] == "read_error"
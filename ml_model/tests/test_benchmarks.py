@@ -0,0 +1,22 @@
+from ml_model.benchmarks.bench_suite import compare_to_baseline
+from ml_model.benchmarks.synthetic_data import generate_wine_dataset
+from ml_model.model.data_validation import process_user_input
+
+
+def test_synthetic_wines_are_valid_uploads():
+    dataset = generate_wine_dataset(2_000, seed=1)
+    valid_data, errors = process_user_input(dataset)
+
+    assert errors is None
+    assert len(valid_data) == 2_000
+    assert set(dataset["color"]) == {"red", "white"}
+    assert generate_wine_dataset(100, seed=1).equals(generate_wine_dataset(100, seed=1))
+
+
+def test_regressions_are_reported_in_both_directions():
+    baseline = {"stage.predict.seconds": 1.0, "api.requests_per_second": 100.0, "stage.load.seconds": 1.0}
+    results = {"stage.predict.seconds": 1.5, "api.requests_per_second": 70.0, "stage.load.seconds": 1.1, "new": 1.0}
+
+    regressions = compare_to_baseline(results, baseline, threshold=0.2)
+
+    assert [name for name, *_ in regressions] == ["stage.predict.seconds", "api.requests_per_second"]
@@ -0,0 +1,89 @@
+import json
+import pandas as pd
+from ml_model.model.data_validation import MAX_REPORTED_ERRORS, count_errors, validate_data
+
+
+def make_valid_data() -> pd.DataFrame:
+    return pd.DataFrame({
+        'FixedAcidity': [7.4, 6.3],
+        'VolatileAcidity': [0.7, 0.3],
+        'CitricAcid': [0.0, 0.2],
+        'ResidualSugar': [1.9, 1.6],
+        'Chlorides': [0.076, 0.049],
+        'FreeSulfurDioxide': [11, 14],
+        'TotalSulfurDioxide': [34, 132],
+        'Density': [0.9978, 0.994],
+        'PH': [3.51, 3.3],
+        'Sulphates': [0.56, 0.49],
+        'Alcohol': [9.4, 9.5],
+        'Quality': [5.0, 6.0],
+        'Color': ['red', 'white'],
+        'Unused': [1, 2],
+    })
+
+
+def test_validate_data_coerces_columns():
+    valid_df, errors = validate_data(make_valid_data())
+
+    assert errors is None
+    assert 'Unused' not in valid_df.columns
+    assert valid_df['FreeSulfurDioxide'].dtype == 'float64'
+    assert valid_df['Quality'].dtype == 'int64'
+    assert valid_df['Quality'].tolist() == [5, 6]
+
+
+def test_validate_data_reports_every_invalid_value():
+    input_df = make_valid_data()
+    input_df['Quality'] = [5.5, 6.0]
+    input_df['Alcohol'] = input_df['Alcohol'].astype(object)
+    input_df.loc[1, 'Alcohol'] = 'abc'
+
+    valid_df, errors = validate_data(input_df)
+    errors = json.loads(errors)
+
+    assert valid_df.empty
+    assert [(error['type'], error['loc']) for error in errors] == [
+        ('int_from_float', ['inputs', 0, 'Quality']),
+        ('float_parsing', ['inputs', 1, 'Alcohol']),
+    ]
+    assert errors[1]['input'] == 'abc'
+
+
+def test_validate_data_reports_missing_columns():
+    valid_df, errors = validate_data(make_valid_data().drop(columns=['Color']))
+    errors = json.loads(errors)
+
+    assert valid_df.empty
+    assert errors[0]['type'] == 'missing'
+    assert errors[0]['loc'] == ['inputs', 0, 'Color']
+
+
+def test_validate_data_reports_missing_values_in_numeric_columns():
+    input_df = make_valid_data()
+    input_df.loc[1, 'Alcohol'] = None
+    input_df.loc[0, 'Quality'] = None
+
+    _, errors = validate_data(input_df)
+    errors = json.loads(errors)
+
+    assert [(error['type'], error['loc'], error['input']) for error in errors] == [
+        ('int_type', ['inputs', 0, 'Quality'], None),
+        ('float_type', ['inputs', 1, 'Alcohol'], None),
+    ]
+
+
+def test_validate_data_counts_the_errors_it_leaves_out():
+    input_df = pd.concat([make_valid_data()] * 500, ignore_index=True)
+    input_df['Alcohol'] = 'abc'
+    input_df['Color'] = input_df['Color'].astype(object)
+    input_df.loc[3, 'Color'] = 1
+
+    _, errors = validate_data(input_df)
+    errors = json.loads(errors)
+
+    assert len(errors) == MAX_REPORTED_ERRORS + 1
+    assert errors[3]['loc'] == ['inputs', 3, 'Alcohol']
+    assert errors[4]['loc'] == ['inputs', 3, 'Color']
+    assert errors[-1]['type'] == 'too_many_errors'
+    assert errors[-1]['n_left_out'] == 1001 - MAX_REPORTED_ERRORS
+    assert count_errors(errors) == 1001
@@ -0,0 +1,33 @@
+import pandas as pd
+from ml_model.model import dataset_cache
+from ml_model.model.dataset_cache import load_frame, load_validated_training_data, save_frame
+
+
+FILE_NAMES = ["winequality-red.csv", "winequality-white.csv"]
+
+
+def test_frame_survives_save_and_load(tmp_path):
+    df = pd.DataFrame({"Alcohol": [9.4, 10.2], "Quality": [5, 6], "Color": ["red", "white"]})
+    file_path = tmp_path / "frame.npz"
+
+    save_frame(df, file_path)
+
+    pd.testing.assert_frame_equal(load_frame(file_path), df)
+
+
+def test_validated_training_data_is_read_from_cache(tmp_path, monkeypatch):
+    calls = []
+    combine = dataset_cache.combine_clean_and_validate_wine_datasets
+
+    def counting_combine(file_names):
+        calls.append(file_names)
+        return combine(file_names)
+
+    monkeypatch.setattr(dataset_cache, "combine_clean_and_validate_wine_datasets", counting_combine)
+
+    first_df, first_errors = load_validated_training_data(FILE_NAMES, cache_dir=tmp_path)
+    second_df, second_errors = load_validated_training_data(FILE_NAMES, cache_dir=tmp_path)
+
+    assert len(calls) == 1
+    assert first_errors is None and second_errors is None
+    pd.testing.assert_frame_equal(second_df, first_df)
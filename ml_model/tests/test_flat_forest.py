@@ -0,0 +1,62 @@
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from ml_model.model.flat_forest import compact_flat_forest, flatten_forest, load_flat_forest, save_flat_forest
+
+
+def fit_forest():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(500, 5))
+    y = (X[:, 0] + rng.normal(scale=0.5, size=500) > 0).astype(int) + (X[:, 1] > 1).astype(int)
+    forest = RandomForestClassifier(n_estimators=25, random_state=0).fit(X, y)
+
+    return forest, rng.normal(size=(300, 5))
+
+
+def test_flat_forest_predictions_are_identical_to_sklearn():
+    forest, X = fit_forest()
+    flat_forest = flatten_forest(forest)
+
+    assert np.array_equal(flat_forest.predict_proba(X), forest.predict_proba(X))
+    assert np.array_equal(flat_forest.predict(X), forest.predict(X))
+
+
+def test_flat_forest_survives_save_and_load(tmp_path):
+    forest, X = fit_forest()
+    file_path = tmp_path / "forest.flat.joblib"
+
+    save_flat_forest(flatten_forest(forest), file_path)
+    flat_forest = load_flat_forest(file_path)
+
+    assert np.array_equal(flat_forest.predict_proba(X), forest.predict_proba(X))
+
+
+def test_compact_flat_forest_predictions_are_identical_to_sklearn():
+    forest, X = fit_forest()
+    compact = compact_flat_forest(flatten_forest(forest))
+
+    # Add rows with features right at, just below and just above the float32 versions of the thresholds
+    thresholds = np.concatenate([
+        estimator.tree_.threshold[estimator.tree_.feature >= 0] for estimator in forest.estimators_
+    ])
+    at_threshold = np.repeat(thresholds.astype(np.float32)[:, np.newaxis], X.shape[1], axis=1)
+    X = np.concatenate([
+        X.astype(np.float32),
+        at_threshold,
+        np.nextafter(at_threshold, np.float32(-np.inf)),
+        np.nextafter(at_threshold, np.float32(np.inf))
+    ])
+
+    assert compact.threshold.dtype == np.float32
+    assert len(compact.leaf_values) < len(flatten_forest(forest).leaf_values)
+    assert compact.nbytes < flatten_forest(forest).nbytes
+    assert np.array_equal(compact.predict_proba(X), forest.predict_proba(X))
+
+
+def test_compressed_flat_forest_survives_save_and_load(tmp_path):
+    forest, X = fit_forest()
+    file_path = tmp_path / "forest.flat.joblib"
+
+    save_flat_forest(compact_flat_forest(flatten_forest(forest)), file_path, compress=3)
+    flat_forest = load_flat_forest(file_path)
+
+    assert np.array_equal(flat_forest.predict_proba(X), forest.predict_proba(X))
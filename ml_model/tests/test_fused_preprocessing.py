@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.base import clone
+from sklearn.preprocessing import MinMaxScaler
+from ml_model.config.dynamic_config import config
+from ml_model.model.fused_preprocessing import compile_preprocessing, fuse_preprocessing, make_equivalence_sample
+from ml_model.model.pipeline import wine_pipeline
+
+
+def make_wine_data(n_rows=400):
+    rng = np.random.default_rng(0)
+    data = {var: rng.normal(loc=5.0, scale=2.0, size=n_rows) for var in config.ml_model_config.numerical_vars}
+    data["Color"] = rng.choice(["red", "white"], size=n_rows)
+
+    return pd.DataFrame(data)[config.ml_model_config.features], rng.integers(3, 9, size=n_rows)
+
+
+@pytest.fixture
+def fitted_pipeline():
+    X, y = make_wine_data()
+    pipeline = clone(wine_pipeline).set_params(classifier__n_estimators=5)
+
+    return pipeline.fit(X, y)
+
+
+def test_fused_preprocessing_is_identical_to_pipeline(fitted_pipeline):
+    fused = compile_preprocessing(fitted_pipeline[:-1])
+    X = make_equivalence_sample(fused)[config.ml_model_config.features]
+    X.loc[:3, "Color"] = ["red", "white", "rosé", None]
+
+    assert fused is not None
+    assert np.array_equal(fused.transform(X, dtype=np.float64), fitted_pipeline[:-1].transform(X))
+    assert np.array_equal(fused.transform(X), fitted_pipeline[:-1].transform(X).astype(np.float32))
+
+
+def test_unsupported_steps_are_not_fused(fitted_pipeline):
+    fitted_pipeline.steps[-2] = ("scaler", MinMaxScaler().fit(fitted_pipeline[:-2].transform(make_wine_data()[0])))
+
+    with pytest.raises(ValueError):
+        fuse_preprocessing(fitted_pipeline[:-1])
+    assert compile_preprocessing(fitted_pipeline[:-1]) is None
@@ -0,0 +1,10 @@
+import pytest
+from ml_model.benchmarks.bench_import_time import FORBIDDEN_PACKAGES, measure_import
+
+
+@pytest.mark.parametrize("module", ["ml_model.model.predict", "api.main", "api.asgi"])
+def test_importing_does_not_need_secrets_or_heavy_packages(module):
+    # measure_import runs without the storage connection string, so the import would fail if it needed the secret
+    _, modules = measure_import(module)
+
+    assert not set(FORBIDDEN_PACKAGES) & set(modules)
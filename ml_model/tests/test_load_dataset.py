@@ -1,4 +1,4 @@
-from ml_model.model.data_utils import load_dataset
+from ml_model.model.data_utils import load_dataset, load_dataset_in_chunks
 import pytest
 import pandas as pd
 import os
@@ -57,3 +57,41 @@ def test_load_dataset(temp_files):
     assert 'fixed acidity' in df_white.columns  # Ensure the 'color' column is present
 
 
+def test_fast_mode_reads_model_columns_with_any_delimiter(tmp_path):
+    file_path = tmp_path / "wines.csv"
+    pd.DataFrame({
+        'fixed acidity': [7.4, 7.8],
+        'comment': ['first', 'second'],
+        'color': ['red', 'white'],
+    }).to_csv(file_path, sep=',', index=False)
+
+    df = load_dataset(full_path=str(file_path), fast=True)
+
+    assert list(df.columns) == ['FixedAcidity', 'Color']
+    assert df['FixedAcidity'].dtype == 'float64'
+    assert df['Color'].tolist() == ['red', 'white']
+
+
+def test_fast_mode_keeps_values_that_do_not_match_the_dtype(tmp_path):
+    file_path = tmp_path / "wines.csv"
+    pd.DataFrame({'fixed acidity': ['7.4', 'sour'], 'alcohol': [9.4, 9.8]}).to_csv(file_path, sep=';', index=False)
+
+    df = load_dataset(full_path=str(file_path), fast=True)
+    chunks = list(load_dataset_in_chunks(1, full_path=str(file_path), fast=True))
+
+    # The invalid value is left for the validation to report
+    assert df['FixedAcidity'].tolist() == ['7.4', 'sour']
+    assert [value for chunk in chunks for value in chunk['FixedAcidity'].tolist()] == [7.4, 'sour']
+
+
+def test_fast_chunks_are_read_again_by_rows_when_a_value_does_not_match_the_dtype(tmp_path):
+    file_path = tmp_path / "wines.csv"
+    # A quoted newline and a blank line make the physical lines differ from the rows
+    file_path.write_text('fixed acidity;color\n7.4;"deep\nred"\n\n7.8;white\n8.1;red\nsour;red\n')
+
+    chunks = list(load_dataset_in_chunks(2, full_path=str(file_path), fast=True))
+    df = pd.concat(chunks)
+
+    assert df['FixedAcidity'].tolist() == [7.4, 7.8, '8.1', 'sour']
+    assert df['Color'].tolist() == ['deep\nred', 'white', 'red', 'red']
+    assert df.index.tolist() == [0, 1, 2, 3]
@@ -0,0 +1,44 @@
+import time
+from ml_model.model.metrics import MetricsRegistry
+from ml_model.model.profiling import profile_if_slow
+
+
+def test_histogram_is_rendered_with_cumulative_buckets():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("stage_seconds", "Time per stage.", labelnames=["stage"], buckets=[0.1, 1.0])
+    for value in (0.05, 0.5, 0.7, 5.0):
+        histogram.observe(value, stage="predict")
+
+    lines = registry.render().splitlines()
+
+    assert 'stage_seconds_bucket{stage="predict",le="0.1"} 1' in lines
+    assert 'stage_seconds_bucket{stage="predict",le="1"} 3' in lines
+    assert 'stage_seconds_bucket{stage="predict",le="+Inf"} 4' in lines
+    assert 'stage_seconds_count{stage="predict"} 4' in lines
+
+
+def test_counters_are_kept_per_label_value():
+    registry = MetricsRegistry()
+    counter = registry.counter("rows_total", "Rows.", labelnames=["outcome"])
+    counter.inc(3, outcome="predicted")
+    counter.inc(2, outcome="predicted")
+    counter.inc(outcome="rejected")
+
+    assert counter.value(outcome="predicted") == 5
+    assert 'rows_total{outcome="rejected"} 1' in registry.render().splitlines()
+
+
+def test_profile_of_slow_block_is_written_as_folded_stacks(tmp_path):
+    def busy_wait(seconds):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+    with profile_if_slow("slow request", 1.0, 0.0, tmp_path, interval_seconds=0.001):
+        busy_wait(0.1)
+    with profile_if_slow("unsampled", 0.0, 0.0, tmp_path) as profiler:
+        assert profiler is None
+
+    (profile_file,) = tmp_path.iterdir()
+    assert profile_file.name.startswith("slow_request-")
+    assert "busy_wait" in profile_file.read_text()
@@ -0,0 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from ml_model.model.micro_batching import MicroBatcher
+
+
+def test_micro_batcher_combines_concurrent_requests():
+    batch_sizes = []
+
+    def predict_fn(input_data: pd.DataFrame):
+        batch_sizes.append(len(input_data))
+        return input_data['x'].to_numpy() * 2
+
+    batcher = MicroBatcher(predict_fn=predict_fn, max_batch_size=1000, max_wait_ms=200)
+    inputs = [pd.DataFrame({'x': [i, i + 100]}) for i in range(10)]
+
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        results = list(pool.map(batcher.predict, inputs))
+
+    # Every request gets the predictions for its own rows
+    for input_data, predictions in zip(inputs, results):
+        assert predictions.tolist() == (input_data['x'] * 2).tolist()
+
+    assert sum(batch_sizes) == 20
+    assert len(batch_sizes) < 10
+
+
+def test_micro_batcher_passes_errors_to_every_request():
+    def predict_fn(input_data: pd.DataFrame):
+        raise ValueError("broken model")
+
+    batcher = MicroBatcher(predict_fn=predict_fn, max_batch_size=10, max_wait_ms=0)
+    future = batcher.submit(pd.DataFrame({'x': [1]}))
+
+    assert isinstance(future.exception(timeout=5), ValueError)
@@ -0,0 +1,78 @@
+import hashlib
+import os
+import pytest
+from ml_model.model.model_download import ArtifactCache, FileSystemBlobSource, download_blob
+
+
+class FailingBlobSource(FileSystemBlobSource):
+    """Fails every read from `fail_at_offset` on, and counts the ranges that were read."""
+
+    def __init__(self, root, fail_at_offset=None):
+        super().__init__(root)
+        self.fail_at_offset = fail_at_offset
+        self.offsets = []
+
+    def read_range(self, name, offset, length):
+        if self.fail_at_offset is not None and offset >= self.fail_at_offset:
+            raise IOError("Connection reset")
+        self.offsets.append(offset)
+        return super().read_range(name, offset, length)
+
+
+@pytest.fixture
+def blob_dir(tmp_path):
+    """Fixture to create a blob store directory with one artifact and its checksum."""
+    blob_dir = tmp_path / "blobs"
+    blob_dir.mkdir()
+    content = os.urandom(10_000)
+    (blob_dir / "model_1.0.0.pkl").write_bytes(content)
+    (blob_dir / "model_1.0.0.pkl.sha256").write_text(hashlib.sha256(content).hexdigest())
+
+    return blob_dir
+
+
+def test_download_writes_complete_file(blob_dir, tmp_path):
+    destination = tmp_path / "models" / "model_1.0.0.pkl"
+
+    download_blob(FileSystemBlobSource(blob_dir), "model_1.0.0.pkl", destination, chunk_bytes=1024, max_workers=3)
+
+    assert destination.read_bytes() == (blob_dir / "model_1.0.0.pkl").read_bytes()
+    assert [path.name for path in destination.parent.iterdir()] == ["model_1.0.0.pkl"]
+
+
+def test_interrupted_download_resumes(blob_dir, tmp_path):
+    destination = tmp_path / "model_1.0.0.pkl"
+
+    with pytest.raises(IOError):
+        download_blob(FailingBlobSource(blob_dir, fail_at_offset=5000), "model_1.0.0.pkl", destination, 1024, 1)
+    assert not destination.exists()
+
+    source = FailingBlobSource(blob_dir)
+    download_blob(source, "model_1.0.0.pkl", destination, chunk_bytes=1024, max_workers=1)
+
+    assert min(source.offsets) == 5120
+    assert destination.read_bytes() == (blob_dir / "model_1.0.0.pkl").read_bytes()
+
+
+def test_download_with_wrong_checksum_is_discarded(blob_dir, tmp_path):
+    (blob_dir / "model_1.0.0.pkl.sha256").write_text("0" * 64)
+    destination = tmp_path / "model_1.0.0.pkl"
+
+    with pytest.raises(ValueError):
+        download_blob(FileSystemBlobSource(blob_dir), "model_1.0.0.pkl", destination, chunk_bytes=1024)
+
+    assert list(tmp_path.glob("model_1.0.0.pkl*")) == []
+
+
+def test_cache_evicts_least_recently_used_artifacts(blob_dir, tmp_path):
+    for version in ["1.1.0", "1.2.0"]:
+        (blob_dir / f"model_{version}.pkl").write_bytes(os.urandom(10_000))
+    source = FileSystemBlobSource(blob_dir)
+    cache = ArtifactCache(tmp_path / "cache", max_bytes=25_000, chunk_bytes=4096)
+
+    first = cache.fetch(source, "model_1.0.0.pkl")
+    os.utime(first, (0, 0))
+    cache.fetch(source, "model_1.1.0.pkl")
+    cache.fetch(source, "model_1.2.0.pkl")
+
+    assert sorted(path.name for path in cache.artifacts()) == ["model_1.1.0.pkl", "model_1.2.0.pkl"]
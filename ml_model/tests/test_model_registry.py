@@ -0,0 +1,155 @@
+import os
+import threading
+import time
+import joblib
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from ml_model.config.dynamic_config import config
+from ml_model.model import model_utils
+from ml_model.model.model_utils import ModelPool, ModelRegistry, save_compact_artifact
+
+
+def fit_small_pipeline(n_estimators: int) -> Pipeline:
+    pipeline = Pipeline([("classifier", RandomForestClassifier(n_estimators=n_estimators, random_state=0))])
+    pipeline.fit([[0.0], [1.0], [2.0], [3.0]], [0, 0, 1, 1])
+
+    return pipeline
+
+
+@pytest.fixture
+def model_file(tmp_path):
+    """Fixture to create a small pipeline artifact on disk."""
+    file_path = tmp_path / "pipeline.pkl"
+    joblib.dump(fit_small_pipeline(n_estimators=2), file_path)
+
+    return file_path
+
+
+def test_registry_loads_pipeline_once(model_file):
+    registry = ModelRegistry(file_path=model_file, check_interval=0)
+
+    first = registry.get_pipeline()
+    second = registry.get_pipeline()
+
+    assert first is second
+    assert registry.metrics()["load_count"] == 1
+    assert registry.metrics()["memory_bytes"] > 0
+    assert registry.metrics()["artifact_bytes"] == model_file.stat().st_size
+
+
+def test_registry_swaps_in_changed_artifact(model_file):
+    registry = ModelRegistry(file_path=model_file, check_interval=0)
+    old_pipeline = registry.get_pipeline()
+
+    # Replace the artifact and make sure the modification time differs from the original one
+    joblib.dump(fit_small_pipeline(n_estimators=3), model_file)
+    stat = model_file.stat()
+    os.utime(model_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    new_pipeline = registry.get_pipeline()
+
+    assert new_pipeline is not old_pipeline
+    assert len(new_pipeline.named_steps["classifier"].estimators_) == 3
+    assert registry.metrics()["load_count"] == 2
+
+
+def test_registries_sharing_an_artifact_do_not_reload_each_other(model_file):
+    first = ModelRegistry(file_path=model_file, check_interval=0)
+    second = ModelRegistry(file_path=model_file, check_interval=0)
+    mtime_ns = model_file.stat().st_mtime_ns
+
+    # Every load marks the artifact as used in the artifact cache, which must not look like a new artifact
+    for _ in range(5):
+        first.get()
+        second.get()
+
+    assert first.metrics()["load_count"] == 1
+    assert second.metrics()["load_count"] == 1
+    assert model_file.stat().st_mtime_ns == mtime_ns
+
+
+def test_registry_keeps_current_model_when_reload_fails(model_file):
+    registry = ModelRegistry(file_path=model_file, check_interval=0)
+    old_pipeline = registry.get_pipeline()
+
+    # Simulate a corrupt artifact
+    model_file.write_bytes(b"not a pickle")
+
+    assert registry.get_pipeline() is old_pipeline
+    assert registry.metrics()["failed_reload_count"] == 1
+
+
+def test_registry_serves_compact_artifact(tmp_path):
+    pipeline = Pipeline([("scaler", StandardScaler()), ("classifier", RandomForestClassifier(n_estimators=3))])
+    pipeline.fit([[0.0], [1.0], [2.0], [3.0]], [0, 0, 1, 1])
+    file_path = save_compact_artifact(pipeline, tmp_path / "pipeline.compact.joblib")
+    registry = ModelRegistry(file_path=file_path, check_interval=0)
+
+    X = [[0.5], [1.5], [2.5]]
+    assert (registry.get_predictor().predict_proba(X) == pipeline.predict_proba(X)).all()
+    assert registry.metrics()["memory_bytes"] > 0
+
+
+def test_pool_loads_versions_lazily_and_evicts_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(model_utils, "TRAINED_MODEL_DIR", tmp_path)
+    for version, n_estimators in [("1.0.0", 2), ("2.0.0", 3)]:
+        joblib.dump(fit_small_pipeline(n_estimators), tmp_path / f"{config.app_config.pipeline_save_file}_{version}.pkl")
+    # A budget of a single byte only ever keeps the model in use
+    pool = ModelPool(default_version="1.0.0", max_bytes=1, check_interval=0)
+
+    assert pool.metrics()["loaded_versions"] == {}
+    assert pool.available_versions() == ["1.0.0", "2.0.0"]
+
+    assert pool.get().version == "1.0.0"
+    model = pool.get("2.0.0")
+
+    assert model.version == "2.0.0"
+    assert len(model.pipeline.named_steps["classifier"].estimators_) == 3
+    assert list(pool.metrics()["loaded_versions"]) == ["2.0.0"]
+    assert pool.eviction_count == 1
+
+    with pytest.raises(ValueError):
+        pool.resolve("../1.0.0")
+
+
+def test_pool_does_not_wait_for_a_loading_version_while_evicting_it(tmp_path, monkeypatch):
+    monkeypatch.setattr(model_utils, "TRAINED_MODEL_DIR", tmp_path)
+    for version in ["1.0.0", "2.0.0"]:
+        joblib.dump(fit_small_pipeline(2), tmp_path / f"{config.app_config.pipeline_save_file}_{version}.pkl")
+    pool = ModelPool(default_version="1.0.0", max_bytes=1, check_interval=0)
+    pool.get()
+    registry = pool.registry()
+
+    # A reload of the default version holds its load lock, while loading 2.0.0 evicts the default version
+    with registry._load_lock:
+        evicting = threading.Thread(target=pool.get, args=("2.0.0",))
+        evicting.start()
+        deadline = time.monotonic() + 5
+        while pool.eviction_count == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert pool.eviction_count == 1
+        assert pool.registry("2.0.0").version == "2.0.0"
+    evicting.join(timeout=5)
+
+    assert list(pool.metrics()["loaded_versions"]) == ["2.0.0"]
+
+
+def test_saving_a_pipeline_keeps_the_artifacts_of_the_served_version(tmp_path, monkeypatch):
+    monkeypatch.setattr(model_utils, "TRAINED_MODEL_DIR", tmp_path)
+    monkeypatch.setattr(config.serving_config, "default_model_version", "0.9.0")
+    monkeypatch.setattr(config.serving_config, "model_cache_max_bytes", 1)
+    old_artifacts = [
+        tmp_path / f"{config.app_config.pipeline_save_file}_{version}{suffix}"
+        for version in ["0.8.0", "0.9.0"] for suffix in [".pkl", ".flat.joblib"]
+    ]
+    for file_path in old_artifacts:
+        file_path.write_bytes(os.urandom(1000))
+        os.utime(file_path, (0, 0))
+
+    model_utils.save_pipeline(fit_small_pipeline(n_estimators=2))
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(
+        path.name for path in old_artifacts[2:] + [model_utils.get_pipeline_file_path()]
+    )
@@ -0,0 +1,65 @@
+import os
+import threading
+import pandas as pd
+from ml_model.config.dynamic_config import config
+from ml_model.model.parallelism import default_prediction_threads, ParallelismBudget
+
+
+def test_budget_shards_large_batches_over_idle_threads():
+    shard_sizes = []
+    lock = threading.Lock()
+
+    def predict_fn(input_data: pd.DataFrame):
+        with lock:
+            shard_sizes.append(len(input_data))
+        return input_data['x'].to_numpy() * 2
+
+    budget = ParallelismBudget(max_threads=4)
+    input_data = pd.DataFrame({'x': range(1000)})
+
+    predictions = budget.predict(predict_fn, input_data, min_rows_per_shard=100)
+
+    # The shards are predicted on all four threads and put back together in row order
+    assert predictions.tolist() == (input_data['x'] * 2).tolist()
+    assert sorted(shard_sizes) == [250, 250, 250, 250]
+    assert budget.active_threads == 0
+
+
+def test_budget_keeps_requests_on_their_own_thread_when_busy():
+    budget = ParallelismBudget(max_threads=4)
+
+    with budget.reserve(3) as first, budget.reserve(4) as second:
+        assert (first, second) == (3, 1)
+        assert budget.active_threads == 4
+
+
+def test_budget_makes_requests_wait_for_a_free_thread():
+    budget = ParallelismBudget(max_threads=2)
+    granted = []
+
+    def predict():
+        with budget.reserve(1) as n_threads:
+            granted.append(n_threads)
+
+    with budget.reserve(2):
+        waiting = threading.Thread(target=predict)
+        waiting.start()
+        waiting.join(timeout=0.2)
+        # The calling thread counts against the budget as well
+        assert waiting.is_alive()
+        assert budget.active_threads == 2
+
+    waiting.join(timeout=5)
+    assert granted == [1]
+    assert budget.active_threads == 0
+
+
+def test_default_budget_divides_the_cores_over_the_workers(monkeypatch):
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+
+    monkeypatch.setattr(config.serving_config, "serving_workers", 0)
+    assert default_prediction_threads() == 8
+    monkeypatch.setattr(config.serving_config, "serving_workers", 3)
+    assert default_prediction_threads() == 2
+    monkeypatch.setattr(config.serving_config, "serving_workers", 16)
+    assert default_prediction_threads() == 1
@@ -0,0 +1,56 @@
+import io
+import numpy as np
+import pandas as pd
+import pytest
+from ml_model.model import predict
+from ml_model.model.predict import TaskContext, clean_validate_and_predict, clean_validate_and_predict_in_chunks
+from ml_model.model.task_store import InMemoryTaskStore
+
+INVALID_CSV = "fixed acidity;volatile acidity\nabc;0.7\n"
+
+
+@pytest.fixture
+def context():
+    task_store = InMemoryTaskStore(max_tasks=10, ttl_seconds=60)
+    task_store.create("task")
+
+    return TaskContext(task_id="task", task_store=task_store)
+
+
+def test_spooled_upload_is_removed_when_validation_fails(context, tmp_path):
+    file_path = tmp_path / "upload.csv"
+    file_path.write_text(INVALID_CSV)
+
+    result = clean_validate_and_predict(context, str(file_path))
+
+    assert "errors" in result
+    assert context.task_store.get_status("task").startswith("failed")
+    assert not file_path.exists()
+
+
+def test_in_memory_upload_that_can_not_be_parsed_fails_the_task(context):
+    result = clean_validate_and_predict(context, io.BytesIO(b""))
+
+    assert "errors" in result
+    assert context.task_store.get_status("task").startswith("failed")
+
+
+def test_chunked_upload_fails_the_task_when_its_predictions_file_can_not_be_created(context, tmp_path):
+    # The predictions file is created next to the upload, in a directory that does not exist
+    result = clean_validate_and_predict_in_chunks(context, str(tmp_path / "missing" / "upload.csv"), chunk_size=10)
+
+    assert "errors" in result
+    assert context.task_store.get_status("task").startswith("failed")
+
+
+def test_topk_orders_classes_by_probability(monkeypatch):
+    classes = np.array([3, 5, 7])
+    probabilities = np.array([[0.2, 0.5, 0.3], [0.4, 0.2, 0.4]])
+    monkeypatch.setattr(predict, "predict_probabilities", lambda input_data, version=None: (classes, probabilities))
+
+    columns = predict.predict_columns(pd.DataFrame(index=range(2)), output="topk", k=2)
+
+    assert list(columns) == ["class_1", "score_1", "class_2", "score_2"]
+    assert columns["class_1"].tolist() == [5, 3]
+    assert columns["class_2"].tolist() == [7, 7]
+    assert columns["score_1"].tolist() == [0.5, 0.4]
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+from ml_model.model.prediction_cache import PredictionCache
+
+
+class CountingModel:
+    def __init__(self):
+        self.predicted_rows = 0
+
+    def predict(self, input_data: pd.DataFrame) -> np.ndarray:
+        self.predicted_rows += len(input_data)
+        return (input_data["Alcohol"] * 10).astype(int).to_numpy()
+
+
+def make_rows(alcohol):
+    return pd.DataFrame({"Alcohol": alcohol, "Color": ["red"] * len(alcohol)})
+
+
+@pytest.mark.parametrize("use_disk", [False, True])
+def test_only_cache_misses_are_predicted(tmp_path, use_disk):
+    cache = PredictionCache(max_entries=100, disk_path=tmp_path / "cache.sqlite3" if use_disk else None)
+    model = CountingModel()
+
+    first = cache.predict(make_rows([9.4, 10.2, 9.4]), model.predict, "model-a")
+    second = cache.predict(make_rows([10.2, 11.0]), model.predict, "model-a")
+
+    assert first.tolist() == [94, 102, 94]
+    assert second.tolist() == [102, 110]
+    assert model.predicted_rows == 3
+    assert cache.metrics()["hits"] == 1
+
+
+def test_cache_is_invalidated_when_the_model_changes():
+    cache = PredictionCache(max_entries=100)
+    model = CountingModel()
+
+    cache.predict(make_rows([9.4]), model.predict, "model-a")
+    cache.predict(make_rows([9.4]), model.predict, "model-b")
+
+    assert model.predicted_rows == 2
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    model = CountingModel()
+    PredictionCache(max_entries=100, disk_path=tmp_path / "cache.sqlite3").predict(
+        make_rows([9.4, 10.2]), model.predict, "model-a"
+    )
+    cache = PredictionCache(max_entries=100, disk_path=tmp_path / "cache.sqlite3")
+
+    assert cache.predict(make_rows([10.2]), model.predict, "model-a").tolist() == [102]
+    assert model.predicted_rows == 2
+    assert cache.metrics()["disk_hits"] == 1
+
+
+def test_least_recently_used_rows_are_evicted():
+    cache = PredictionCache(max_entries=2)
+    model = CountingModel()
+
+    cache.predict(make_rows([9.4, 10.2]), model.predict, "model-a")
+    cache.predict(make_rows([9.4, 11.0]), model.predict, "model-a")
+    cache.predict(make_rows([10.2]), model.predict, "model-a")
+
+    assert model.predicted_rows == 4
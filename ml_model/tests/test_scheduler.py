@@ -0,0 +1,68 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from ml_model.model.scheduler import AdmissionScheduler, QueueFullError
+
+
+@pytest.fixture
+def executor():
+    executor = ThreadPoolExecutor(max_workers=1)
+    yield executor
+    executor.shutdown(wait=True)
+
+
+def submit(scheduler, task_id, client_id, rows, fn, *args):
+    scheduler.submit(scheduler.reserve(task_id, client_id, rows), fn, *args)
+
+
+def test_tasks_are_rejected_when_the_queue_holds_too_many_rows(executor):
+    scheduler = AdmissionScheduler(executor, max_running=1, max_rows=1_000, max_queued_tasks=10)
+    release = threading.Event()
+
+    # A task larger than the limit is admitted when nothing else is queued
+    submit(scheduler, "large", "a", 5_000, release.wait)
+    with pytest.raises(QueueFullError) as error:
+        scheduler.reserve("small", "b", 10)
+
+    assert error.value.retry_after_seconds >= 1
+    assert scheduler.metrics()["rejected_count"] == 1
+    release.set()
+
+
+def test_tasks_of_unknown_size_are_rejected_once_their_size_is_known(executor):
+    scheduler = AdmissionScheduler(executor, max_running=1, max_rows=1_000, max_queued_tasks=10)
+    release = threading.Event()
+    submit(scheduler, "running", "a", 500, release.wait)
+
+    # Admitted at the smallest cost while the size is unknown
+    ticket = scheduler.reserve("unknown", "b", 0)
+    scheduler.resize(ticket, 400)
+    assert scheduler.metrics()["outstanding_rows"] == 900
+
+    with pytest.raises(QueueFullError):
+        scheduler.resize(ticket, 5_000)
+
+    assert scheduler.metrics()["outstanding_rows"] == 500
+    assert scheduler.metrics()["rejected_count"] == 1
+    release.set()
+
+
+def test_clients_take_turns_and_queue_positions_are_reported(executor):
+    scheduler = AdmissionScheduler(executor, max_running=1, max_rows=10_000, max_queued_tasks=10)
+    release = threading.Event()
+    order = []
+
+    submit(scheduler, "a1", "a", 100, release.wait)
+    for task_id in ("a2", "a3"):
+        submit(scheduler, task_id, "a", 100, order.append, task_id)
+    submit(scheduler, "b1", "b", 100, order.append, "b1")
+
+    assert scheduler.queue_position("b1") == 0
+    assert scheduler.queue_position("a3") == 2
+    assert scheduler.queue_position("a1") is None
+
+    release.set()
+    while scheduler.metrics()["queued_tasks"] or scheduler.metrics()["running_tasks"]:
+        executor.submit(lambda: None).result()
+
+    assert order == ["b1", "a2", "a3"]
@@ -0,0 +1,66 @@
+import threading
+import time
+import pytest
+from ml_model.model.task_store import InMemoryTaskStore, SqliteTaskStore
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def task_store(request, tmp_path):
+    """Fixture that provides every task store backend."""
+    if request.param == "memory":
+        return InMemoryTaskStore(max_tasks=10, ttl_seconds=60)
+    return SqliteTaskStore(path=tmp_path / "tasks.sqlite3", ttl_seconds=60)
+
+
+def test_task_store_keeps_status_progress_and_result(task_store):
+    task_store.create("task")
+    assert task_store.get_status("task") == "processing"
+
+    task_store.update("task", processed_rows=10)
+    task_store.update("task", status="completed", result={"predictions": [5, 6], "version": "1.0.0"})
+
+    record = task_store.get("task")
+    assert record.status == "completed"
+    assert record.processed_rows == 10
+    assert record.result == {"predictions": [5, 6], "version": "1.0.0"}
+    assert task_store.get("unknown") is None
+
+
+def test_in_memory_task_store_evicts_least_recently_updated_tasks():
+    task_store = InMemoryTaskStore(max_tasks=2, ttl_seconds=60)
+    for task_id in ["first", "second", "third"]:
+        task_store.create(task_id)
+
+    assert len(task_store) == 2
+    assert task_store.get("first") is None
+    assert task_store.get_status("third") == "processing"
+
+
+def test_task_store_evicts_expired_tasks_and_their_files(tmp_path):
+    predictions_file = tmp_path / "upload.csv.predictions"
+    predictions_file.write_text("5\n")
+    task_store = InMemoryTaskStore(max_tasks=10, ttl_seconds=0)
+
+    task_store.update("old", status="completed", result={"predictions_file": str(predictions_file)})
+    task_store.create("new")
+
+    assert task_store.get("old") is None
+    assert not predictions_file.exists()
+
+
+def test_waiting_for_a_task_returns_on_its_next_update(task_store):
+    task_store.create("task")
+    since = task_store.get("task").updated_at
+
+    # Without an update, the wait times out and returns the task as it is
+    assert task_store.wait("task", since, timeout=0.05).status == "processing"
+
+    timer = threading.Timer(0.05, task_store.update, args=("task",), kwargs={"status": "completed"})
+    timer.start()
+    start = time.monotonic()
+    record = task_store.wait("task", since, timeout=5)
+    timer.join()
+
+    assert record.status == "completed"
+    assert time.monotonic() - start < 1
+    assert task_store.wait("unknown", 0.0, timeout=5) is None
@@ -0,0 +1,33 @@
+import numpy as np
+from ml_model.model.tune_pipeline import make_leaderboard, pick_best_candidate, successive_halving
+
+
+def test_successive_halving_keeps_the_best_candidates():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(1200, 4)).astype(np.float32)
+    y = (X[:, 0] > 0).astype(int)
+    candidates = [{"n_estimators": 5, "max_depth": max_depth} for max_depth in [1, 2, 4, 8]]
+
+    evaluations = successive_halving(X, y, candidates, factor=2, n_splits=3, n_workers=2)
+    leaderboard = make_leaderboard(evaluations)
+
+    assert evaluations.groupby("round")["candidate"].count().tolist() == [4, 2]
+    assert evaluations.groupby("round")["n_samples"].first().tolist() == [600, 1200]
+    assert len(leaderboard) == 4
+    assert leaderboard["round"].tolist() == [1, 1, 0, 0]
+    assert {"fit_seconds", "predict_latency_ms", "model_bytes"} <= set(leaderboard.columns)
+
+
+def test_candidates_over_the_latency_budget_are_pruned_every_round():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(1200, 4)).astype(np.float32)
+    y = (X[:, 0] > 0).astype(int)
+    candidates = [{"n_estimators": 5, "max_depth": max_depth} for max_depth in [1, 2, 4, 8]]
+
+    evaluations = successive_halving(X, y, candidates, factor=2, n_splits=3, n_workers=2, max_latency_ms=0.0)
+    leaderboard = make_leaderboard(evaluations)
+
+    # No candidate is fast enough, so none continues to the rows of the next round
+    assert evaluations["round"].unique().tolist() == [0]
+    assert pick_best_candidate(leaderboard, max_latency_ms=0.0) is None
+    assert pick_best_candidate(leaderboard)["candidate"] == leaderboard.loc[0, "candidate"]